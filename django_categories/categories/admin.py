@@ -1,3 +1,217 @@
-from django.contrib import admin
+"""
+Admin for tables with millions of rows.
 
-# Register your models here.
+The stock changelist runs an unbounded COUNT(*) per page view (two, with
+show_full_result_count), renders foreign keys as selects listing every
+category, and fetches the categories of every similarity pair one by one.
+Here foreign keys use autocomplete widgets backed by the name search index,
+rows are fetched with their related categories in the page query, and the
+paginator estimates large counts. Bulk actions run the set-based code paths
+(Category.save's subtree UPDATE, similarity_io) rather than per-row saves.
+"""
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connection, transaction
+from django.utils.functional import cached_property
+
+from .models import Category, CategorySimilarity
+from .search import filter_by_name
+from .similarity_io import mark_similar_many, merge_similarities, unmark_similar_many
+
+# Tables with more rows than this (by estimate) are not counted exactly when unfiltered
+ESTIMATE_THRESHOLD = 100000
+
+# Filtered changelists count at most this many rows
+COUNT_LIMIT = 10000
+
+
+def estimated_row_count(model):
+    """A cheap estimate of the number of rows of model's table, None if unavailable."""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+        elif connection.vendor == 'sqlite':
+            # Ids are never reused: an upper bound, off by the deleted rows
+            cursor.execute(f'SELECT MAX(id) FROM {connection.ops.quote_name(table)}')
+        else:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the table size estimate for large unfiltered changelists, and
+    counts filtered ones up to COUNT_LIMIT rows. Either way the count may
+    fall short of the real one, so pages past it are still served (by plain
+    slicing, empty past the last row) instead of being rejected.
+    """
+
+    # Whether count is the real number of rows
+    exact = True
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model)
+            if estimate is not None and estimate > ESTIMATE_THRESHOLD:
+                self.exact = False
+                return estimate
+            return queryset.count()
+
+        count = queryset[:COUNT_LIMIT + 1].count()
+        if count > COUNT_LIMIT:
+            self.exact = False
+            return COUNT_LIMIT
+        return count
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if self.exact or int(number) < 1:
+                raise
+            return int(number)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if self.exact:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
+
+
+class TargetActionForm(ActionForm):
+    target_id = forms.IntegerField(
+        required=False, label='Target category id', help_text='For "move subtree" and "merge similarities"',
+    )
+
+
+class CategorySimilarityAdminForm(forms.ModelForm):
+    class Meta:
+        model = CategorySimilarity
+        fields = ['category_a', 'category_b']
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('category_a') is not None and cleaned_data.get('category_a') == cleaned_data.get('category_b'):
+            raise forms.ValidationError('A category cannot be similar to itself.')
+        return cleaned_data
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 100
+    ordering = ('id',)
+
+
+def _target(modeladmin, request):
+    """The category named in the action form, or None after reporting why not."""
+    try:
+        target_id = int(request.POST.get('target_id') or '')
+    except ValueError:
+        modeladmin.message_user(request, 'Enter a target category id.', messages.ERROR)
+        return None
+    target = Category.objects.filter(id=target_id).first()
+    if target is None:
+        modeladmin.message_user(request, f'Category {target_id} does not exist.', messages.ERROR)
+    return target
+
+
+@admin.register(Category)
+class CategoryAdmin(LargeTableAdmin):
+    list_display = ('id', 'name', 'parent', 'depth', 'child_count', 'similarity_degree', 'island_id')
+    list_select_related = ('parent',)
+    list_filter = (('parent', admin.EmptyFieldListFilter),)
+    search_fields = ('name',)
+    autocomplete_fields = ('parent',)
+    readonly_fields = ('depth', 'path', 'similarity_degree', 'island_id', 'created_at', 'updated_at')
+    action_form = TargetActionForm
+    actions = ('move_subtree', 'merge_similarities')
+
+    def get_queryset(self, request):
+        # Correlated COUNT on the (parent, id) index, evaluated for the page rows only
+        return super().get_queryset(request).with_child_count()
+
+    def get_search_results(self, request, queryset, search_term):
+        # The name index instead of icontains over the whole table
+        return filter_by_name(queryset, search_term), False
+
+    @admin.display(description='Children')
+    def child_count(self, obj):
+        return obj.child_count
+
+    @admin.action(description='Move subtree under the target category')
+    def move_subtree(self, request, queryset):
+        target = _target(self, request)
+        if target is None:
+            return
+
+        moved = 0
+        try:
+            with transaction.atomic():
+                # One UPDATE per moved subtree, see Category.move_descendants
+                for category in queryset.order_by('depth', 'id'):
+                    category.parent = target
+                    category.save()
+                    moved += 1
+        except ValueError as error:
+            self.message_user(request, str(error), messages.ERROR)
+            return
+        self.message_user(request, f'Moved {moved} categories with their subtrees under {target.name}.')
+
+    @admin.action(description='Merge similarities into the target category')
+    def merge_similarities(self, request, queryset):
+        target = _target(self, request)
+        if target is None:
+            return
+
+        created, deleted = merge_similarities(queryset.values_list('id', flat=True), target.id)
+        self.message_user(
+            request, f'Moved {deleted} similarities to {target.name} ({created} new after removing duplicates).',
+        )
+
+
+@admin.register(CategorySimilarity)
+class CategorySimilarityAdmin(LargeTableAdmin):
+    form = CategorySimilarityAdminForm
+    list_display = ('id', 'category_a', 'category_b', 'created_at')
+    list_select_related = ('category_a', 'category_b')
+    autocomplete_fields = ('category_a', 'category_b')
+    # Exact id lookups, served by the (category_a, category_b) and
+    # (category_b, category_a) indexes
+    search_fields = ('=category_a__id', '=category_b__id')
+    actions = ('unmark_selected',)
+
+    def get_actions(self, request):
+        # The stock delete skips the island split, see unmark_selected
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def get_readonly_fields(self, request, obj=None):
+        # Changing the ends of an edge is a delete and an add
+        return ('category_a', 'category_b') if obj is not None else ()
+
+    def save_model(self, request, obj, form, change):
+        # Through the batch path, which also merges the islands
+        if not change:
+            id_a, id_b = sorted((obj.category_a_id, obj.category_b_id))
+            mark_similar_many([(id_a, id_b)])
+            obj.pk = CategorySimilarity.objects.values_list('id', flat=True).get(category_a_id=id_a, category_b_id=id_b)
+
+    def delete_model(self, request, obj):
+        unmark_similar_many([(obj.category_a_id, obj.category_b_id)])
+
+    def delete_queryset(self, request, queryset):
+        unmark_similar_many(list(queryset.values_list('category_a_id', 'category_b_id')))
+
+    @admin.action(description='Delete selected similarities')
+    def unmark_selected(self, request, queryset):
+        deleted = unmark_similar_many(list(queryset.values_list('category_a_id', 'category_b_id')))
+        self.message_user(request, f'Deleted {deleted} similarities.')
@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CategoriesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'categories'
+
+    def ready(self):
+        # Keeps the shared similarity graph in sync with model writes
+        from . import signals  # noqa: F401
+
+        post_migrate.connect(_ensure_search_triggers, sender=self)
+
+
+def _ensure_search_triggers(using, **kwargs):
+    # Migrations that rebuild the categories table drop the name index triggers
+    from .search import ensure_search_triggers
+
+    ensure_search_triggers(using)
@@ -0,0 +1,123 @@
+"""
+Conditional GET and response caching keyed on GraphVersion.
+
+Responses of decorated views only depend on the request path and the
+graph data, so the persisted graph version is all it takes to validate
+them: it becomes the ETag, its timestamp the Last-Modified date, and part
+of the cache key under which the rendered body is stored. Clients and
+CDNs revalidating an unchanged graph get a 304 after a single primary key
+lookup; anyone else gets the cached body. Entries of older versions are
+never read again and simply expire.
+
+The version is read from the database, while graph-backed bodies come
+from the graph of this process, which may not have replayed the latest
+writes of other processes yet. Before rendering a body to store under a
+version, the graph is caught up to at least that version (see
+catch_up_graph_service()), so a body is never older than its key and ETag.
+"""
+import functools
+import hashlib
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .graph_service import catch_up_graph_service, run_in_graph_executor
+from .models import GraphVersion
+
+CACHE_PREFIX = 'categories.graph'
+
+
+def _cache_key(request, version):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'{CACHE_PREFIX}:{version}:{path}'
+
+
+def _validators(version, updated_at):
+    return f'"graph-{version}"', (int(updated_at.timestamp()) if updated_at else None)
+
+
+def _not_modified(request, etag, last_modified):
+    """The 304 (or 412) response if the client's copy is current, else None."""
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        _add_headers(response, etag, last_modified)
+    return response
+
+
+def _add_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Shared caches may keep it, but have to revalidate on every use
+    patch_cache_control(response, public=True, no_cache=True)
+
+
+def _timeout():
+    return getattr(settings, 'CATEGORY_GRAPH_CACHE_TIMEOUT', 300)
+
+
+def _cacheable(response):
+    return response.status_code == 200 and not response.streaming
+
+
+def _from_cache(cached):
+    content, content_type = cached
+    return HttpResponse(content, content_type=content_type)
+
+
+def graph_version_cached(view):
+    """Adds ETag / Last-Modified validation and server-side caching to a GET view, sync or async."""
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await view(request, *args, **kwargs)
+
+            version, updated_at = await sync_to_async(GraphVersion.current)()
+            etag, last_modified = _validators(version, updated_at)
+            response = _not_modified(request, etag, last_modified)
+            if response is not None:
+                return response
+
+            key = _cache_key(request, version)
+            cached = await cache.aget(key)
+            if cached is not None:
+                response = _from_cache(cached)
+            else:
+                await run_in_graph_executor(catch_up_graph_service, version)
+                response = await view(request, *args, **kwargs)
+                if _cacheable(response):
+                    await cache.aset(key, (response.content, response['Content-Type']), _timeout())
+            _add_headers(response, etag, last_modified)
+            return response
+
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        version, updated_at = GraphVersion.current()
+        etag, last_modified = _validators(version, updated_at)
+        response = _not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        key = _cache_key(request, version)
+        cached = cache.get(key)
+        if cached is not None:
+            response = _from_cache(cached)
+        else:
+            catch_up_graph_service(version)
+            response = view(request, *args, **kwargs)
+            if _cacheable(response):
+                cache.set(key, (response.content, response['Content-Type']), _timeout())
+        _add_headers(response, etag, last_modified)
+        return response
+
+    return wrapper
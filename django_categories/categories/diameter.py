@@ -0,0 +1,174 @@
+"""
+Exact diameter (longest rabbit hole) of the similarity graph.
+
+Each island is solved with iFUB (iterative Fringe Upper Bound): BFS from a
+central node u splits the island into distance levels, and only nodes on the
+outermost levels can be endpoints of a diameter path. Their eccentricities
+are computed level by level, from the outside in, until the lower bound
+(the best eccentricity seen so far) beats the upper bound 2 * (level - 1)
+that every remaining inner node is subject to. On the dense, small-world
+islands we deal with this touches a handful of levels instead of running a
+BFS from every node.
+
+The eccentricity BFS runs within one fringe level are independent, so large
+levels can be spread over a process pool when workers are configured.
+Workers are spawned rather than forked, as forking a multithreaded web worker
+can copy locks held by other threads into the children. They receive the
+graph once, via the pool initializer, and work on storage keys only (no
+database access).
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Fringe levels smaller than this are cheaper to run in-process than to ship
+# to the pool
+PARALLEL_MIN_FRINGE = 64
+
+_worker_graph = None
+
+
+def _init_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _worker_eccentricities(nodes):
+    return [(node,) + eccentricity(_worker_graph, node) for node in nodes]
+
+
+def eccentricity(graph, start):
+    """Returns (eccentricity, one of the farthest nodes) for start."""
+    visited = {start}
+    frontier = [start]
+    distance = 0
+
+    while True:
+        next_frontier = []
+        for node in frontier:
+            for neighbor in graph.neighbors(node):
+                if neighbor not in visited:
+                    visited.add(neighbor)
+                    next_frontier.append(neighbor)
+
+        if not next_frontier:
+            return distance, frontier[0]
+
+        distance += 1
+        frontier = next_frontier
+
+
+def _bfs_tree(graph, start):
+    """Returns ({node: parent}, [[level 0 nodes], [level 1 nodes], ...])."""
+    parent_map = {start: None}
+    levels = [[start]]
+
+    while True:
+        next_level = []
+        for node in levels[-1]:
+            for neighbor in graph.neighbors(node):
+                if neighbor not in parent_map:
+                    parent_map[neighbor] = node
+                    next_level.append(neighbor)
+
+        if not next_level:
+            return parent_map, levels
+        levels.append(next_level)
+
+
+def _path_to(parent_map, node):
+    path = []
+    while node is not None:
+        path.append(node)
+        node = parent_map[node]
+    return path
+
+
+class DiameterEngine:
+    def __init__(self, graph, workers=None):
+        self.graph = graph
+        # In-process unless asked for more workers
+        self.pool_size = workers or 1
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _pool(self):
+        """The process pool, started on first use so small graphs never pay for it."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.pool_size,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.graph,),
+            )
+        return self._executor
+
+    def _eccentricities(self, nodes):
+        """(node, eccentricity, farthest node) for every node, in parallel when worthwhile."""
+        if self.pool_size < 2 or len(nodes) < PARALLEL_MIN_FRINGE:
+            return [(node,) + eccentricity(self.graph, node) for node in nodes]
+
+        chunk_size = max(PARALLEL_MIN_FRINGE // 4, len(nodes) // (self.pool_size * 4) + 1)
+        chunks = [nodes[start:start + chunk_size] for start in range(0, len(nodes), chunk_size)]
+        results = []
+        for chunk_result in self._pool().map(_worker_eccentricities, chunks):
+            results.extend(chunk_result)
+        return results
+
+    def island_diameter(self, island):
+        """Returns (diameter, endpoint_a, endpoint_b) of one island."""
+        graph = self.graph
+        if len(island) == 1:
+            return 0, island[0], island[0]
+
+        # Double sweep from the best connected node: gives a first lower
+        # bound a-b and, as the middle of that path, a central start node
+        hub = max(island, key=lambda node: len(graph.neighbors(node)))
+        _, node_a = eccentricity(graph, hub)
+        parents_a, levels_a = _bfs_tree(graph, node_a)
+        node_b = levels_a[-1][0]
+        lower_bound, best = len(levels_a) - 1, (node_a, node_b)
+
+        sweep_path = _path_to(parents_a, node_b)
+        center = sweep_path[len(sweep_path) // 2]
+
+        _, levels = _bfs_tree(graph, center)
+        level = len(levels) - 1
+        upper_bound = 2 * level
+
+        while upper_bound > lower_bound and level > 0:
+            for node, node_eccentricity, farthest in self._eccentricities(levels[level]):
+                if node_eccentricity > lower_bound:
+                    lower_bound, best = node_eccentricity, (node, farthest)
+
+            # Any node at a lower level is within 2 * (level - 1) of every
+            # node at or below it, and the fringe above is already covered
+            if lower_bound >= 2 * (level - 1):
+                break
+            upper_bound = 2 * (level - 1)
+            level -= 1
+
+        return lower_bound, best[0], best[1]
+
+    def longest_path(self, islands):
+        """Exact longest shortest path (as storage keys) across all islands."""
+        best = None
+        for island in islands:
+            if best is not None and len(island) - 1 <= best[0]:
+                continue # Too small to hold a longer path
+            result = self.island_diameter(island)
+            if best is None or result[0] > best[0]:
+                best = result
+
+        if best is None:
+            return []
+
+        _, start, end = best
+        parent_map, _ = _bfs_tree(self.graph, start)
+        return _path_to(parent_map, end)[::-1]
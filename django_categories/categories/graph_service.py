@@ -1,68 +1,603 @@
-from collections import defaultdict, deque
-from .models import Category, CategorySimilarity
+import asyncio
+import contextvars
+import functools
+import heapq
+import threading
+import time
+import weakref
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Min
+
+from .diameter import DiameterEngine
+from .graph_snapshot import load_current_snapshot
+from .graph_storage import GRAPH_STORAGES
+from .landmarks import LandmarkIndex
+from .metrics import timed
+from .models import Category, CategorySimilarity, GraphChange, GraphVersion
+from .sql_graph import SQLGraphService
+
+# Sequence numbers re-read behind the last applied GraphChange entry on every
+# catch-up, to pick up entries of transactions that committed after an entry
+# with a higher number had already been seen
+CHANGE_LOG_OVERLAP = 1000
+
+# GraphChange kind -> graph storage method and number of ids it takes
+_CHANGE_METHODS = {
+    GraphChange.ADD_NODE: ('add_node', 1),
+    GraphChange.REMOVE_NODE: ('remove_node', 1),
+    GraphChange.ADD_EDGE: ('add_edge', 2),
+    GraphChange.REMOVE_EDGE: ('remove_edge', 2),
+}
 
 class CategoryGraphService:
-    def __init__(self):
-        # In memory graph representation: {category_id: [similar_id1, similar_id2, ...]}
-        self.adjacency_list = defaultdict(list)
-        self.all_category_ids = set(Category.objects.values_list('id', flat=True))
+    def __init__(self, storage=None, landmarks=None):
+        # 'dict' keeps {category_id: [similar_id1, ...]} and is patched in
+        # place; 'csr' keeps compact arrays and is rebuilt lazily after writes;
+        # 'mmap' maps a CSR snapshot file shared by all worker processes.
+        self.storage = storage or getattr(settings, 'CATEGORY_GRAPH_STORAGE', 'dict')
+        self.graph = None
+
+        # Bumped on every rebuild and every incremental patch
+        self.version = 0
+        self.built_at = None
+
+        # Last GraphChange sequence number reflected in the graph, the numbers
+        # applied within CHANGE_LOG_OVERLAP of it, and when the log was read
+        self.change_seq = 0
+        self._applied_seqs = set()
+        self.caught_up_at = None
+        # Persisted GraphVersion the graph reflects at least: read before the
+        # data on every rebuild and catch-up
+        self.data_version = 0
+        self._stale = False
+        self._lock = threading.RLock()
+
+        # Connected component labels, computed on first use and patched on
+        # merges: {node: label} and {label: [node, ...]}
+        self._component_of = None
+        self._components = None
+        self._next_label = 0
+
+        # (graph version, path ids) of the last exact diameter computation
+        self._exact_diameter = None
+
+        # Landmarks per island for distance bounds and ALT search (0: none);
+        # the index is built on first use and dropped whenever the graph changes
+        self.landmark_count = (
+            landmarks if landmarks is not None else getattr(settings, 'CATEGORY_GRAPH_LANDMARKS', 0)
+        )
+        self.landmark_min_island = getattr(settings, 'CATEGORY_GRAPH_LANDMARK_MIN_ISLAND', 1000)
+        self.landmark_search = getattr(settings, 'CATEGORY_GRAPH_LANDMARK_SEARCH', False)
+        self._landmarks = None
 
         # Build the graph
-        self._build_graph()
+        self.rebuild()
+
+    def rebuild(self):
+        """Reloads the whole graph from the database."""
+        with self._lock, timed('graph_build'):
+            # Read before the graph: changes committed while it loads are
+            # replayed by the next catch_up(), which is harmless
+            self.data_version = GraphVersion.current()[0]
+            self.change_seq = GraphChange.last_seq()
+            self._applied_seqs = set(
+                GraphChange.objects.filter(id__gt=self.change_seq - CHANGE_LOG_OVERLAP).values_list('id', flat=True)
+            )
+
+            self.graph = self._build_graph()
+            self._stale = False
+            self._invalidate_components()
+            self.version += 1
+            self.built_at = self.caught_up_at = time.monotonic()
+
+    def catch_up(self):
+        """
+        Applies the GraphChange entries logged by any process since the last
+        rebuild or catch-up. Returns the number of entries applied, or None
+        if the graph was rebuilt instead: when the log was compacted past our
+        position, a bulk load reset it, more than CATEGORY_GRAPH_CATCH_UP_MAX
+        entries are pending, or the storage cannot be patched.
+
+        Entries are applied in sequence order from the first one not applied
+        yet, re-applying any later ones. Each entry sets the state of a node
+        or edge outright, so the result is the same as applying every entry
+        exactly once.
+        """
+        max_pending = getattr(settings, 'CATEGORY_GRAPH_CATCH_UP_MAX', 10000)
+
+        with self._lock, timed('graph_catch_up'):
+            data_version = GraphVersion.current()[0]
+            first_seq = GraphChange.objects.aggregate(first=Min('id'))['first']
+            if first_seq is not None and first_seq > self.change_seq + 1:
+                self.rebuild() # Entries we never saw were compacted
+                return None
+
+            window = max_pending + CHANGE_LOG_OVERLAP
+            changes = list(
+                GraphChange.objects.filter(id__gt=self.change_seq - CHANGE_LOG_OVERLAP)
+                .order_by('id')
+                .values_list('id', 'kind', 'category_a_id', 'category_b_id')[:window + 1]
+            )
+            start = next((index for index, change in enumerate(changes) if change[0] not in self._applied_seqs), None)
+            if start is None:
+                self.data_version = max(self.data_version, data_version)
+                self.caught_up_at = time.monotonic()
+                return 0
+
+            pending = changes[start:]
+            if (
+                len(changes) > window
+                or not self.graph.supports_updates
+                or any(kind == GraphChange.RESET for _, kind, _, _ in pending)
+            ):
+                self.rebuild()
+                return None
+
+            for _, kind, id_a, id_b in pending:
+                method_name, arity = _CHANGE_METHODS[kind]
+                if arity == 1:
+                    self._apply(method_name, id_a)
+                elif id_a in self.graph and id_b in self.graph:
+                    # Either end may be gone if a later removal was already applied
+                    self._apply(method_name, id_a, id_b)
+
+            self.change_seq = max(self.change_seq, changes[-1][0])
+            self._applied_seqs.update(seq for seq, _, _, _ in pending)
+            self._applied_seqs = {seq for seq in self._applied_seqs if seq > self.change_seq - CHANGE_LOG_OVERLAP}
+            self.data_version = max(self.data_version, data_version)
+            self.caught_up_at = time.monotonic()
+            return len(pending)
 
     def _build_graph(self):
         """Builds the undirected graph from the CategorySimilarity table."""
+        if self.storage == 'mmap':
+            return load_current_snapshot()
+
+        all_category_ids = Category.objects.values_list('id', flat=True)
 
         # Load all similarity pairs efficiently in one query
         similarities = CategorySimilarity.objects.all().values_list(
             'category_a_id', 'category_b_id'
         )
 
-        for id_a, id_b in similarities:
-            # Since similarity is bidirectional, add the edge in both directions
-            self.adjacency_list[id_a].append(id_b)
-            self.adjacency_list[id_b].append(id_a)
+        return GRAPH_STORAGES[self.storage].from_edges(all_category_ids, similarities.iterator())
+
+    def _current_graph(self):
+        """Returns the graph, rebuilding it first if a write invalidated it."""
+        if self._stale:
+            self.rebuild()
+        return self.graph
+
+    def _apply(self, method_name, *args):
+        """Patches the graph in place, or marks it for a rebuild if the storage is immutable."""
+        with self._lock:
+            if self.graph.supports_updates:
+                changed = getattr(self.graph, method_name)(*args)
+            else:
+                changed = True
+                self._stale = True
 
-        # Ensure all categories are in the adjacency list, even if isolated
-        for cat_id in self.all_category_ids:
-            if cat_id not in self.adjacency_list:
-                self.adjacency_list[cat_id] = []
+            if changed:
+                self.version += 1
+                self._update_components(method_name, *args)
+
+    def _invalidate_components(self):
+        self._component_of = None
+        self._components = None
+
+    def _update_components(self, method_name, *args):
+        """
+        Keeps component labels current after a patch. Additions only ever
+        merge islands, which is cheap to apply. Removing an edge searches
+        from both of its ends in turn (see _split_off), so it costs the
+        smaller side of a split, or less. Removing a node recomputes the
+        components of its own island only.
+        """
+        if self._components is None:
+            return
+
+        if self._stale:
+            self._invalidate_components()
+        elif method_name == 'add_node':
+            (node,) = args
+            self._component_of[node] = self._next_label
+            self._components[self._next_label] = [node]
+            self._next_label += 1
+        elif method_name == 'add_edge':
+            label_a = self._component_of.get(args[0])
+            label_b = self._component_of.get(args[1])
+            if label_a is None or label_b is None:
+                self._invalidate_components()
+            elif label_a != label_b:
+                # Relabel the smaller island into the larger one
+                if len(self._components[label_a]) < len(self._components[label_b]):
+                    label_a, label_b = label_b, label_a
+                merged = self._components.pop(label_b)
+                for node in merged:
+                    self._component_of[node] = label_a
+                self._components[label_a].extend(merged)
+        elif method_name == 'remove_edge':
+            label = self._component_of.get(args[0])
+            if label is None or label != self._component_of.get(args[1]):
+                self._invalidate_components()
+                return
+            part = self._split_off(self.graph, args[0], args[1])
+            if part is not None:
+                self._components[label] = [node for node in self._components[label] if node not in part]
+                self._add_component(part)
+        else:
+            (node,) = args
+            label = self._component_of.pop(node, None)
+            if label is None:
+                return
+            members = [member for member in self._components.pop(label) if member != node]
+            for island in self._islands(self.graph, members):
+                self._add_component(island)
+
+    def _add_component(self, nodes):
+        label = self._next_label
+        self._next_label += 1
+        self._components[label] = list(nodes)
+        for node in nodes:
+            self._component_of[node] = label
+
+    @staticmethod
+    def _split_off(graph, node_a, node_b):
+        """
+        The part of their island cut off by removing the edge between node_a
+        and node_b, as a set of nodes, or None if the two are still connected.
+        A search runs from each end, one node at a time in turn: the first to
+        run out has found the part split off, and meeting the other search
+        means nothing split.
+        """
+        searches = (({node_a}, [node_a]), ({node_b}, [node_b]))
+        while True:
+            for side, (visited, stack) in enumerate(searches):
+                if not stack:
+                    return visited
+                other_visited = searches[1 - side][0]
+                for neighbor in graph.neighbors(stack.pop()):
+                    if neighbor in other_visited:
+                        return None
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        stack.append(neighbor)
+
+    def _components_for(self, graph):
+        """Returns {label: [node, ...]} for the current graph, computing it if needed."""
+        if self._components is None:
+            self._components = dict(enumerate(self._islands(graph)))
+            self._component_of = {
+                node: label
+                for label, island in self._components.items()
+                for node in island
+            }
+            self._next_label = len(self._components)
+        return self._components
+
+    def _landmarks_for(self, graph):
+        """The landmark index of the current graph version, or None if landmarks are disabled."""
+        if not self.landmark_count:
+            return None
+        if not self._has_current_landmarks():
+            with timed('graph_landmarks'):
+                self._landmarks = LandmarkIndex(
+                    graph,
+                    self._components_for(graph).values(),
+                    self.landmark_count,
+                    min_island_size=self.landmark_min_island,
+                    version=self.version,
+                )
+        return self._landmarks
+
+    def _has_current_landmarks(self):
+        return self._landmarks is not None and self._landmarks.version == self.version
+
+    def landmark_stats(self):
+        """Size and build cost of the landmark index, None if it is disabled or out of date."""
+        landmarks = self._landmarks
+        if landmarks is None or landmarks.version != self.version:
+            return None
+        return landmarks.stats()
+
+    def build_landmarks(self):
+        """Builds the landmark index now rather than on the first query. Returns its stats, or None."""
+        with self._lock:
+            landmarks = self._landmarks_for(self._current_graph())
+            return landmarks.stats() if landmarks is not None else None
+
+    def add_category(self, cat_id):
+        """Registers a new, isolated category."""
+        self._apply('add_node', cat_id)
+
+    def remove_category(self, cat_id):
+        """Drops a category together with all of its similarity edges."""
+        self._apply('remove_node', cat_id)
+
+    def add_similarity(self, id_a, id_b):
+        """Adds an undirected edge. Adding an existing edge is a no-op."""
+        self._apply('add_edge', id_a, id_b)
+
+    def remove_similarity(self, id_a, id_b):
+        """Removes an undirected edge. Removing a missing edge is a no-op."""
+        self._apply('remove_edge', id_a, id_b)
+
+    def add_similarities(self, pairs):
+        """Adds many edges under a single lock acquisition."""
+        with self._lock:
+            for id_a, id_b in pairs:
+                self._apply('add_edge', id_a, id_b)
+
+    def remove_similarities(self, pairs):
+        """Removes many edges under a single lock acquisition."""
+        with self._lock:
+            for id_a, id_b in pairs:
+                self._apply('remove_edge', id_a, id_b)
 
     def find_shortest_path(self, start_id, end_id):
         """Finds the shortest sequence (rabbit hole) from start to end."""
         if start_id == end_id:
             return [start_id]
 
-        queue = deque([start_id])
-        visited = {start_id}
-        # Parent map to reconstruct the path: {child_id: parent_id}
-        parent_map = {start_id: None}
+        with self._lock, timed('graph_traversal'):
+            graph = self._current_graph()
+            start = graph.key_of(start_id)
+            end = graph.key_of(end_id)
+            if start is None or end is None:
+                return None
 
-        while queue:
-            current_id = queue.popleft()
+            # Different islands: no path, and no need to explore either one
+            self._components_for(graph)
+            if self._component_of[start] != self._component_of[end]:
+                return None
+
+            landmarks = self._landmarks_for(graph) if self.landmark_search else None
+            if landmarks is not None and landmarks.covers(start):
+                path = landmarks.find_path(graph, start, end)
+            else:
+                path = self._bidirectional_bfs(graph, start, end)
+
+        if path is None:
+            return None # Path not found
+        return [graph.id_of(node) for node in path]
+
+    def find_shortest_paths(self, pairs):
+        """
+        Shortest paths for many (start_id, end_id) pairs at once, as a list
+        aligned with pairs, None where there is no path. The graph is
+        undirected, so pairs are grouped by start or by end, whichever gives
+        fewer groups, and each group shares its work:
+
+        A bidirectional search only expands a few hundred nodes even on
+        large islands, far less than one BFS over the island. So the
+        targets of a group are searched one by one, until the searches so
+        far project more expanded nodes for the remaining targets than the
+        island holds; a single BFS from the group's end, stopping once every
+        remaining target is reached, then finds all the others.
+        """
+        pairs = [(int(start_id), int(end_id)) for start_id, end_id in pairs]
+        results = [None] * len(pairs)
+        flip = len({end_id for _, end_id in pairs}) < len({start_id for start_id, _ in pairs})
+
+        with self._lock, timed('graph_traversal'):
+            graph = self._current_graph()
+            self._components_for(graph)
+
+            groups = {} # source node -> [(pair index, target node)]
+            for index, (start_id, end_id) in enumerate(pairs):
+                if start_id == end_id:
+                    results[index] = [start_id]
+                    continue
+                source, target = graph.key_of(start_id), graph.key_of(end_id)
+                if flip:
+                    source, target = target, source
+                if source is None or target is None or self._component_of[source] != self._component_of[target]:
+                    continue
+                groups.setdefault(source, []).append((index, target))
+
+            for source, targets in groups.items():
+                pending = list(dict.fromkeys(target for _, target in targets))
+                island_size = len(self._components[self._component_of[source]])
+                paths = {}
+                expanded = 0
+                for done, target in enumerate(pending):
+                    if done and expanded * (len(pending) - done) >= island_size * done:
+                        parent_map = self._bfs_until(graph, source, pending[done:])
+                        for target in pending[done:]:
+                            if target in parent_map:
+                                paths[target] = self._walk_back(parent_map, target)[::-1]
+                        break
+                    paths[target], target_expanded = self._bidirectional_search(graph, source, target)
+                    expanded += target_expanded
+
+                for index, target in targets:
+                    path = paths.get(target)
+                    if path is not None:
+                        path = [graph.id_of(node) for node in path]
+                        results[index] = path[::-1] if flip else path
+
+        return results
+
+    @staticmethod
+    def _bfs_until(graph, start, targets):
+        """BFS from start that stops once every node of targets is reached. Returns {node: parent}."""
+        parent_map = {start: None}
+        remaining = set(targets)
+        remaining.discard(start)
+        frontier = [start]
+
+        while frontier and remaining:
+            next_frontier = []
+            for node in frontier:
+                for neighbor in graph.neighbors(node):
+                    if neighbor not in parent_map:
+                        parent_map[neighbor] = node
+                        next_frontier.append(neighbor)
+                        remaining.discard(neighbor)
+            frontier = next_frontier
+
+        return parent_map
+
+    def neighborhood(self, cat_id, k, limit=None):
+        """
+        Categories within k similarity hops of cat_id, as ([[ids at 1 hop],
+        [ids at 2 hops], ...], truncated). Each level is expanded in one go,
+        with set operations over the neighbor lists of the whole frontier
+        rather than a Python loop per node. With a limit, the search stops
+        once that many categories were found, keeping the lowest ids of the
+        last level.
+        """
+        with self._lock, timed('graph_neighborhood'):
+            graph = self._current_graph()
+            start = graph.key_of(cat_id)
+            if start is None:
+                return None, False
+
+            visited = {start}
+            frontier = [start]
+            levels = []
+            found = 0
+            truncated = False
+            for _ in range(k):
+                level = set(chain.from_iterable(map(graph.neighbors, frontier)))
+                level.difference_update(visited)
+                if not level:
+                    break
 
-            for neighbor_id in self.adjacency_list.get(current_id, []):
-                if neighbor_id == end_id:
-                    # Found the end, reconstruct path
-                    path = [end_id]
-                    while current_id is not None:
-                        path.append(current_id)
-                        current_id = parent_map.get(current_id)
-                    return path[::-1] # Reverse the path to go start -> end
+                # Keys sort like ids in every storage
+                if limit is not None and found + len(level) > limit:
+                    level = heapq.nsmallest(limit - found, level)
+                    truncated = True
+                else:
+                    level = sorted(level)
 
-                if neighbor_id not in visited:
-                    visited.add(neighbor_id)
-                    parent_map[neighbor_id] = current_id
-                    queue.append(neighbor_id)
+                if level:
+                    found += len(level)
+                    levels.append([graph.id_of(node) for node in level])
+                if truncated:
+                    break
+                visited.update(level)
+                frontier = level
 
-        return None # Path not found
+        return levels, truncated
+
+    def distance_bounds(self, id_a, id_b):
+        """
+        (lower, upper) bounds of the rabbit hole length (similarity hops)
+        between two categories, or None if they are not connected. Answered
+        from the landmark distances in O(#landmarks) when their island has
+        landmarks; otherwise the exact length, found by search.
+        """
+        if id_a == id_b:
+            return (0, 0) if self.same_island(id_a, id_b) else None
+
+        with self._lock, timed('graph_distance'):
+            graph = self._current_graph()
+            node_a = graph.key_of(id_a)
+            node_b = graph.key_of(id_b)
+            if node_a is None or node_b is None:
+                return None
+
+            self._components_for(graph)
+            if self._component_of[node_a] != self._component_of[node_b]:
+                return None
+
+            landmarks = self._landmarks_for(graph)
+            if landmarks is not None:
+                bounds = landmarks.distance_bounds(node_a, node_b)
+                if bounds is not None:
+                    return bounds
+
+            length = len(self._bidirectional_bfs(graph, node_a, node_b)) - 1
+            return length, length
+
+    def same_island(self, id_a, id_b):
+        """Whether two categories are connected by any chain of similarities."""
+        with self._lock:
+            graph = self._current_graph()
+            node_a = graph.key_of(id_a)
+            node_b = graph.key_of(id_b)
+            if node_a is None or node_b is None:
+                return False
+            self._components_for(graph)
+            return self._component_of[node_a] == self._component_of[node_b]
+
+    def _bidirectional_bfs(self, graph, start, end):
+        return self._bidirectional_search(graph, start, end)[0]
+
+    def _bidirectional_search(self, graph, start, end):
+        """
+        Searches from both ends at once, always expanding one full level of
+        the smaller frontier. Once a level produces a meeting point, the best
+        meeting point of that level gives a shortest path.
+        Returns (path or None, number of nodes expanded).
+        """
+        parents = ({start: None}, {end: None})
+        depths = ({start: 0}, {end: 0})
+        frontiers = ([start], [end])
+        expanded = 0
+
+        while frontiers[0] and frontiers[1]:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            expanded += len(frontiers[side])
+            own_parents, own_depths = parents[side], depths[side]
+            other_depths = depths[1 - side]
+
+            best = None # (path length, node on this side, node on the other side)
+            next_frontier = []
+            for node in frontiers[side]:
+                node_depth = own_depths[node]
+                for neighbor in graph.neighbors(node):
+                    if neighbor in other_depths:
+                        length = node_depth + 1 + other_depths[neighbor]
+                        if best is None or length < best[0]:
+                            best = (length, node, neighbor)
+                    if neighbor not in own_parents:
+                        own_parents[neighbor] = node
+                        own_depths[neighbor] = node_depth + 1
+                        next_frontier.append(neighbor)
+
+            if best is not None:
+                _, near, far = best
+                if side == 1:
+                    near, far = far, near
+                return self._walk_back(parents[0], near)[::-1] + self._walk_back(parents[1], far), expanded
+
+            frontiers = (next_frontier, frontiers[1]) if side == 0 else (frontiers[0], next_frontier)
+
+        return None, expanded
+
+    @staticmethod
+    def _walk_back(parent_map, node):
+        path = []
+        while node is not None:
+            path.append(node)
+            node = parent_map[node]
+        return path
 
     def get_rabbit_islands(self):
-        """Finds all connected components (rabbit islands)."""
+        """Finds all connected components (rabbit islands) as lists of category ids."""
+        with self._lock, timed('graph_islands'):
+            graph = self._current_graph()
+            return [
+                [graph.id_of(node) for node in island]
+                for island in self._components_for(graph).values()
+            ]
+
+    def _islands(self, graph, nodes=None):
+        """
+        Connected components of the storage graph, as lists of storage keys:
+        all of them, or those of the given nodes.
+        """
         visited = set()
         islands = []
 
-        for start_node in self.all_category_ids:
+        for start_node in graph.nodes() if nodes is None else nodes:
             if start_node not in visited:
                 island = []
                 stack = [start_node] # Using a stack for DFS
@@ -74,7 +609,7 @@ class CategoryGraphService:
                         island.append(node)
 
                         # Add unvisited neighbors to the stack
-                        for neighbor in self.adjacency_list.get(node, []):
+                        for neighbor in graph.neighbors(node):
                             if neighbor not in visited:
                                 stack.append(neighbor)
 
@@ -83,57 +618,255 @@ class CategoryGraphService:
 
         return islands
 
-    def find_longest_rabbit_hole(self):
+    def find_longest_rabbit_hole(self, exact=False):
         """
         Finds the longest shortest path (graph diameter) in the largest island.
         This is O(N * (N+E)), which is slow, so we use the two-BFS approximation
         on the largest component for robustness.
+        With exact=True the true diameter over every island is computed with
+        bound pruning (see diameter.py) and cached until the graph changes.
         """
-        islands = self.get_rabbit_islands()
-        if not islands:
-            return []
+        if exact:
+            return self._find_exact_longest_rabbit_hole()
+
+        with self._lock, timed('graph_diameter'):
+            graph = self._current_graph()
+            islands = list(self._components_for(graph).values())
+            if not islands:
+                return []
+
+            # Find the largest island
+            largest_island = max(islands, key=len, default=[])
+
+            if not largest_island:
+                return []
 
-        # Find the largest island
-        largest_island = max(islands, key=len, default=[])
+            # 1. Run BFS from a random node (A) in the largest island to find the farthest node (B)
+            start_node = largest_island[0]
+            farthest_node_b, _, parent_map_a = self._bfs_farthest(graph, start_node)
 
-        if not largest_island:
-            return []
+            # 2. Run BFS from B to find the farthest node (C)
+            farthest_node_c, max_distance, parent_map_b = self._bfs_farthest(graph, farthest_node_b)
 
-        # 1. Run BFS from a random node (A) in the largest island to find the farthest node (B)
-        start_node = largest_island[0]
-        farthest_node_b, _, parent_map_a = self._bfs_farthest(start_node)
+            # 3. Reconstruct the path B -> C
+            path = [farthest_node_c]
+            current = parent_map_b.get(farthest_node_c)
+            while current is not None:
+                path.append(current)
+                current = parent_map_b.get(current)
 
-        # 2. Run BFS from B to find the farthest node (C)
-        farthest_node_c, max_distance, parent_map_b = self._bfs_farthest(farthest_node_b)
+            return [graph.id_of(node) for node in reversed(path)] # Longest path B -> C
 
-        # 3. Reconstruct the path B -> C
-        path = [farthest_node_c]
-        current = parent_map_b.get(farthest_node_c)
-        while current is not None:
-            path.append(current)
-            current = parent_map_b.get(current)
+    def _find_exact_longest_rabbit_hole(self):
+        # This can take seconds: only the snapshot is taken under the lock,
+        # so paths, neighborhoods and patches are not held up meanwhile
+        with self._lock:
+            graph = self._current_graph()
+            version = self.version
+            if self._exact_diameter is not None and self._exact_diameter[0] == version:
+                return list(self._exact_diameter[1])
 
-        return path[::-1] # Longest path B -> C
+            # Largest islands first, so small ones can be skipped by size
+            islands = sorted((list(island) for island in self._components_for(graph).values()), key=len, reverse=True)
+            graph = graph.snapshot()
 
-    def _bfs_farthest(self, start_id):
+        with timed('graph_diameter_exact'):
+            workers = getattr(settings, 'CATEGORY_GRAPH_DIAMETER_WORKERS', None)
+            with DiameterEngine(graph, workers=workers) as engine:
+                path = [graph.id_of(node) for node in engine.longest_path(islands)]
+
+        with self._lock:
+            if self.version == version:
+                self._exact_diameter = (version, path)
+        return list(path)
+
+    def _bfs_farthest(self, graph, start):
         """Helper to run BFS and return the farthest node and path map."""
-        queue = deque([(start_id, 0)]) # (node, distance)
-        visited = {start_id}
-        parent_map = {start_id: None}
+        queue = deque([(start, 0)]) # (node, distance)
+        visited = {start}
+        parent_map = {start: None}
         max_dist = 0
-        farthest_node = start_id
+        farthest_node = start
 
         while queue:
-            current_id, dist = queue.popleft()
+            current, dist = queue.popleft()
 
             if dist > max_dist:
                 max_dist = dist
-                farthest_node = current_id
+                farthest_node = current
 
-            for neighbor_id in self.adjacency_list.get(current_id, []):
-                if neighbor_id not in visited:
-                    visited.add(neighbor_id)
-                    parent_map[neighbor_id] = current_id
-                    queue.append((neighbor_id, dist + 1))
+            for neighbor in graph.neighbors(current):
+                if neighbor not in visited:
+                    visited.add(neighbor)
+                    parent_map[neighbor] = current
+                    queue.append((neighbor, dist + 1))
 
         return farthest_node, max_dist, parent_map
+
+    def stats(self, rebuild=True):
+        """
+        Size of the in-memory graph, for diagnostics. With rebuild=False a
+        graph invalidated by writes is reported as it is rather than
+        reloaded first. The storages keep their sizes current, so this is
+        cheap enough for every metrics scrape.
+        """
+        with self._lock:
+            graph = self._current_graph() if rebuild else self.graph
+            return {
+                'storage': self.storage,
+                'version': self.version,
+                'nodes': len(graph),
+                'edges': graph.edge_count(),
+                'memory_bytes': graph.memory_bytes(),
+                'landmarks': self.landmark_stats(),
+            }
+
+
+# Process-wide graph, built on first use and patched in place by the signal
+# handlers in signals.py.
+_graph_service = None
+_graph_service_lock = threading.Lock()
+
+
+def _needs_build():
+    max_age = getattr(settings, 'CATEGORY_GRAPH_MAX_AGE', None)
+    return _graph_service is None or (
+        max_age is not None and time.monotonic() - _graph_service.built_at > max_age
+    )
+
+
+def _needs_catch_up():
+    interval = getattr(settings, 'CATEGORY_GRAPH_CATCH_UP_INTERVAL', None)
+    caught_up_at = getattr(_graph_service, 'caught_up_at', None)
+    return interval is not None and caught_up_at is not None and time.monotonic() - caught_up_at > interval
+
+
+def _graph_engine():
+    """
+    The engine class for the current graph: the in-memory one, unless the
+    storage is 'sql' or the graph has at least CATEGORY_GRAPH_SQL_THRESHOLD
+    similarities and would take too much memory per worker.
+    """
+    threshold = getattr(settings, 'CATEGORY_GRAPH_SQL_THRESHOLD', None)
+    if getattr(settings, 'CATEGORY_GRAPH_STORAGE', 'dict') == 'sql' or (
+        threshold is not None and CategorySimilarity.objects.count() >= threshold
+    ):
+        return SQLGraphService
+    return CategoryGraphService
+
+
+def get_graph_service(rebuild=False):
+    """
+    Returns the shared graph service (CategoryGraphService or SQLGraphService)
+    for this process.
+    The writes of other processes are replayed from the GraphChange log at
+    most every CATEGORY_GRAPH_CATCH_UP_INTERVAL seconds (if set), and the
+    graph is rebuilt once it is older than CATEGORY_GRAPH_MAX_AGE seconds
+    (if set).
+    Every rebuild picks the engine again, as the graph grows or shrinks.
+    Threads arriving during a build wait for it instead of starting their own.
+    """
+    global _graph_service
+
+    with _graph_service_lock:
+        if _graph_service is None:
+            _graph_service = _graph_engine()()
+        elif rebuild or _needs_build():
+            engine = _graph_engine()
+            if isinstance(_graph_service, engine):
+                _graph_service.rebuild()
+            else:
+                _graph_service = engine()
+        elif _needs_catch_up():
+            _graph_service.catch_up()
+
+        return _graph_service
+
+
+# Bounded pool for CPU-bound graph work requested from async views, so it
+# never runs on (and blocks) the event loop.
+_graph_executor = None
+_graph_executor_lock = threading.Lock()
+
+# Build in progress per event loop, awaited by every request that needs it
+_inflight_builds = weakref.WeakKeyDictionary()
+
+
+def graph_executor():
+    global _graph_executor
+
+    with _graph_executor_lock:
+        if _graph_executor is None:
+            _graph_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'CATEGORY_GRAPH_EXECUTOR_WORKERS', 4),
+                thread_name_prefix='category-graph',
+            )
+        return _graph_executor
+
+
+def _run_with_connections(func, *args, **kwargs):
+    """
+    Runs func on a worker thread. Workers outlive requests, so the request
+    signals never close their database connections: drop unusable or
+    expired ones before and after, as Django does around every request.
+    """
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_graph_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Run in a copy of our context, so the request's timings are recorded
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        graph_executor(), functools.partial(context.run, _run_with_connections, func, *args, **kwargs)
+    )
+
+
+async def aget_graph_service():
+    """
+    Async get_graph_service(). When a (re)build is needed it runs in the
+    graph executor, and every coroutine arriving meanwhile awaits that same
+    build ("single-flight") instead of queueing a build of its own.
+    """
+    if not _needs_build() and not _needs_catch_up():
+        return _graph_service
+
+    loop = asyncio.get_running_loop()
+    build = _inflight_builds.get(loop)
+    if build is None:
+        build = asyncio.ensure_future(run_in_graph_executor(get_graph_service))
+        _inflight_builds[loop] = build
+        build.add_done_callback(lambda _: _inflight_builds.pop(loop, None))
+
+    # A cancelled request must not cancel the build others are waiting for
+    return await asyncio.shield(build)
+
+
+def catch_up_graph_service(version):
+    """
+    Replays the change log now, whatever CATEGORY_GRAPH_CATCH_UP_INTERVAL
+    says, if the shared graph may predate the persisted GraphVersion version.
+    Responses cached or validated under that version (see caching.py) must
+    not be rendered from an older graph. A graph not built yet is built
+    from current data anyway, and the SQL engine has nothing to catch up.
+    """
+    with _graph_service_lock:
+        if _graph_service is not None and getattr(_graph_service, 'data_version', version) < version:
+            _graph_service.catch_up()
+
+
+def get_cached_graph_service():
+    """Returns the shared graph if it has been built, without building it."""
+    return _graph_service
+
+
+def reset_graph_service():
+    """Drops the shared graph; the next get_graph_service() call rebuilds it."""
+    global _graph_service
+
+    with _graph_service_lock:
+        _graph_service = None
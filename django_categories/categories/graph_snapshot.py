@@ -0,0 +1,155 @@
+"""
+On-disk CSR snapshot of the similarity graph, shared by worker processes.
+
+File layout (native byte order, every section 8-byte aligned):
+
+    header   magic, format version, n, len(indices), database version
+    ids      int64[n]      dense index -> category id, ascending
+    indptr   int64[n + 1]  row offsets into indices
+    indices  int32[...]    concatenated neighbor indices
+
+Workers mmap the file read-only and wrap the sections in memoryviews, so
+they all share one physical copy through the page cache and loading costs
+no more than reading the header. The header records the database version
+the snapshot was built from (GraphVersion); a snapshot that no longer
+matches is rebuilt.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+
+from django.conf import settings
+
+from .graph_storage import CSRGraph
+from .models import Category, CategorySimilarity, GraphVersion
+
+MAGIC = b'CATGRAPH'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('=8sIIQQ64s')  # magic, format, padding, n, len(indices), db version
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_path():
+    default = os.path.join(tempfile.gettempdir(), 'category-graph.snapshot')
+    return str(getattr(settings, 'CATEGORY_GRAPH_SNAPSHOT_PATH', default))
+
+
+def _padded(size):
+    return size + (-size % 8)
+
+
+def database_version():
+    """The persisted GraphVersion, bumped by every write to the graph data."""
+    return str(GraphVersion.current()[0])
+
+
+def write_snapshot(graph, version, path=None):
+    """Writes a CSRGraph atomically: readers see either the old or the new file."""
+    path = path or snapshot_path()
+    directory = os.path.dirname(os.path.abspath(path))
+
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.graph-snapshot-')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, 0, len(graph.ids), len(graph.indices), version.encode(),
+            ))
+            for section in (graph.ids, graph.indptr, graph.indices):
+                data = section.tobytes()
+                snapshot_file.write(data)
+                snapshot_file.write(b'\0' * (_padded(len(data)) - len(data)))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    return path
+
+
+def read_header(path=None):
+    """Returns (n, len(indices), database version) without mapping the arrays."""
+    with open(path or snapshot_path(), 'rb') as snapshot_file:
+        raw = snapshot_file.read(HEADER.size)
+
+    if len(raw) < HEADER.size:
+        raise SnapshotError('Truncated graph snapshot')
+    magic, format_version, _, node_count, index_count, version = HEADER.unpack(raw)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise SnapshotError('Not a graph snapshot, or written by another format version')
+    return node_count, index_count, version.rstrip(b'\0').decode()
+
+
+def load_snapshot(path=None):
+    """Maps the snapshot read-only. Returns (CSRGraph, database version)."""
+    path = path or snapshot_path()
+    node_count, index_count, version = read_header(path)
+    layout = ((node_count, 'q', 8), (node_count + 1, 'q', 8), (index_count, 'i', 4))
+
+    with open(path, 'rb') as snapshot_file:
+        mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(mapped) < HEADER.size + sum(_padded(length * itemsize) for length, _, itemsize in layout):
+        mapped.close()
+        raise SnapshotError('Truncated graph snapshot')
+
+    view = memoryview(mapped)
+    offset = HEADER.size
+    sections = []
+    for length, typecode, itemsize in layout:
+        size = length * itemsize
+        sections.append(view[offset:offset + size].cast(typecode))
+        offset += _padded(size)
+
+    return CSRGraph(*sections), version
+
+
+def build_snapshot(path=None):
+    """Builds the CSR graph from the database and writes it. Returns (path, version)."""
+    # Read the version first: a write landing during the build then makes
+    # the snapshot look stale rather than silently missing that write.
+    version = database_version()
+    graph = CSRGraph.from_edges(
+        Category.objects.values_list('id', flat=True),
+        CategorySimilarity.objects.values_list('category_a_id', 'category_b_id').iterator(),
+    )
+    return write_snapshot(graph, version, path), version
+
+
+def load_current_snapshot(path=None):
+    """
+    Maps the snapshot, rebuilding it first if it is missing or older than
+    the database. An exclusive lock file makes concurrent workers wait for
+    one rebuild instead of each running their own.
+    """
+    path = path or snapshot_path()
+    current_version = database_version()
+
+    try:
+        graph, version = load_snapshot(path)
+        if version == current_version:
+            return graph
+    except (OSError, SnapshotError):
+        pass
+
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Another worker may have rebuilt it while we waited for the lock
+            try:
+                if read_header(path)[2] != database_version():
+                    build_snapshot(path)
+            except (OSError, SnapshotError):
+                build_snapshot(path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    graph, _ = load_snapshot(path)
+    return graph
@@ -0,0 +1,250 @@
+import sys
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+BOXED_INT_BYTES = sys.getsizeof(1 << 20)
+EMPTY_LIST_BYTES = sys.getsizeof([])
+
+
+class AdjacencyListGraph:
+    """
+    Dict-of-lists storage: {category_id: [similar_id1, similar_id2, ...]}.
+    Nodes are addressed by their category id, and the graph can be patched
+    in place.
+    """
+    supports_updates = True
+
+    def __init__(self):
+        self.adjacency_list = defaultdict(list)
+        # Kept current by every patch, so sizes never need a walk of the graph
+        self._edges = 0
+        self._node_bytes = 0  # keys, neighbor lists and boxed neighbor ints
+
+    @classmethod
+    def from_edges(cls, category_ids, edges):
+        graph = cls()
+
+        for id_a, id_b in edges:
+            # Since similarity is bidirectional, add the edge in both directions
+            graph.adjacency_list[id_a].append(id_b)
+            graph.adjacency_list[id_b].append(id_a)
+
+        # Ensure all categories are in the adjacency list, even if isolated
+        for cat_id in category_ids:
+            if cat_id not in graph.adjacency_list:
+                graph.adjacency_list[cat_id] = []
+
+        graph._count()
+        return graph
+
+    def _count(self):
+        """Computes the sizes from scratch, once per build."""
+        self._edges = sum(len(neighbors) for neighbors in self.adjacency_list.values()) // 2
+        self._node_bytes = sum(
+            sys.getsizeof(cat_id) + sys.getsizeof(neighbors)
+            for cat_id, neighbors in self.adjacency_list.items()
+        )
+        # Every neighbor entry holds its own boxed int from the query rows
+        self._node_bytes += self._edges * 2 * BOXED_INT_BYTES
+
+    def __len__(self):
+        return len(self.adjacency_list)
+
+    def __contains__(self, cat_id):
+        return cat_id in self.adjacency_list
+
+    def nodes(self):
+        return self.adjacency_list.keys()
+
+    def neighbors(self, node):
+        return self.adjacency_list.get(node, ())
+
+    def key_of(self, cat_id):
+        return cat_id if cat_id in self.adjacency_list else None
+
+    def id_of(self, node):
+        return node
+
+    def edge_count(self):
+        return self._edges
+
+    def memory_bytes(self):
+        """Approximate footprint of the container objects and boxed ints."""
+        return sys.getsizeof(self.adjacency_list) + self._node_bytes
+
+    def snapshot(self):
+        """A copy that later patches of this graph leave untouched."""
+        graph = type(self)()
+        graph.adjacency_list.update((cat_id, list(neighbors)) for cat_id, neighbors in self.adjacency_list.items())
+        graph._count()
+        return graph
+
+    def add_node(self, cat_id):
+        if cat_id in self.adjacency_list:
+            return False
+        self.adjacency_list[cat_id] = []
+        self._node_bytes += sys.getsizeof(cat_id) + EMPTY_LIST_BYTES
+        return True
+
+    def remove_node(self, cat_id):
+        if cat_id not in self.adjacency_list:
+            return False
+        neighbors = self.adjacency_list.pop(cat_id)
+        self._node_bytes -= sys.getsizeof(cat_id) + sys.getsizeof(neighbors) + len(neighbors) * BOXED_INT_BYTES
+        for neighbor_id in neighbors:
+            neighbor_neighbors = self.adjacency_list.get(neighbor_id)
+            if neighbor_neighbors and cat_id in neighbor_neighbors:
+                size = sys.getsizeof(neighbor_neighbors)
+                neighbor_neighbors.remove(cat_id)
+                self._node_bytes -= size - sys.getsizeof(neighbor_neighbors) + BOXED_INT_BYTES
+                self._edges -= 1
+        return True
+
+    def add_edge(self, id_a, id_b):
+        if id_b in self.adjacency_list.get(id_a, ()):
+            return False
+        self.add_node(id_a)
+        self.add_node(id_b)
+        neighbors_a, neighbors_b = self.adjacency_list[id_a], self.adjacency_list[id_b]
+        size = sys.getsizeof(neighbors_a) + sys.getsizeof(neighbors_b)
+        neighbors_a.append(id_b)
+        neighbors_b.append(id_a)
+        self._edges += 1
+        self._node_bytes += sys.getsizeof(neighbors_a) + sys.getsizeof(neighbors_b) - size + 2 * BOXED_INT_BYTES
+        return True
+
+    def remove_edge(self, id_a, id_b):
+        neighbors_a = self.adjacency_list.get(id_a, [])
+        if id_b not in neighbors_a:
+            return False
+        neighbors_b = self.adjacency_list[id_b]
+        size = sys.getsizeof(neighbors_a) + sys.getsizeof(neighbors_b)
+        neighbors_a.remove(id_b)
+        neighbors_b.remove(id_a)
+        self._edges -= 1
+        self._node_bytes -= size - sys.getsizeof(neighbors_a) - sys.getsizeof(neighbors_b) + 2 * BOXED_INT_BYTES
+        return True
+
+
+class CSRGraph:
+    """
+    Compressed sparse row storage. Category ids are remapped to dense indices
+    0..n-1 (in ascending id order) and the neighbors of index i are
+    indices[indptr[i]:indptr[i + 1]]. Everything lives in three flat typed
+    arrays (or memoryviews of a mapped snapshot, see graph_snapshot.py), so
+    there is no per-node or per-edge Python object.
+    Nodes are addressed by their dense index. The structure is immutable;
+    callers rebuild it after writes.
+    """
+    supports_updates = False
+
+    def __init__(self, ids, indptr, indices):
+        self.ids = ids          # index -> category id, sorted ascending
+        self.indptr = indptr    # len(ids) + 1 offsets into indices
+        self.indices = indices  # concatenated neighbor indices
+        self._indices_view = memoryview(indices)
+
+    def __getstate__(self):
+        # Memoryviews (ours, or mmap-backed arrays) cannot be pickled, e.g.
+        # when the graph is shipped to worker processes
+        return {
+            'ids': _to_array('q', self.ids),
+            'indptr': _to_array('q', self.indptr),
+            'indices': _to_array('i', self.indices),
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state['ids'], state['indptr'], state['indices'])
+
+    @classmethod
+    def from_edges(cls, category_ids, edges):
+        ids = array('q', sorted(category_ids))
+        n = len(ids)
+
+        # Temporary id -> index map, dropped once the arrays are filled
+        index_of = {cat_id: index for index, cat_id in enumerate(ids)}.get
+
+        # Edges as interleaved (index_a, index_b) pairs plus per-node degrees
+        pairs = array('i')
+        degree = [0] * n
+        for id_a, id_b in edges:
+            index_a = index_of(id_a)
+            index_b = index_of(id_b)
+            if index_a is None or index_b is None:
+                continue
+            pairs.append(index_a)
+            pairs.append(index_b)
+            degree[index_a] += 1
+            degree[index_b] += 1
+        del index_of
+
+        # Prefix sums turn the degree counts into row offsets
+        indptr = array('q', bytes(8 * (n + 1)))
+        total = 0
+        for index, node_degree in enumerate(degree):
+            indptr[index] = total
+            total += node_degree
+        indptr[n] = total
+        del degree
+
+        indices = array('i', bytes(4 * total))
+        cursor = indptr.tolist()
+        pair_iter = iter(pairs)
+        for index_a in pair_iter:
+            index_b = next(pair_iter)
+            indices[cursor[index_a]] = index_b
+            cursor[index_a] += 1
+            indices[cursor[index_b]] = index_a
+            cursor[index_b] += 1
+
+        return cls(ids, indptr, indices)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, cat_id):
+        return self.key_of(cat_id) is not None
+
+    def nodes(self):
+        return range(len(self.ids))
+
+    def neighbors(self, node):
+        return self._indices_view[self.indptr[node]:self.indptr[node + 1]]
+
+    def key_of(self, cat_id):
+        index = bisect_left(self.ids, cat_id)
+        if index < len(self.ids) and self.ids[index] == cat_id:
+            return index
+        return None
+
+    def id_of(self, node):
+        return self.ids[node]
+
+    def edge_count(self):
+        return len(self.indices) // 2
+
+    def snapshot(self):
+        """The graph itself: it is never patched."""
+        return self
+
+    def memory_bytes(self):
+        return sum(
+            len(arr) * arr.itemsize
+            for arr in (self.ids, self.indptr, self.indices)
+        )
+
+
+def _to_array(typecode, values):
+    """Copies an array or a memoryview into a plain array."""
+    if isinstance(values, array):
+        return values
+    copy = array(typecode)
+    copy.frombytes(values.tobytes())
+    return copy
+
+
+GRAPH_STORAGES = {
+    'dict': AdjacencyListGraph,
+    'csr': CSRGraph,
+}
@@ -0,0 +1,185 @@
+"""
+Maintenance of the persisted Category.island_id labels.
+
+Every category carries the label of the connected component (rabbit island)
+it belongs to in the similarity graph. A label is always the id of one of the
+island's own members, so labels of different islands never collide.
+Adding edges merges islands (union-find over labels, then one relabelling
+UPDATE); removing an edge or a category only recomputes the island it
+touched. Merges lock the endpoints whose labels they read, splits the
+members they recompute, so concurrent writers never relabel from stale
+labels.
+"""
+from django.db import transaction
+from django.db.models import Case, Count, F, Value, When
+
+from .models import Category, CategorySimilarity, GraphVersion
+
+# Keeps IN (...) lists and CASE expressions below SQLite's variable limit
+BATCH_SIZE = 500
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        while parent != item:
+            grandparent = self.parent[parent]
+            self.parent[item] = grandparent # Path halving
+            item, parent = parent, grandparent
+        return item
+
+    def union(self, item_a, item_b):
+        root_a = self.find(item_a)
+        root_b = self.find(item_b)
+        if root_a != root_b:
+            self.parent[root_b] = root_a
+
+    def groups(self):
+        groups = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return groups
+
+
+def _batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def assign_missing_islands():
+    """Gives every unlabelled category (e.g. from bulk_create) its own island."""
+    with transaction.atomic():
+        updated = Category.objects.filter(island_id__isnull=True).update(island_id=F('id'))
+        if updated:
+            GraphVersion.bump()
+    return updated
+
+
+def union_edges(pairs):
+    """
+    Merges the islands joined by newly inserted (id_a, id_b) similarity pairs.
+    Each merged group keeps the label of its largest island, so only the
+    smaller islands are rewritten: the sizes come from one COUNT per batch
+    of labels, and each smaller island is relabelled by one UPDATE on the
+    island_id index. The endpoints are locked while their labels are read,
+    so a concurrent merge or split of their islands waits for this one.
+    """
+    pairs = list(pairs)
+    endpoint_ids = {cat_id for pair in pairs for cat_id in pair}
+    if not endpoint_ids:
+        return 0
+
+    with transaction.atomic():
+        label_of = {}
+        for batch in _batches(sorted(endpoint_ids)):
+            label_of.update(
+                Category.objects.select_for_update().filter(id__in=batch).order_by('id').values_list('id', 'island_id')
+            )
+
+        union_find = UnionFind()
+        for id_a, id_b in pairs:
+            label_a = label_of.get(id_a)
+            label_b = label_of.get(id_b)
+            if label_a is not None and label_b is not None:
+                union_find.union(label_a, label_b)
+
+        merged_groups = [labels for labels in union_find.groups().values() if len(labels) > 1]
+        if not merged_groups:
+            return 0
+
+        sizes = {}
+        for batch in _batches(label for labels in merged_groups for label in labels):
+            sizes.update(
+                Category.objects.filter(island_id__in=batch)
+                .values_list('island_id')
+                .annotate(size=Count('id'))
+                .order_by()
+            )
+
+        relabel = {}
+        for labels in merged_groups:
+            target = max(labels, key=lambda label: sizes.get(label, 0))
+            relabel.update({label: target for label in labels if label != target})
+
+        return _relabel(relabel)
+
+
+def _relabel(relabel):
+    """Applies {old_label: new_label}: one UPDATE per batch, with a CASE when it holds several labels."""
+    updated = 0
+    with transaction.atomic():
+        for batch in _batches(relabel.items()):
+            if len(batch) == 1:
+                ((old_label, new_label),) = batch
+                updated += Category.objects.filter(island_id=old_label).update(island_id=new_label)
+                continue
+            updated += Category.objects.filter(
+                island_id__in=[old_label for old_label, _ in batch]
+            ).update(island_id=Case(
+                *[When(island_id=old_label, then=Value(new_label)) for old_label, new_label in batch]
+            ))
+        if updated:
+            GraphVersion.bump()
+    return updated
+
+
+def split_island(label):
+    """
+    Recomputes the components of a single island after an edge or a member
+    was removed. The part that still contains the label keeps it, every
+    other part is relabelled to its smallest member id. The members are
+    locked from the read until the relabelling commits.
+    """
+    if label is None:
+        return 0
+
+    with transaction.atomic():
+        members = list(
+            Category.objects.select_for_update().filter(island_id=label).order_by('id').values_list('id', flat=True)
+        )
+        if not members:
+            return 0
+
+        union_find = UnionFind()
+        for cat_id in members:
+            union_find.find(cat_id)
+        for id_a, id_b in CategorySimilarity.objects.filter(
+            category_a__island_id=label
+        ).values_list('category_a_id', 'category_b_id'):
+            union_find.union(id_a, id_b)
+
+        updated = 0
+        for part in union_find.groups().values():
+            if label in part:
+                continue
+            new_label = min(part)
+            for batch in _batches(part):
+                updated += Category.objects.filter(id__in=batch).update(island_id=new_label)
+        if updated:
+            GraphVersion.bump()
+    return updated
+
+
+def recompute_islands():
+    """Full recompute of every label, e.g. after loading data with bulk_create."""
+    union_find = UnionFind()
+    current = dict(Category.objects.values_list('id', 'island_id'))
+    for cat_id in current:
+        union_find.find(cat_id)
+    for id_a, id_b in CategorySimilarity.objects.values_list('category_a_id', 'category_b_id').iterator():
+        union_find.union(id_a, id_b)
+
+    updated = 0
+    with transaction.atomic():
+        for part in union_find.groups().values():
+            label = min(part)
+            changed = [cat_id for cat_id in part if current[cat_id] != label]
+            for batch in _batches(changed):
+                updated += Category.objects.filter(id__in=batch).update(island_id=label)
+        if updated:
+            GraphVersion.bump()
+    return updated
@@ -0,0 +1,190 @@
+"""
+Landmark distance oracle for the similarity graph.
+
+A few landmark categories are picked per island, and the BFS distance from
+each of them to every member of the island is stored in a compact array.
+By the triangle inequality, for any landmark L:
+
+    |d(L, u) - d(L, v)|  <=  d(u, v)  <=  d(L, u) + d(L, v)
+
+so the distance between two categories is bounded in O(#landmarks), without
+touching the graph. The lower bound is also a consistent A* heuristic, which
+lets find_path() run a landmark-guided ("ALT") search that expands far fewer
+nodes than a one-sided BFS when paths are long. On small-world graphs, where
+every distance is close to log n, the bounds are loose and a bidirectional
+BFS is much faster, so the service only uses it when asked to
+(CATEGORY_GRAPH_LANDMARK_SEARCH).
+
+Landmarks are chosen by farthest-point selection: each new landmark is the
+member farthest from those already chosen, which keeps them on the
+periphery where their bounds are tightest. Building costs one BFS per
+landmark (plus one to find the first) and memory of one 2 or 4 byte
+distance per landmark and member. Islands smaller than min_island_size get
+no landmarks: a plain BFS is already cheap there.
+
+Distances only hold for the graph they were computed on: any patch makes
+the whole index invalid, see CategoryGraphService._landmarks_for().
+"""
+import heapq
+import sys
+import time
+from array import array
+from bisect import bisect_right
+
+
+def _bfs_distances(graph, start, position, offset, size):
+    """Distance array (indexed by position - offset) from start to every member of its island."""
+    distances = array('H' if size <= 0xFFFF else 'i', [0]) * size
+    visited = {start}
+    frontier = [start]
+    distance = 0
+
+    while frontier:
+        distance += 1
+        next_frontier = []
+        for node in frontier:
+            for neighbor in graph.neighbors(node):
+                if neighbor not in visited:
+                    visited.add(neighbor)
+                    distances[position[neighbor] - offset] = distance
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+
+    return distances
+
+
+class LandmarkIndex:
+    def __init__(self, graph, islands, landmarks_per_island, min_island_size=1, version=None):
+        """
+        Picks up to landmarks_per_island landmarks in every island (lists of
+        storage keys) of at least min_island_size members. version is the
+        graph version the distances are valid for.
+        """
+        start_time = time.perf_counter()
+        self.version = version
+
+        # Members of indexed islands are numbered contiguously, island after
+        # island: {node: position}, the first position of each island, and
+        # per island the landmark nodes and their distance arrays
+        self._position = {}
+        self._offsets = []
+        self._landmarks = []
+        self._distances = []
+
+        for island in islands:
+            size = len(island)
+            if size < max(2, min_island_size) or landmarks_per_island < 1:
+                continue
+
+            offset = len(self._position)
+            for index, node in enumerate(island, start=offset):
+                self._position[node] = index
+
+            # The first landmark is the member farthest from an arbitrary one
+            seed = _bfs_distances(graph, island[0], self._position, offset, size)
+            nearest = seed  # distance from each member to its nearest landmark
+            landmarks, rows = [], []
+            for _ in range(min(landmarks_per_island, size)):
+                farthest = max(range(size), key=nearest.__getitem__)
+                if landmarks and nearest[farthest] == 0:
+                    break  # every member already is a landmark
+                landmark = island[farthest]
+                row = _bfs_distances(graph, landmark, self._position, offset, size)
+                landmarks.append(landmark)
+                rows.append(row)
+                nearest = row if len(rows) == 1 else array(row.typecode, map(min, nearest, row))
+
+            self._offsets.append(offset)
+            self._landmarks.append(landmarks)
+            self._distances.append(rows)
+
+        self.build_seconds = time.perf_counter() - start_time
+
+    def _locate(self, node):
+        """(island index, position within the island) of node, or None if its island is not indexed."""
+        position = self._position.get(node)
+        if position is None:
+            return None
+        island = bisect_right(self._offsets, position) - 1
+        return island, position - self._offsets[island]
+
+    def covers(self, node):
+        return node in self._position
+
+    def distance_bounds(self, node_a, node_b):
+        """
+        (lower, upper) bounds of the distance between two nodes of the same
+        indexed island, or None if they are not both in one.
+        """
+        located_a, located_b = self._locate(node_a), self._locate(node_b)
+        if located_a is None or located_b is None or located_a[0] != located_b[0]:
+            return None
+
+        (island, index_a), (_, index_b) = located_a, located_b
+        lower, upper = 0, None
+        for row in self._distances[island]:
+            distance_a, distance_b = row[index_a], row[index_b]
+            lower = max(lower, abs(distance_a - distance_b))
+            upper = distance_a + distance_b if upper is None else min(upper, distance_a + distance_b)
+        return lower, upper
+
+    def find_path(self, graph, start, end):
+        """
+        Shortest path from start to end (storage keys, same indexed island)
+        with A* search, using the landmark lower bound to end as heuristic.
+        Returns the list of nodes, or None if end cannot be reached.
+        """
+        located = self._locate(end)
+        if located is None or start not in self._position:
+            return None
+
+        island, end_index = located
+        offset = self._offsets[island]
+        rows = self._distances[island]
+        targets = [row[end_index] for row in rows]
+        position = self._position
+
+        def estimate(node):
+            index = position[node] - offset
+            return max(abs(row[index] - target) for row, target in zip(rows, targets))
+
+        parents = {start: None}
+        depths = {start: 0}
+        # (depth + estimate, -depth, node): among equal estimates the deepest
+        # node first, as it is the closest to the target
+        heap = [(estimate(start), 0, start)]
+        while heap:
+            _, negative_depth, node = heapq.heappop(heap)
+            if node == end:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                return path[::-1]
+
+            depth = -negative_depth
+            if depth > depths[node]:
+                continue  # Superseded by a shorter way to node
+
+            depth += 1
+            for neighbor in graph.neighbors(node):
+                if depth < depths.get(neighbor, depth + 1):
+                    depths[neighbor] = depth
+                    parents[neighbor] = node
+                    heapq.heappush(heap, (depth + estimate(neighbor), -depth, neighbor))
+
+        return None
+
+    def memory_bytes(self):
+        """Approximate memory used by the index: distance arrays plus the position map."""
+        rows = sum(sys.getsizeof(row) for island_rows in self._distances for row in island_rows)
+        return rows + sys.getsizeof(self._position) + 28 * len(self._position)
+
+    def stats(self):
+        return {
+            'islands': len(self._landmarks),
+            'landmarks': sum(map(len, self._landmarks)),
+            'covered_nodes': len(self._position),
+            'memory_bytes': self.memory_bytes(),
+            'build_seconds': self.build_seconds,
+        }
@@ -0,0 +1,210 @@
+import json
+import platform
+import random
+import statistics
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from categories.graph_service import CategoryGraphService, reset_graph_service
+from categories.sql_graph import SQLGraphService
+from categories.synthetic import island_ranges, populate
+
+STORAGES = ('dict', 'csr', 'sql')
+
+class Command(BaseCommand):
+    help = 'Benchmark the similarity graph on synthetic data in a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, help='Number of categories', default=10000)
+        parser.add_argument('--roots', type=int, help='Number of root categories', default=100)
+        parser.add_argument('--islands', type=int, help='Number of islands', default=20)
+        parser.add_argument('--degree', type=float, help='Average similarities per category', default=10)
+        parser.add_argument('--seed', type=int, help='Random seed', default=42)
+        parser.add_argument('--queries', type=int, help='Shortest path queries per storage', default=200)
+        parser.add_argument('--requests', type=int, help='Requests per HTTP endpoint', default=20)
+        parser.add_argument('--storage', type=str, help='Storages to benchmark', choices=STORAGES, nargs='+', default=['dict', 'csr'])
+        parser.add_argument('--exact', action='store_true', help='Also time the exact diameter')
+        parser.add_argument('--landmarks', type=int, help='Landmarks per island for the in-memory storages, 0 for none', default=0)
+        parser.add_argument('--landmark-min-island', type=int, help='Smallest island given landmarks', default=100)
+        parser.add_argument('--batch-size', type=int, help='Rows per INSERT while loading', default=1000)
+        parser.add_argument('--output', type=str, help='Write the JSON results to this file, stdout by default')
+        parser.add_argument('--baseline', type=str, help='JSON results of an earlier run to compare against')
+        parser.add_argument('--tolerance', type=float, help='Allowed slowdown against the baseline, 0.2 = 20%%', default=0.2)
+        parser.add_argument('--fail-on-regression', action='store_true', help='Exit with an error if anything regressed')
+
+    def handle(self, *args, **options):
+        reset_graph_service()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = self.run_benchmarks(options)
+        finally:
+            reset_graph_service()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'parameters': {
+                key: options[key]
+                for key in ('nodes', 'roots', 'islands', 'degree', 'seed', 'queries', 'requests', 'storage', 'exact', 'landmarks')
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'results': results,
+        }
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output_file:
+                output_file.write(output + '\n')
+            self.stderr.write(f'Results written to {options["output"]}')
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as baseline_file:
+                baseline = json.load(baseline_file)
+            regressions = self.compare(baseline.get('results', {}), results, options['tolerance'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} benchmark(s) regressed: {", ".join(regressions)}')
+
+    def run_benchmarks(self, options):
+        results = {}
+        rng = random.Random(options['seed'])
+
+        start = time.perf_counter()
+        categories, similarities = populate(
+            options['nodes'], options['roots'], options['islands'], options['degree'],
+            seed=options['seed'], batch_size=options['batch_size'],
+        )
+        results['load'] = {'seconds': time.perf_counter() - start, 'categories': categories, 'similarities': similarities}
+        self.stderr.write(f'Loaded {categories} categories and {similarities} similarities')
+
+        # Both ends on the same island, so every query has a path to find
+        islands = [bounds for bounds in island_ranges(options['nodes'], options['islands']) if bounds[1] - bounds[0] > 1]
+        pairs = [tuple(rng.sample(range(*rng.choice(islands)), 2)) for _ in range(options['queries'])]
+
+        for storage in options['storage']:
+            self.stderr.write(f'Benchmarking {storage}...')
+            start = time.perf_counter()
+            if storage == 'sql':
+                service = SQLGraphService()
+            else:
+                service = CategoryGraphService(storage=storage, landmarks=options['landmarks'])
+                service.landmark_min_island = options['landmark_min_island']
+            results[f'{storage}.build'] = {'seconds': time.perf_counter() - start, **service.stats()}
+
+            if storage != 'sql' and options['landmarks']:
+                start = time.perf_counter()
+                landmarks = service.build_landmarks()
+                results[f'{storage}.landmarks'] = {'seconds': time.perf_counter() - start, **(landmarks or {})}
+                results[f'{storage}.distance_bounds'] = self.time_calls(service.distance_bounds, pairs)
+                service.landmark_search = True
+                results[f'{storage}.shortest_path_landmarks'] = self.time_calls(service.find_shortest_path, pairs)
+                service.landmark_search = False
+
+            results[f'{storage}.shortest_path'] = self.time_calls(
+                service.find_shortest_path, pairs
+            )
+            results[f'{storage}.islands'] = self.time_calls(service.get_rabbit_islands, [()])
+            results[f'{storage}.longest_rabbit_hole'] = self.time_calls(service.find_longest_rabbit_hole, [()])
+            if options['exact']:
+                results[f'{storage}.longest_rabbit_hole_exact'] = self.time_calls(
+                    lambda: service.find_longest_rabbit_hole(exact=True), [()]
+                )
+
+        self.stderr.write('Benchmarking HTTP endpoints...')
+        results.update(self.time_endpoints(pairs[:options['requests']], options['requests'], options['storage'][0]))
+        return results
+
+    @staticmethod
+    def time_calls(func, calls):
+        """Timings (milliseconds) of func(*args) for every args in calls."""
+        durations = []
+        for args in calls:
+            start = time.perf_counter()
+            func(*args)
+            durations.append((time.perf_counter() - start) * 1000)
+        return summarize(durations)
+
+    def time_endpoints(self, pairs, count, storage):
+        client = Client()
+        # (url, JSON body) per request; requests with a body are POSTed
+        endpoints = {
+            'http.getRabbitHole': [(f'/categories/getRabbitHole/{a}/{b}/', None) for a, b in pairs],
+            'http.agetRabbitHole': [(f'/categories/async/getRabbitHole/{a}/{b}/', None) for a, b in pairs],
+            'http.getRabbitHoles': [('/categories/getRabbitHoles/', {'pairs': pairs})] * count,
+            'http.getNeighborhood': [(f'/categories/getNeighborhood/{a}/?k=2', None) for a, _ in pairs],
+            'http.getBreadcrumbs': [(f'/categories/getBreadcrumbs/{b}/', None) for _, b in pairs],
+            'http.search': [(f'/categories/search/?q=Synthetic+Category+{a}', None) for a, _ in pairs],
+            'http.getRabbitIslands': [('/categories/getRabbitIslands/', None)] * count,
+            'http.getRabbitIslandsJson': [('/categories/getRabbitIslandsJson/', None)] * count,
+            'http.getLongestRabbitHole': [('/categories/getLongestRabbitHole/', None)] * count,
+            'http.index': [('/categories/', None)] * count,
+        }
+
+        def fetch(url, body):
+            if body is None:
+                response = client.get(url)
+            else:
+                response = client.post(url, json.dumps(body), content_type='application/json')
+            if response.status_code != 200:
+                raise CommandError(f'{url} returned {response.status_code}')
+            if response.streaming:
+                b''.join(response.streaming_content)
+
+        setup_test_environment()
+        try:
+            # Without the debug toolbar and query logging of DEBUG, and
+            # without the response cache: every request renders its body
+            with override_settings(
+                DEBUG=False, CATEGORY_GRAPH_STORAGE=storage, CATEGORY_GRAPH_SQL_THRESHOLD=None,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+            ):
+                reset_graph_service()
+                fetch(*endpoints['http.getRabbitHole'][0]) # Builds the graph
+
+                results = {}
+                for name, requests in endpoints.items():
+                    results[name] = self.time_calls(fetch, requests)
+        finally:
+            teardown_test_environment()
+        return results
+
+    def compare(self, baseline, results, tolerance):
+        """Prints the change of every timing against the baseline; returns the regressed names."""
+        regressions = []
+        for name in sorted(results):
+            metric = next((metric for metric in ('p50_ms', 'seconds') if metric in results[name]), None)
+            if metric is None:
+                continue # Nothing timed
+            before = baseline.get(name, {}).get(metric)
+            after = results[name][metric]
+            if not before:
+                self.stderr.write(f'{name:40} {after:12.3f} (no baseline)')
+                continue
+
+            change = after / before - 1
+            flag = ''
+            if change > tolerance:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            self.stderr.write(f'{name:40} {before:12.3f} -> {after:12.3f} {metric:8} {change:+8.1%}{flag}')
+        return regressions
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'mean_ms': statistics.fmean(durations),
+        'p50_ms': durations[len(durations) // 2],
+        'p95_ms': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'max_ms': durations[-1],
+    }
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from categories.graph_snapshot import build_snapshot, load_snapshot, snapshot_path
+
+
+class Command(BaseCommand):
+    help = 'Write the similarity graph to a binary snapshot that workers can mmap'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, help='Output file, CATEGORY_GRAPH_SNAPSHOT_PATH by default')
+
+    def handle(self, *args, **options):
+        path = options['path'] or snapshot_path()
+
+        started = time.perf_counter()
+        path, version = build_snapshot(path)
+        elapsed = time.perf_counter() - started
+
+        graph, _ = load_snapshot(path)
+        self.stdout.write(
+            f'Wrote {path}: {len(graph)} categories, {graph.edge_count()} similarities, '
+            f'{graph.memory_bytes()} bytes, version {version}, in {elapsed:.2f}s'
+        )
@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from categories.models import Category
+from categories.tree_io import read_rows, write_rows
+
+MODE_IMPORT = 'import'
+MODE_EXPORT = 'export'
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+
+class Command(BaseCommand):
+    help = 'Stream a category hierarchy in or out as JSONL or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', type=str, help='Mode', choices=[MODE_IMPORT, MODE_EXPORT], required=True)
+        parser.add_argument('--format', type=str, help='File format', choices=[FORMAT_JSONL, FORMAT_CSV], default=FORMAT_JSONL)
+        parser.add_argument('--file', type=str, help='File to read or write, stdin/stdout by default')
+        parser.add_argument('--batch-size', type=int, help='Rows per INSERT / fetch', default=1000)
+
+    def handle(self, *args, **options):
+        mode = options['mode']
+        file_format = options['format']
+        path = options['file']
+
+        if mode == MODE_IMPORT:
+            stream = open(path, newline='', encoding='utf-8') if path else sys.stdin
+            try:
+                imported = Category.objects.bulk_import(
+                    read_rows(stream, file_format),
+                    batch_size=options['batch_size'],
+                )
+            finally:
+                if path:
+                    stream.close()
+            self.stderr.write(f'Imported {imported} categories')
+        elif mode == MODE_EXPORT:
+            stream = open(path, 'w', newline='', encoding='utf-8') if path else self.stdout
+            try:
+                exported = write_rows(
+                    Category.objects.all().export_rows(chunk_size=options['batch_size']),
+                    stream,
+                    file_format,
+                )
+            finally:
+                if path:
+                    stream.close()
+            self.stderr.write(f'Exported {exported} categories')
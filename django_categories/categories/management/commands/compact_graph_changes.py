@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from categories.models import GraphChange
+
+
+class Command(BaseCommand):
+    help = 'Delete old entries of the similarity graph change log; run it periodically, e.g. from cron'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, help='Age in seconds, CATEGORY_GRAPH_CHANGE_RETENTION by default')
+
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        if older_than is None:
+            older_than = getattr(settings, 'CATEGORY_GRAPH_CHANGE_RETENTION', 86400)
+
+        deleted = GraphChange.compact(timezone.now() - timedelta(seconds=older_than))
+        self.stdout.write(f'Deleted {deleted} graph changes older than {older_than}s')
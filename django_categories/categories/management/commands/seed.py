@@ -1,6 +1,10 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 import random
-from categories.models import Category, CategorySimilarity
+from categories.graph_service import reset_graph_service
+from categories.tree_index import reset_tree_index
+from categories.models import Category, CategorySimilarity, GraphChange, GraphVersion
+from categories.synthetic import populate
 
 MODE_REFRESH = 'refresh'
 MODE_CLEAR = 'clear'
@@ -10,26 +14,73 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--mode', type=str, help='Mode', choices=[MODE_REFRESH, MODE_CLEAR])
+        parser.add_argument('--nodes', type=int, help='Number of categories', default=2000)
+        parser.add_argument('--roots', type=int, help='Number of root categories', default=100)
+        parser.add_argument('--edges', type=int, help='Number of similarities to generate (duplicates are dropped)', default=200000)
+        parser.add_argument('--islands', type=int, help='Number of islands', default=20)
+        parser.add_argument('--depth-bias', type=float, help='Above 1 builds deeper trees, below 1 flatter ones', default=1.0)
+        parser.add_argument('--max-depth', type=int, help='Maximum category depth')
+        parser.add_argument('--seed', type=int, help='Random seed, random by default')
+        parser.add_argument('--batch-size', type=int, help='Rows per INSERT', default=1000)
+        parser.add_argument('--workers', type=int, help='Processes generating similarities', default=1)
 
     def handle(self, *args, **options):
         mode = options['mode']
         if mode == MODE_REFRESH:
             self.stdout.write('Seeding categories...')
-            self.refresh_categories()
+            self.refresh_categories(options)
         elif mode == MODE_CLEAR:
             self.stdout.write('Clearing categories...')
             self.clear_categories()
 
         self.stdout.write('Done')
 
-    def refresh_categories(self):
+    def refresh_categories(self, options):
+        if options['nodes'] < 1 or options['depth_bias'] <= 0:
+            raise CommandError('--nodes must be at least 1 and --depth-bias positive')
+        if options['max_depth'] is not None and options['max_depth'] < 1:
+            raise CommandError('--max-depth must be at least 1')
+
         self.clear_categories()
-        self.create_categories()
+        self.create_categories(options)
 
     def clear_categories(self):
-        Category.objects.all().delete()
+        # Plain DELETEs: Model.delete() would load every row to send the
+        # per-row signals, and everything goes anyway
+        with transaction.atomic():
+            CategorySimilarity.objects.all()._raw_delete(CategorySimilarity.objects.db)
+            Category.objects.all()._raw_delete(Category.objects.db)
+            GraphVersion.bump(tree=True)
+            GraphChange.log(GraphChange.RESET)
+            transaction.on_commit(reset_graph_service)
+            transaction.on_commit(reset_tree_index)
+
+    def create_categories(self, options):
+        seed = options['seed']
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        self.stdout.write(f'Using seed {seed}')
+
+        # The examples keep ids 1 to 6, the generated categories follow
+        self.create_examples()
+
+        num_categories = options['nodes']
+        _, created = populate(
+            num_categories,
+            options['roots'],
+            options['islands'],
+            2 * options['edges'] / num_categories,
+            seed=seed,
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            depth_bias=options['depth_bias'],
+            max_depth=options['max_depth'],
+            first_id=Category.objects.order_by('-id').values_list('id', flat=True).first() + 1,
+            log=self.stdout.write,
+        )
+        self.stdout.write(f'Intended similarities: {options["edges"]}. Actual unique similarities created: {created} across {options["islands"]} islands.')
 
-    def create_categories(self, num_categories=2000, num_roots=100):
+    def create_examples(self):
         # examples from task desc
         cat_a = Category.objects.create(
             name='A',
@@ -69,73 +120,3 @@ class Command(BaseCommand):
         cat_b.mark_similar_to(cat_d)
 
         cat_e.mark_similar_to(cat_f)
-
-        root_categories = []
-        for i in range(1, num_roots + 1):
-            root_categories.append(Category(
-                name=f'Seeded Category {i}',
-                description=f'Description for Seeded Category {i}',
-                image=f'/image/path/to/category/{i}.png',
-                parent=None,
-                depth=0,
-            ))
-        Category.objects.bulk_create(root_categories)
-
-        all_categories = list(Category.objects.filter(id__gt=6))
-        for i in range(num_roots + 1, num_categories + 1):
-            parent = None
-            if i > num_roots:
-                parent = random.choice(all_categories)
-
-            new_cat = Category.objects.create(
-                name=f'Seeded Category {i}',
-                description=f'Description for Seeded Category {i}',
-                image=f'/image/path/to/category/{i}.png',
-                parent=parent,
-            )
-            all_categories.append(new_cat)
-
-        all_categories = root_categories + all_categories
-        self.create_similarities(all_categories)
-
-    def create_similarities(self, all_categories, num_groups=20, total_similarities=200000):
-        self.stdout.write('Creating similarities...')
-        category_map = {cat.id: cat for cat in all_categories}
-        all_ids = sorted(category_map.keys())
-
-        categories_per_group = len(all_ids) // num_groups
-
-        similarity_records = set()
-        for _ in range(total_similarities):
-            # Choose a random group (island) index
-            group_index = random.randrange(num_groups)
-
-            # Determine the ID range for this group
-            start_index = group_index * categories_per_group
-            # Ensure the last group gets any remainder
-            end_index = start_index + categories_per_group
-            if group_index == num_groups - 1:
-                end_index = len(all_ids)
-
-            # Slice the IDs belonging to this group
-            group_ids = all_ids[start_index:end_index]
-
-            if len(group_ids) < 2:
-                continue # Skip if the group is too small
-
-            # Choose two distinct categories from WITHIN the selected group
-            pk_a, pk_b = random.sample(group_ids, 2)
-
-            # Enforce lower ID first
-            if pk_a > pk_b:
-                pk_a, pk_b = pk_b, pk_a
-
-            similarity_records.add((pk_a, pk_b))
-
-        unique_similarity_records = [
-            CategorySimilarity(category_a_id=a, category_b_id=b)
-            for a, b in similarity_records
-        ]
-
-        CategorySimilarity.objects.bulk_create(unique_similarity_records, ignore_conflicts=True)
-        self.stdout.write(f'Intended similarities: {total_similarities}. Actual unique similarities created: {len(unique_similarity_records)} across {num_groups} islands.')
@@ -0,0 +1,53 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from categories.models import CategorySimilarity
+from categories.similarity_io import read_pairs, write_pairs
+
+MODE_MARK = 'mark'
+MODE_UNMARK = 'unmark'
+MODE_EXPORT = 'export'
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+
+class Command(BaseCommand):
+    help = 'Stream similarity edges in (mark / unmark) or out as JSONL or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', type=str, help='Mode', choices=[MODE_MARK, MODE_UNMARK, MODE_EXPORT], required=True)
+        parser.add_argument('--format', type=str, help='File format', choices=[FORMAT_JSONL, FORMAT_CSV], default=FORMAT_JSONL)
+        parser.add_argument('--file', type=str, help='File to read or write, stdin/stdout by default')
+        parser.add_argument('--chunk-size', type=int, help='Pairs per INSERT / DELETE / fetch', default=1000)
+
+    def handle(self, *args, **options):
+        mode = options['mode']
+        file_format = options['format']
+        path = options['file']
+        chunk_size = options['chunk_size']
+
+        if mode in (MODE_MARK, MODE_UNMARK):
+            stream = open(path, newline='', encoding='utf-8') if path else sys.stdin
+            try:
+                pairs = read_pairs(stream, file_format)
+                if mode == MODE_MARK:
+                    count = CategorySimilarity.objects.mark_similar_many(pairs, chunk_size=chunk_size)
+                else:
+                    count = CategorySimilarity.objects.unmark_similar_many(pairs, chunk_size=chunk_size)
+            finally:
+                if path:
+                    stream.close()
+            self.stderr.write(f'{"Created" if mode == MODE_MARK else "Deleted"} {count} similarities')
+        elif mode == MODE_EXPORT:
+            stream = open(path, 'w', newline='', encoding='utf-8') if path else self.stdout
+            try:
+                exported = write_pairs(
+                    CategorySimilarity.objects.export_pairs(chunk_size=chunk_size),
+                    stream,
+                    file_format,
+                )
+            finally:
+                if path:
+                    stream.close()
+            self.stderr.write(f'Exported {exported} similarities')
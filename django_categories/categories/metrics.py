@@ -0,0 +1,230 @@
+"""
+Lightweight request and graph instrumentation.
+
+timed(phase) measures a block of code (graph build, traversal, name
+hydration, template rendering...). Each measurement feeds a per-process
+histogram and, during a request, the request's own timings. The
+ServerTimingMiddleware reports those timings, the total time and the SQL
+time and query count in a Server-Timing response header, which browsers
+show in their network panel. It runs natively under both WSGI and ASGI, and
+queries count wherever they run: the counter follows the request context
+into sync_to_async and graph executor threads, as timings do.
+render_metrics() renders the histograms and the size of the cached graph in
+the Prometheus text format for /metrics.
+
+Hot-path cost is a couple of perf_counter() calls, a bisect and a lock per
+measurement. Metrics are kept per process, as with any Prometheus client
+without a shared store: scrape each worker, or sum them up downstream.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# {phase: [milliseconds, calls]} of the current request, None outside requests
+_request_timings = ContextVar('category_request_timings', default=None)
+
+# _QueryCounter of the current request, None outside requests
+_request_queries = ContextVar('category_request_queries', default=None)
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_name, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.buckets = buckets
+        self._series = {}  # label value -> [per-bucket counts..., +Inf count], sum, count
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = [(label, list(counts), total, count) for label, (counts, total, count) in self._series.items()]
+
+        for label_value, counts, total, count in sorted(snapshot):
+            label = f'{self.label_name}="{_label(label_value)}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'category_request_duration_seconds', 'Time spent handling requests, by view.', 'view', DURATION_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    'category_request_queries', 'SQL queries executed per request, by view.', 'view', QUERY_COUNT_BUCKETS,
+)
+PHASE_DURATION = Histogram(
+    'category_phase_duration_seconds', 'Time spent in instrumented phases.', 'phase', DURATION_BUCKETS,
+)
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PHASE_DURATION.observe(phase, elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            entry = timings.setdefault(phase, [0.0, 0])
+            entry[0] += elapsed * 1000
+            entry[1] += 1
+
+
+class _QueryCounter:
+    """Sums the SQL time and query count of a request."""
+
+    def __init__(self):
+        self.count = 0
+        self.milliseconds = 0.0
+
+
+def _count_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every connection, of every thread: counts
+    the query against the request found in the current context, if any.
+    """
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.milliseconds += (time.perf_counter() - start) * 1000
+        queries.count += 1
+
+
+def install_query_counter(db_connection):
+    if _count_query not in db_connection.execute_wrappers:
+        db_connection.execute_wrappers.append(_count_query)
+
+
+@receiver(connection_created)
+def _connection_created(sender, connection, **kwargs):
+    # Connections are per thread: the executor and sync_to_async threads
+    # open theirs after this module is loaded
+    install_query_counter(connection)
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header to every response and records the request metrics."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        # This thread's connection may predate the connection_created hook
+        install_query_counter(connection)
+        timings, queries = {}, _QueryCounter()
+        tokens = _request_timings.set(timings), _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_timings.reset(tokens[0])
+            _request_queries.reset(tokens[1])
+        return self._record(request, response, timings, queries, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        timings, queries = {}, _QueryCounter()
+        tokens = _request_timings.set(timings), _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_timings.reset(tokens[0])
+            _request_queries.reset(tokens[1])
+        return self._record(request, response, timings, queries, time.perf_counter() - start)
+
+    def _record(self, request, response, timings, queries, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        REQUEST_DURATION.observe(view, elapsed)
+        REQUEST_QUERIES.observe(view, queries.count)
+
+        entries = [f'{phase};dur={milliseconds:.2f};desc="{calls}x"' for phase, (milliseconds, calls) in timings.items()]
+        entries.append(f'db;dur={queries.milliseconds:.2f};desc="{queries.count} queries"')
+        entries.append(f'total;dur={elapsed * 1000:.2f}')
+        response['Server-Timing'] = ', '.join(entries)
+        return response
+
+
+def _graph_lines():
+    from .graph_service import get_cached_graph_service
+
+    graph_service = get_cached_graph_service()
+    if getattr(graph_service, 'graph', None) is None:
+        return [] # Not built yet, or the SQL engine
+
+    # Read under the service lock, so a concurrent patch is never half seen
+    stats = graph_service.stats(rebuild=False)
+    gauges = [
+        ('category_graph_nodes', 'Categories in the cached similarity graph.', stats['nodes']),
+        ('category_graph_edges', 'Similarities in the cached similarity graph.', stats['edges']),
+        ('category_graph_memory_bytes', 'Approximate memory used by the cached graph.', stats['memory_bytes']),
+        ('category_graph_version', 'Rebuilds and patches applied to the cached graph.', stats['version']),
+    ]
+    landmarks = stats['landmarks']
+    if landmarks is not None:
+        gauges += [
+            ('category_graph_landmarks', 'Landmarks of the current distance oracle.', landmarks['landmarks']),
+            ('category_graph_landmark_memory_bytes', 'Approximate memory used by the landmark distances.', landmarks['memory_bytes']),
+            ('category_graph_landmark_build_seconds', 'Time taken to build the landmark distances.', landmarks['build_seconds']),
+        ]
+
+    storage = _label(stats['storage'])
+    lines = []
+    for name, help_text, value in gauges:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name}{{storage="{storage}"}} {value}']
+    return lines
+
+
+def render_metrics():
+    lines = []
+    for histogram in (REQUEST_DURATION, REQUEST_QUERIES, PHASE_DURATION):
+        lines += histogram.render()
+    lines += _graph_lines()
+    return '\n'.join(lines) + '\n'
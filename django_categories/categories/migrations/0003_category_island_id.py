@@ -0,0 +1,45 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:20
+
+from django.db import migrations, models
+
+
+def label_islands(apps, schema_editor):
+    Category = apps.get_model('categories', 'Category')
+    CategorySimilarity = apps.get_model('categories', 'CategorySimilarity')
+
+    parent = {cat_id: cat_id for cat_id in Category.objects.values_list('id', flat=True)}
+
+    def find(cat_id):
+        while parent[cat_id] != cat_id:
+            parent[cat_id] = parent[parent[cat_id]]
+            cat_id = parent[cat_id]
+        return cat_id
+
+    for id_a, id_b in CategorySimilarity.objects.values_list('category_a_id', 'category_b_id').iterator():
+        root_a, root_b = find(id_a), find(id_b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    members = {}
+    for cat_id in parent:
+        members.setdefault(find(cat_id), []).append(cat_id)
+
+    for label, ids in members.items():
+        for start in range(0, len(ids), 500):
+            Category.objects.filter(id__in=ids[start:start + 500]).update(island_id=label)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0002_categorysimilarity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='island_id',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(label_islands, migrations.RunPython.noop),
+    ]
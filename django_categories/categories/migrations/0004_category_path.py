@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:23
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    Category = apps.get_model('categories', 'Category')
+
+    children = defaultdict(list)
+    for cat_id, parent_id in Category.objects.values_list('id', 'parent_id'):
+        children[parent_id].append(cat_id)
+
+    batch = []
+    stack = [(root_id, '', 0) for root_id in children[None]]
+    while stack:
+        cat_id, parent_path, depth = stack.pop()
+        path = f'{parent_path}{cat_id}/'
+        batch.append(Category(id=cat_id, path=path, depth=depth))
+        stack.extend((child_id, path, depth + 1) for child_id in children[cat_id])
+
+        if len(batch) >= 500:
+            Category.objects.bulk_update(batch, ['path', 'depth'])
+            batch = []
+
+    Category.objects.bulk_update(batch, ['path', 'depth'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0003_category_island_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
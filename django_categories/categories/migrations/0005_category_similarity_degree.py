@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:26
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_degrees(apps, schema_editor):
+    Category = apps.get_model('categories', 'Category')
+    CategorySimilarity = apps.get_model('categories', 'CategorySimilarity')
+
+    def count_for(field):
+        return Coalesce(models.Subquery(
+            CategorySimilarity.objects.filter(**{field: models.OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(count=models.Count('id'))
+            .values('count')
+        ), 0)
+
+    Category.objects.update(similarity_degree=count_for('category_a') + count_for('category_b'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0004_category_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='similarity_degree',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_degrees, migrations.RunPython.noop),
+    ]
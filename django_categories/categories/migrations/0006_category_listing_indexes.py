@@ -0,0 +1,21 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0005_category_similarity_degree'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['depth', 'id'], name='categories__depth_a87923_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['parent', 'id'], name='categories__parent__5667e4_idx'),
+        ),
+    ]
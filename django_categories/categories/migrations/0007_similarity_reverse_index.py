@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0006_category_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='categorysimilarity',
+            index=models.Index(fields=['category_b', 'category_a'], name='categories__categor_4653dc_idx'),
+        ),
+    ]
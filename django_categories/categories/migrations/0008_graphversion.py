@@ -0,0 +1,21 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0007_similarity_reverse_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
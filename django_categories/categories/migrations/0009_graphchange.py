@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-17 23:53
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0008_graphversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('add_node', 'add_node'), ('remove_node', 'remove_node'), ('add_edge', 'add_edge'), ('remove_edge', 'remove_edge'), ('reset', 'reset')], max_length=16)),
+                ('category_a_id', models.BigIntegerField(blank=True, null=True)),
+                ('category_b_id', models.BigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
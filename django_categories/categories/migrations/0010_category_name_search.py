@@ -0,0 +1,84 @@
+from django.db import migrations
+
+# External content FTS5 table: it only stores the index, the names are read
+# from categories_category. The prefix indexes serve autocomplete queries of
+# 2 and 3 characters without scanning the term list.
+#
+# SQLite drops these triggers whenever a later migration rebuilds
+# categories_category (most AlterField / RemoveField operations do):
+# search.ensure_search_triggers() recreates them after every migrate.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE categories_category_fts USING fts5(
+        name,
+        content='categories_category',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    # Triggers keep the index in sync with every write, bulk and raw ones included
+    """
+    CREATE TRIGGER categories_category_fts_insert AFTER INSERT ON categories_category BEGIN
+        INSERT INTO categories_category_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER categories_category_fts_delete AFTER DELETE ON categories_category BEGIN
+        INSERT INTO categories_category_fts(categories_category_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER categories_category_fts_update AFTER UPDATE OF name ON categories_category BEGIN
+        INSERT INTO categories_category_fts(categories_category_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO categories_category_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    "INSERT INTO categories_category_fts(categories_category_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS categories_category_fts_update',
+    'DROP TRIGGER IF EXISTS categories_category_fts_delete',
+    'DROP TRIGGER IF EXISTS categories_category_fts_insert',
+    'DROP TABLE IF EXISTS categories_category_fts',
+]
+
+POSTGRESQL_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS categories_category_name_trgm ON categories_category USING gin (name gin_trgm_ops)',
+]
+POSTGRESQL_BACKWARD = [
+    'DROP INDEX IF EXISTS categories_category_name_trgm',
+]
+
+
+class VendorRunSQL(migrations.RunSQL):
+    """RunSQL applied on one database vendor only, a no-op on the others."""
+
+    def __init__(self, vendor, sql, reverse_sql, **kwargs):
+        super().__init__(sql, reverse_sql, **kwargs)
+        self.vendor = vendor
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        return name, args, {'vendor': self.vendor, **kwargs}
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0009_graphchange'),
+    ]
+
+    operations = [
+        VendorRunSQL('sqlite', SQLITE_FORWARD, SQLITE_BACKWARD),
+        VendorRunSQL('postgresql', POSTGRESQL_FORWARD, POSTGRESQL_BACKWARD),
+    ]
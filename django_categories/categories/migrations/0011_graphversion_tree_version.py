@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 00:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0010_category_name_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='graphversion',
+            name='tree_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('categories', '0011_graphversion_tree_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='path',
+            field=models.TextField(db_index=True, default='', editable=False),
+        ),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Concat, Substr
+from django.utils import timezone
 
 # Create your models here.
 class TimestampedModel(models.Model):
@@ -8,25 +10,143 @@ class TimestampedModel(models.Model):
     class Meta:
         abstract = True
 
+class CategoryQuerySet(models.QuerySet):
+    def with_similar(self):
+        """Prefetches Category.similar_categories for every fetched category, one joined query per side."""
+        return self.prefetch_related(*similar_prefetches())
+
+    def with_child_count(self):
+        """Annotates child_count with a correlated COUNT on the (parent, id) index."""
+        return self.annotate(child_count=Coalesce(models.Subquery(
+            Category.objects.filter(parent_id=models.OuterRef('pk'))
+            .order_by()
+            .values('parent_id')
+            .annotate(count=models.Count('id'))
+            .values('count')
+        ), 0))
+
+    def refresh_similarity_degrees(self):
+        """Recomputes the denormalized similarity_degree with one set-based UPDATE."""
+        def count_for(field):
+            return Coalesce(models.Subquery(
+                CategorySimilarity.objects.filter(**{field: models.OuterRef('pk')})
+                .order_by()
+                .values(field)
+                .annotate(count=models.Count('id'))
+                .values('count')
+            ), 0)
+
+        return self.update(similarity_degree=count_for('category_a') + count_for('category_b'))
+
+    def subtree(self, path):
+        """
+        The category at path and all of its descendants, as an indexed range
+        scan: every path below "1/5/" sorts between "1/5/" and "1/50",
+        because '/' is the character right before '0'.
+        """
+        return self.filter(path__gte=path, path__lt=path[:-1] + '0')
+
+    def bulk_import(self, rows, batch_size=1000):
+        """
+        Inserts a hierarchy from an iterable of row dicts (see tree_io.py)
+        with batched bulk_create. Returns the number of categories created.
+        """
+        from .tree_io import import_tree
+        return import_tree(rows, batch_size=batch_size)
+
+    def export_rows(self, chunk_size=2000):
+        """Streams the categories as row dicts, parents before children."""
+        from .tree_io import export_tree
+        return export_tree(self, chunk_size=chunk_size)
+
+    def lock(self):
+        """
+        Locks the selected categories for the rest of the transaction, in id
+        order so concurrent writers can not deadlock. Returns their ids.
+        """
+        return set(self.select_for_update().order_by('id').values_list('id', flat=True))
+
+    def island_sizes(self):
+        """(island_id, size) for every island, largest first, in one GROUP BY."""
+        return (
+            self.values_list('island_id')
+            .annotate(size=models.Count('id'))
+            .order_by('-size', 'island_id')
+        )
+
+class CategorySimilarityQuerySet(models.QuerySet):
+    def mark_similar_many(self, pairs, chunk_size=1000):
+        """
+        Creates similarities for an iterable of (id_a, id_b) pairs in
+        fixed-size chunks (see similarity_io.py). Returns the number created.
+        """
+        from .similarity_io import mark_similar_many
+        return mark_similar_many(pairs, chunk_size=chunk_size)
+
+    def unmark_similar_many(self, pairs, chunk_size=1000):
+        """Deletes the similarities for an iterable of (id_a, id_b) pairs. Returns the number deleted."""
+        from .similarity_io import unmark_similar_many
+        return unmark_similar_many(pairs, chunk_size=chunk_size)
+
+    def export_pairs(self, chunk_size=2000):
+        """Streams the (category_a_id, category_b_id) pairs."""
+        return self.order_by('id').values_list('category_a_id', 'category_b_id').iterator(chunk_size=chunk_size)
+
 class Category(TimestampedModel):
+    # Searched through an index kept in sync by triggers on SQLite, which a
+    # migration rebuilding this table drops: see search.ensure_search_triggers()
     name = models.CharField(max_length=255, blank=False, null=False)
     description = models.TextField(blank=False, null=False)
     image = models.TextField(blank=False, null=False)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, related_name='children', null=True, blank=True)
     depth = models.PositiveIntegerField(default=0)
+    # Materialized path of ids from the root, e.g. "1/5/12/" for 12 under 5 under 1.
+    # Unbounded, as trees may be deep; on PostgreSQL db_index also adds a
+    # text_pattern_ops index for the prefix lookups.
+    path = models.TextField(default='', editable=False, db_index=True)
+    # Number of CategorySimilarity rows this category appears in
+    similarity_degree = models.PositiveIntegerField(default=0)
+    # Connected component in the similarity graph, see islands.py
+    island_id = models.BigIntegerField(null=True, blank=True, db_index=True)
+
+    objects = CategoryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pages of the listing views: WHERE depth = ? / parent_id = ? AND id > ?
+            models.Index(fields=['depth', 'id']),
+            models.Index(fields=['parent', 'id']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.id})'
 
     @property
     def similar(self):
-        similar_categories = CategorySimilarity.objects.filter(
-            models.Q(category_a=self) | models.Q(category_b=self)
-        )
+        """Similar categories, as a queryset that resolves the neighbor ids in a subquery."""
+        return Category.objects.filter(id__in=self.similar_ids())
 
-        similar_ids = [
-            similarity.category_a.id if similarity.category_a != self else similarity.category_b.id
-            for similarity in similar_categories
-        ]
+    @property
+    def similar_categories(self):
+        """
+        Similar categories, as a list ordered by id. Taken from the rows
+        prefetched by Category.objects.with_similar() or prefetch_similar()
+        when present, otherwise read from Category.similar.
+        """
+        if hasattr(self, 'similarities_a_prefetched') and hasattr(self, 'similarities_b_prefetched'):
+            neighbors = [similarity.category_b for similarity in self.similarities_a_prefetched]
+            neighbors += [similarity.category_a for similarity in self.similarities_b_prefetched]
+            return sorted(neighbors, key=lambda category: category.id)
 
-        return Category.objects.filter(id__in=similar_ids)
+        return list(self.similar.order_by('id'))
+
+    def similar_ids(self):
+        """Neighbor ids, read from the *_id columns only (no joins, no FK fetches)."""
+        return CategorySimilarity.objects.filter(category_a_id=self.id).values_list(
+            'category_b_id', flat=True
+        ).union(
+            CategorySimilarity.objects.filter(category_b_id=self.id).values_list('category_a_id', flat=True)
+        )
 
     def mark_similar_to(self, other_category):
         if self.id == other_category.id:
@@ -41,10 +161,17 @@ class Category(TimestampedModel):
             pk_a, pk_b = pk_b, pk_a
             cat_a, cat_b = cat_b, cat_a
 
-        similarity, created = CategorySimilarity.objects.get_or_create(
-            category_a=cat_a,
-            category_b=cat_b
-        )
+        with transaction.atomic():
+            # As in mark_similar_many, which could otherwise count the pair as created too
+            Category.objects.filter(id__in=(pk_a, pk_b)).lock()
+            similarity, created = CategorySimilarity.objects.get_or_create(
+                category_a=cat_a,
+                category_b=cat_b
+            )
+
+            if created:
+                from .islands import union_edges
+                union_edges([(pk_a, pk_b)])
 
         return similarity, created
 
@@ -58,50 +185,142 @@ class Category(TimestampedModel):
         if pk_a > pk_b:
             pk_a, pk_b = pk_b, pk_a
 
-        deleted_count, _ = CategorySimilarity.objects.filter(
-            category_a=pk_a,
-            category_b=pk_b
-        ).delete()
+        with transaction.atomic():
+            Category.objects.filter(id__in=(pk_a, pk_b)).lock()
+            deleted_count, _ = CategorySimilarity.objects.filter(
+                category_a=pk_a,
+                category_b=pk_b
+            ).delete()
+
+            if deleted_count > 0:
+                from .islands import split_island
+                split_island(Category.objects.values_list('island_id', flat=True).get(id=pk_a))
 
         return deleted_count > 0
 
+    def is_same_island(self, other_category):
+        """Whether the two categories are connected through similarities."""
+        return self.island_id is not None and self.island_id == other_category.island_id
+
     def save(self, *args, **kwargs):
         is_new = self.id is None
         old_parent_id = None
+        old_path = None
+        old_depth = None
 
-        if not is_new:
-            try:
-                old_parent_id = Category.objects.values_list('parent_id', flat=True).get(id=self.id)
-            except Category.DoesNotExist:
-                pass
+        with transaction.atomic():
+            if not is_new:
+                try:
+                    old_parent_id, old_path, old_depth = Category.objects.select_for_update().values_list(
+                        'parent_id', 'path', 'depth'
+                    ).get(id=self.id)
+                except Category.DoesNotExist:
+                    pass
 
-        if self.parent:
-            self.depth = self.parent.depth + 1
-        elif not self.parent:
-            self.depth = 0
+            parent_path = ''
+            if self.parent_id is not None:
+                if old_path and self.parent_id != old_parent_id:
+                    parent_path, parent_depth = self._lock_ancestry(self.parent_id)
+                else:
+                    parent_path, parent_depth = Category.objects.values_list('path', 'depth').get(id=self.parent_id)
+                if old_path and parent_path.startswith(old_path):
+                    raise ValueError("Cannot move a category under itself or one of its descendants")
+                self.depth = parent_depth + 1
+            else:
+                self.depth = 0
 
-        super().save(*args, **kwargs)
+            if not is_new:
+                self.path = f'{parent_path}{self.id}/'
+
+            super().save(*args, **kwargs)
 
-        parent_changed = (is_new and self.parent_id is not None) or (self.parent_id != old_parent_id)
+            if is_new:
+                # The path ends with our own id, which is only known now. A new
+                # category also starts out as an island of its own.
+                self.path = f'{parent_path}{self.id}/'
+                if self.island_id is None:
+                    self.island_id = self.id
+                Category.objects.filter(id=self.id).update(path=self.path, island_id=self.island_id)
 
-        if parent_changed and self.id is not None:
-            self.update_children_depth()
+            parent_changed = not is_new and bool(old_path) and self.parent_id != old_parent_id
 
-    def update_children_depth(self):
-        def recursive_update(parent_id, new_depth):
-            children = Category.objects.filter(parent_id=parent_id)
-            if children.exists():
-                children.update(depth=new_depth)
+            if parent_changed and old_path != self.path:
+                self.move_descendants(old_path, old_depth)
 
-                for child in children:
-                    recursive_update(child.id, new_depth + 1)
+            if parent_changed:
+                # New categories are counted by the post_save handler
+                GraphVersion.bump(tree=True)
+            if is_new or parent_changed:
+                # New and moved categories renumber the cached tree index
+                from .tree_index import reset_tree_index
+                transaction.on_commit(reset_tree_index)
 
-        recursive_update(self.id, self.depth + 1)
+    @staticmethod
+    def _lock_ancestry(parent_id):
+        """
+        Locks parent_id and its ancestors for the rest of the transaction, and
+        returns its (path, depth) as read under the lock. Moves lock the moved
+        category too, so no concurrent move can put the new parent under the
+        category being moved once the cycle check below has passed.
+        """
+        locked = set()
+        while True:
+            parent_path, parent_depth = Category.objects.values_list('path', 'depth').get(id=parent_id)
+            chain = {int(cat_id) for cat_id in parent_path.split('/')[:-1]}
+            if chain <= locked:
+                return parent_path, parent_depth
+            # In id order, so concurrent moves lock shared ancestors in the same order
+            list(Category.objects.select_for_update().filter(id__in=chain - locked).order_by('id').values_list('id'))
+            locked |= chain
+
+    def move_descendants(self, old_path, old_depth):
+        """
+        Rewrites the path and depth of the whole subtree below this category
+        in a single UPDATE, after the category itself moved from old_path.
+        """
+        return Category.objects.subtree(old_path).filter(path__gt=old_path).update(
+            path=Concat(models.Value(self.path), Substr('path', len(old_path) + 1)),
+            depth=models.F('depth') + (self.depth - old_depth),
+        )
+
+    @property
+    def ancestor_ids(self):
+        """Ids from the root down to the parent, read from the path."""
+        return [int(cat_id) for cat_id in self.path.split('/')[:-2]]
+
+    def ancestors(self):
+        return Category.objects.filter(id__in=self.ancestor_ids).order_by('depth')
+
+    def descendants(self):
+        return Category.objects.subtree(self.path).filter(path__gt=self.path)
+
+    def subtree_count(self):
+        """Number of descendants, excluding the category itself."""
+        return self.descendants().count()
+
+    def is_descendant_of(self, other_category):
+        """Whether this category is somewhere below other_category, from the cached tree index."""
+        from .tree_index import get_tree_index
+        return get_tree_index().is_ancestor(other_category.id, self.id)
+
+    def descendant_ids(self):
+        """Ids of every category below this one, in preorder, from the cached tree index."""
+        from .tree_index import get_tree_index
+        return get_tree_index().descendant_ids(self.id)
+
+    def breadcrumbs(self):
+        """The categories from the root down to this one, with a single query."""
+        from .tree_index import get_tree_index
+        ancestor_ids = get_tree_index().ancestor_ids(self.id)
+        ancestors = Category.objects.in_bulk(ancestor_ids)
+        return [ancestors[cat_id] for cat_id in ancestor_ids if cat_id in ancestors] + [self]
 
 class CategorySimilarity(TimestampedModel):
     category_a = models.ForeignKey('Category', on_delete=models.CASCADE, related_name='similarities_a')
     category_b = models.ForeignKey('Category', on_delete=models.CASCADE, related_name='similarities_b')
 
+    objects = CategorySimilarityQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         pk_a = self.category_a.id
         pk_b = self.category_b.id
@@ -115,5 +334,118 @@ class CategorySimilarity(TimestampedModel):
         unique_together = (('category_a', 'category_b'),)
 
         indexes = [
+            # Covering indexes for neighbor lookups from either side, as done
+            # by the recursive traversals in sql_graph.py
             models.Index(fields=['category_a', 'category_b']),
+            models.Index(fields=['category_b', 'category_a']),
         ]
+
+
+class GraphVersion(models.Model):
+    """
+    Single row counting writes to categories and similarities. Bumped in the
+    same transaction as every write, so it only ever grows and a reader that
+    sees a version also sees the data it stands for. Used for ETags, cache
+    keys and the graph snapshot. tree_version only counts the writes that
+    change the shape of the tree (new, deleted and moved categories), which
+    invalidate the tree index of every process (see tree_index.py).
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    tree_version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def bump(cls, tree=False):
+        changes = {'version': models.F('version') + 1, 'updated_at': timezone.now()}
+        if tree:
+            changes['tree_version'] = models.F('tree_version') + 1
+        updated = cls.objects.filter(pk=1).update(**changes)
+        if not updated:
+            cls.objects.get_or_create(
+                pk=1, defaults={'version': 1, 'tree_version': int(tree), 'updated_at': timezone.now()},
+            )
+
+    @classmethod
+    def current(cls):
+        """(version, updated_at); (0, None) before the first write."""
+        return cls.objects.filter(pk=1).values_list('version', 'updated_at').first() or (0, None)
+
+    @classmethod
+    def current_tree(cls):
+        """tree_version; 0 before the first write."""
+        return cls.objects.filter(pk=1).values_list('tree_version', flat=True).first() or 0
+
+
+class GraphChange(models.Model):
+    """
+    Append-only feed of changes to the similarity graph, written in the same
+    transaction as the change. The id is the sequence number: a process
+    holding a copy of the graph replays the entries after the last one it
+    has seen instead of reloading everything (see
+    CategoryGraphService.catch_up()). Bulk loads that do not log every edge
+    write a single RESET entry, which makes readers rebuild. Old entries are
+    removed by compact().
+    """
+    ADD_NODE = 'add_node'
+    REMOVE_NODE = 'remove_node'
+    ADD_EDGE = 'add_edge'
+    REMOVE_EDGE = 'remove_edge'
+    RESET = 'reset'
+    KIND_CHOICES = [(kind, kind) for kind in (ADD_NODE, REMOVE_NODE, ADD_EDGE, REMOVE_EDGE, RESET)]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    # Plain ids rather than foreign keys: entries outlive deleted categories
+    category_a_id = models.BigIntegerField(null=True, blank=True)
+    category_b_id = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @classmethod
+    def log(cls, kind, category_a_id=None, category_b_id=None):
+        cls.objects.create(kind=kind, category_a_id=category_a_id, category_b_id=category_b_id)
+
+    @classmethod
+    def log_edges(cls, kind, pairs, batch_size=1000):
+        """One entry per (id_a, id_b) pair, in order, with batched inserts."""
+        cls.objects.bulk_create(
+            [cls(kind=kind, category_a_id=id_a, category_b_id=id_b) for id_a, id_b in pairs],
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def last_seq(cls):
+        return cls.objects.aggregate(last=models.Max('id'))['last'] or 0
+
+    @classmethod
+    def compact(cls, older_than):
+        """
+        Deletes the entries up to the last one created before the datetime
+        older_than, always keeping the latest entry. Only ever removing a
+        prefix of the log lets a reader tell from the first remaining
+        sequence number whether it missed deleted entries.
+        Returns the number of entries deleted.
+        """
+        cutoff = cls.objects.filter(created_at__lt=older_than).aggregate(cutoff=models.Max('id'))['cutoff']
+        if cutoff is None:
+            return 0
+        deleted, _ = cls.objects.filter(id__lte=cutoff, id__lt=cls.last_seq()).delete()
+        return deleted
+
+
+def similar_prefetches():
+    """
+    Prefetches of the similarity rows on either side of a category, each
+    joined to the category on the other side, for Category.similar_categories.
+    """
+    return [
+        models.Prefetch(
+            f'similarities_{side}',
+            queryset=CategorySimilarity.objects.select_related(f'category_{other}'),
+            to_attr=f'similarities_{side}_prefetched',
+        )
+        for side, other in (('a', 'b'), ('b', 'a'))
+    ]
+
+
+def prefetch_similar(categories):
+    """Prefetches Category.similar_categories for a list of already fetched categories."""
+    models.prefetch_related_objects(categories, *similar_prefetches())
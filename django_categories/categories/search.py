@@ -0,0 +1,175 @@
+"""
+Ranked category name search, for picking rabbit hole endpoints.
+
+Every word of the query has to match the name, as a prefix, so partial
+words work and results narrow down while the user types.
+
+- SQLite: FTS5 table categories_category_fts (migration 0010), kept in sync
+  by triggers on categories_category. Words match the start of words of
+  the name. Matches are ranked by bm25, then by name length, so "cat" puts
+  "Cats" before "Cat food recipes". FTS5 picks the CANDIDATES best matches
+  by bm25 itself, and only those are joined to the categories and
+  tie-broken on name length. SQLite drops the triggers whenever a
+  migration rebuilds categories_category, so ensure_search_triggers()
+  recreates them after every migrate (see apps.py).
+- PostgreSQL: pg_trgm GIN index on name. Words match anywhere in the name,
+  with ILIKE (which the trigram index serves), ranked by trigram similarity
+  to the query.
+- Other databases: name__istartswith / icontains filters, unranked, as a
+  fallback only.
+
+Either way the index is only touched for the matching rows, so lookups
+stay in the milliseconds however many categories there are.
+"""
+import re
+
+from django.db import connection, connections, transaction
+from django.db.models.expressions import RawSQL
+
+from .metrics import timed
+from .models import Category
+
+FTS_TABLE = 'categories_category_fts'
+
+# Best bm25 matches tie-broken on name length per SQLite query, see above
+CANDIDATES = 1000
+
+# Current definition of the triggers created by migration 0010
+SQLITE_TRIGGERS = {
+    f'{FTS_TABLE}_insert': f"""
+        CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON categories_category BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, name) VALUES (new.id, new.name);
+        END
+    """,
+    f'{FTS_TABLE}_delete': f"""
+        CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON categories_category BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name);
+        END
+    """,
+    f'{FTS_TABLE}_update': f"""
+        CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF name ON categories_category BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO {FTS_TABLE}(rowid, name) VALUES (new.id, new.name);
+        END
+    """,
+}
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def query_words(query):
+    """The words of a search query, punctuation and FTS syntax dropped."""
+    return _WORD.findall(query or '')
+
+
+def _fts_query(words):
+    # Quoted so that words like NEAR or AND are not operators
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _search_sqlite(words, limit):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT c.id, c.name
+            FROM (
+                SELECT rowid, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank LIMIT %s
+            ) m
+            JOIN categories_category c ON c.id = m.rowid
+            ORDER BY m.rank, length(c.name), c.id
+            LIMIT %s
+            """,
+            [_fts_query(words), CANDIDATES, limit],
+        )
+        return cursor.fetchall()
+
+
+def _search_postgresql(words, limit):
+    phrase = ' '.join(words)
+    conditions = ' AND '.join(['name ILIKE %s'] * len(words))
+    patterns = ['%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for word in words]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT id, name
+            FROM categories_category
+            WHERE {conditions}
+            ORDER BY similarity(name, %s) DESC, length(name), id
+            LIMIT %s
+            """,
+            patterns + [phrase, limit],
+        )
+        return cursor.fetchall()
+
+
+def _search_fallback(words, limit):
+    queryset = Category.objects.filter(name__istartswith=words[0])
+    for word in words[1:]:
+        queryset = queryset.filter(name__icontains=word)
+    return list(queryset.order_by('name', 'id').values_list('id', 'name')[:limit])
+
+
+_BACKENDS = {
+    'sqlite': _search_sqlite,
+    'postgresql': _search_postgresql,
+}
+
+
+def search_categories(query, limit=10):
+    """[(id, name), ...] of the best matches for query, at most limit of them."""
+    words = query_words(query)
+    if not words or limit < 1:
+        return []
+
+    with timed('search'):
+        return _BACKENDS.get(connection.vendor, _search_fallback)(words, limit)
+
+
+def filter_by_name(queryset, query):
+    """
+    Narrows a Category queryset to the names matching query, unranked, for
+    callers that paginate and order on their own (e.g. the admin). Uses
+    the same index as search_categories().
+    """
+    words = query_words(query)
+    if not words:
+        return queryset
+
+    if connection.vendor == 'sqlite':
+        return queryset.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [_fts_query(words)],
+        ))
+    if connection.vendor == 'postgresql':
+        for word in words:
+            queryset = queryset.filter(name__icontains=word)
+        return queryset
+
+    queryset = queryset.filter(name__istartswith=words[0])
+    for word in words[1:]:
+        queryset = queryset.filter(name__icontains=word)
+    return queryset
+
+
+def ensure_search_triggers(using='default'):
+    """
+    Recreates the SQLite triggers keeping the name index in sync if any is
+    missing, then rebuilds the index, which missed every write made
+    meanwhile. Returns the names of the recreated triggers.
+    """
+    db_connection = connections[using]
+    if db_connection.vendor != 'sqlite':
+        return []
+
+    with transaction.atomic(using=using), db_connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        if cursor.fetchone() is None:
+            return [] # Migration 0010 not applied
+
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'categories_category'")
+        existing = {name for name, in cursor.fetchall()}
+        missing = [name for name in SQLITE_TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(SQLITE_TRIGGERS[name])
+        if missing:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    return missing
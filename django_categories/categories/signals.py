@@ -0,0 +1,83 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .graph_service import get_cached_graph_service
+from .islands import split_island
+from .models import Category, CategorySimilarity, GraphChange, GraphVersion
+from .tree_index import reset_tree_index
+
+
+def _patch_graph(method_name, *args):
+    """
+    Applies an incremental update to the shared graph once the surrounding
+    transaction commits, so rolled back writes never reach it.
+    Nothing to do if the graph has not been built in this process yet.
+    """
+    def apply():
+        graph_service = get_cached_graph_service()
+        if graph_service is not None:
+            getattr(graph_service, method_name)(*args)
+
+    transaction.on_commit(apply)
+
+
+def catch_up_graph():
+    """
+    on_commit callback of bulk writes: the shared graph replays the changes
+    they logged to GraphChange, rather than the writer keeping every
+    changed edge in memory until the commit.
+    """
+    graph_service = get_cached_graph_service()
+    if graph_service is not None:
+        graph_service.catch_up()
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    # Any change, names included, shows up in the graph responses
+    GraphVersion.bump(tree=created)
+    if created:
+        GraphChange.log(GraphChange.ADD_NODE, instance.id)
+        _patch_graph('add_category', instance.id)
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting(sender, instance, **kwargs):
+    # The instance may predate a merge of its island: split the current one
+    instance.island_id = Category.objects.filter(id=instance.id).values_list('island_id', flat=True).first()
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    GraphVersion.bump(tree=True)
+    GraphChange.log(GraphChange.REMOVE_NODE, instance.id)
+    _patch_graph('remove_category', instance.id)
+    transaction.on_commit(reset_tree_index)
+
+    # Losing a member may split the island it belonged to
+    island_id = instance.island_id
+    transaction.on_commit(lambda: split_island(island_id))
+
+
+@receiver(post_save, sender=CategorySimilarity)
+def similarity_saved(sender, instance, created, **kwargs):
+    if created:
+        GraphVersion.bump()
+        GraphChange.log(GraphChange.ADD_EDGE, instance.category_a_id, instance.category_b_id)
+        Category.objects.filter(id__in=(instance.category_a_id, instance.category_b_id)).update(
+            similarity_degree=F('similarity_degree') + 1
+        )
+        _patch_graph('add_similarity', instance.category_a_id, instance.category_b_id)
+
+
+@receiver(post_delete, sender=CategorySimilarity)
+def similarity_deleted(sender, instance, **kwargs):
+    GraphVersion.bump()
+    GraphChange.log(GraphChange.REMOVE_EDGE, instance.category_a_id, instance.category_b_id)
+    Category.objects.filter(
+        id__in=(instance.category_a_id, instance.category_b_id),
+        similarity_degree__gt=0,
+    ).update(similarity_degree=F('similarity_degree') - 1)
+    _patch_graph('remove_similarity', instance.category_a_id, instance.category_b_id)
@@ -0,0 +1,217 @@
+"""
+Batch mutation and streaming ingestion of CategorySimilarity edges.
+
+Pairs are normalized in memory (lower id first, duplicates dropped) and
+written per fixed-size chunk: one bulk_create or one set-based DELETE per
+chunk, instead of a get_or_create / delete round trip per pair. Bulk writes
+send no model signals, so the work the signals do for single edges is done
+here per chunk: the changes are logged to GraphChange, similarity_degree is
+shifted with one UPDATE per distinct delta and island labels are merged or
+split. Once the transaction commits, the cached graph replays the logged
+changes (see signals.catch_up_graph()), so no chunk is kept in memory until
+then. Writers lock the endpoint categories of a chunk before looking up
+which pairs are stored, so concurrent writers of the same pairs take turns
+and never both count a pair as created (or deleted).
+"""
+import csv
+import json
+import operator
+from collections import Counter
+from functools import reduce
+from itertools import islice
+
+from django.db import connection, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Greatest
+
+from .islands import split_island, union_edges
+from .models import Category, CategorySimilarity, GraphChange, GraphVersion
+from .signals import catch_up_graph
+
+FIELDS = ('category_a_id', 'category_b_id')
+
+# Pairs per chunk: bounds memory and keeps IN (...) lists below SQLite's
+# variable limit
+CHUNK_SIZE = 1000
+
+# Pairs per lookup in _existing(): two query parameters each
+LOOKUP_SIZE = 400
+
+
+def normalize_pairs(pairs):
+    """Yields (lower id, higher id) for every pair; a category cannot be similar to itself."""
+    for id_a, id_b in pairs:
+        id_a, id_b = int(id_a), int(id_b)
+        if id_a == id_b:
+            raise ValueError(f"Cannot mark a category as similar to itself: {id_a}")
+        yield (id_a, id_b) if id_a < id_b else (id_b, id_a)
+
+
+def _chunks(pairs, size):
+    iterator = iter(pairs)
+    while True:
+        chunk = set(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _existing(pairs):
+    """
+    The subset of pairs already stored, as {(id_a, id_b): row id}. Looks up
+    the exact pairs on the (category_a, category_b) index: a row value IN
+    (VALUES ...) list where supported, an OR of the pairs elsewhere.
+    """
+    pairs = sorted(pairs)
+    existing = {}
+    for start in range(0, len(pairs), LOOKUP_SIZE):
+        batch = pairs[start:start + LOOKUP_SIZE]
+        if connection.vendor in ('sqlite', 'postgresql'):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT category_a_id, category_b_id, id
+                    FROM {CategorySimilarity._meta.db_table}
+                    WHERE (category_a_id, category_b_id) IN (VALUES {', '.join(['(%s, %s)'] * len(batch))})
+                    """,
+                    [cat_id for pair in batch for cat_id in pair],
+                )
+                rows = cursor.fetchall()
+        else:
+            rows = CategorySimilarity.objects.filter(
+                reduce(operator.or_, (Q(category_a_id=id_a, category_b_id=id_b) for id_a, id_b in batch))
+            ).values_list('category_a_id', 'category_b_id', 'id')
+        existing.update(((id_a, id_b), row_id) for id_a, id_b, row_id in rows)
+    return existing
+
+
+def _shift_degrees(pairs, sign):
+    """Adds sign to similarity_degree once per pair endpoint, one UPDATE per distinct delta."""
+    ids_by_delta = {}
+    for cat_id, count in Counter(cat_id for pair in pairs for cat_id in pair).items():
+        ids_by_delta.setdefault(count, []).append(cat_id)
+
+    for count, cat_ids in ids_by_delta.items():
+        Category.objects.filter(id__in=cat_ids).update(
+            similarity_degree=Greatest(F('similarity_degree') + sign * count, Value(0))
+        )
+
+
+def mark_similar_many(pairs, chunk_size=CHUNK_SIZE):
+    """
+    Stores every (id_a, id_b) pair not stored yet. Returns the number of
+    similarities created. Raises ValueError, writing nothing, if a pair
+    references a category that does not exist.
+    """
+    created = 0
+    with transaction.atomic():
+        for chunk in _chunks(normalize_pairs(pairs), chunk_size):
+            cat_ids = {cat_id for pair in chunk for cat_id in pair}
+            unknown = cat_ids - Category.objects.filter(id__in=cat_ids).lock()
+            if unknown:
+                raise ValueError(f"Similarities reference unknown categories: {sorted(unknown)[:10]}")
+
+            new_pairs = sorted(chunk - _existing(chunk).keys())
+            if not new_pairs:
+                continue
+
+            CategorySimilarity.objects.bulk_create(
+                [CategorySimilarity(category_a_id=id_a, category_b_id=id_b) for id_a, id_b in new_pairs],
+                batch_size=chunk_size,
+                ignore_conflicts=True,
+            )
+            GraphChange.log_edges(GraphChange.ADD_EDGE, new_pairs, batch_size=chunk_size)
+            _shift_degrees(new_pairs, 1)
+            union_edges(new_pairs)
+            created += len(new_pairs)
+
+        if created:
+            GraphVersion.bump()
+            transaction.on_commit(catch_up_graph)
+
+    return created
+
+
+def unmark_similar_many(pairs, chunk_size=CHUNK_SIZE):
+    """Deletes every stored (id_a, id_b) pair. Returns the number of similarities deleted."""
+    deleted = 0
+    touched_islands = set()
+    with transaction.atomic():
+        for chunk in _chunks(normalize_pairs(pairs), chunk_size):
+            Category.objects.filter(id__in={cat_id for pair in chunk for cat_id in pair}).lock()
+            existing = _existing(chunk)
+            if not existing:
+                continue
+
+            touched_islands.update(
+                Category.objects.filter(id__in=[id_a for id_a, _ in existing])
+                .values_list('island_id', flat=True)
+            )
+            # Plain DELETE: QuerySet.delete() would load every row to send
+            # the per-row post_delete signals this function replaces
+            CategorySimilarity.objects.filter(id__in=existing.values())._raw_delete(CategorySimilarity.objects.db)
+            GraphChange.log_edges(GraphChange.REMOVE_EDGE, sorted(existing), batch_size=chunk_size)
+            _shift_degrees(existing, -1)
+            deleted += len(existing)
+
+        # Each island is recomputed once, with all of its removed edges gone
+        for label in touched_islands:
+            split_island(label)
+
+        if deleted:
+            GraphVersion.bump()
+            transaction.on_commit(catch_up_graph)
+
+    return deleted
+
+
+def merge_similarities(source_ids, target_id, chunk_size=CHUNK_SIZE):
+    """
+    Moves every similarity of the source categories over to the target
+    category, e.g. before deleting duplicates: each neighbor of a source
+    becomes a neighbor of the target. Runs as one mark_similar_many and one
+    unmark_similar_many, in one transaction.
+    Returns (similarities created, similarities deleted).
+    """
+    source_ids = set(source_ids) - {target_id}
+    with transaction.atomic():
+        old_pairs = set()
+        neighbor_ids = set()
+        for batch in _chunks(source_ids, chunk_size):
+            for id_a, id_b in CategorySimilarity.objects.filter(
+                Q(category_a_id__in=batch) | Q(category_b_id__in=batch)
+            ).values_list('category_a_id', 'category_b_id'):
+                old_pairs.add((id_a, id_b))
+                neighbor_ids.update((id_a, id_b))
+
+        neighbor_ids -= source_ids | {target_id}
+        created = mark_similar_many(((target_id, neighbor_id) for neighbor_id in sorted(neighbor_ids)), chunk_size)
+        deleted = unmark_similar_many(sorted(old_pairs), chunk_size)
+    return created, deleted
+
+
+def read_pairs(stream, file_format):
+    """Yields (id_a, id_b) from CSV with a category_a_id,category_b_id header, or JSONL objects."""
+    if file_format == 'csv':
+        for row in csv.DictReader(stream):
+            yield int(row['category_a_id']), int(row['category_b_id'])
+    else:
+        for line in stream:
+            if line.strip():
+                row = json.loads(line)
+                yield row['category_a_id'], row['category_b_id']
+
+
+def write_pairs(pairs, stream, file_format):
+    count = 0
+    if file_format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(FIELDS)
+        for pair in pairs:
+            writer.writerow(pair)
+            count += 1
+    else:
+        for id_a, id_b in pairs:
+            stream.write(json.dumps({'category_a_id': id_a, 'category_b_id': id_b}) + '\n')
+            count += 1
+    return count
@@ -0,0 +1,299 @@
+"""
+Graph engine that answers queries inside the database instead of loading
+the similarity graph into Python memory.
+
+Traversals are WITH RECURSIVE queries over CategorySimilarity, expanding a
+walk(node, depth) relation one level per step through the covering
+(category_a, category_b) and (category_b, category_a) indexes. UNION drops
+duplicate (node, depth) rows, so a walk of depth d holds at most d rows per
+node of the island. The depth limit starts small and doubles until the
+target is reached; the persisted island_id labels (see islands.py) tell up
+front whether a path exists at all and bound the search by the island size.
+
+Python memory stays bounded by the query results: a path, one row per
+island, or (for the exact diameter) the largest island, which is loaded on
+its own as a CSRGraph.
+"""
+import threading
+import time
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection
+
+from .diameter import DiameterEngine
+from .graph_storage import CSRGraph
+from .metrics import timed
+from .models import Category, CategorySimilarity
+
+# Depth limit of the first traversal; doubled on every retry
+INITIAL_DEPTH = 4
+
+_OTHER_END = 'CASE WHEN s.category_a_id = {node} THEN s.category_b_id ELSE s.category_a_id END'
+
+
+def _walk_cte():
+    """walk(node, depth): every node reachable from %s in depth <= %s steps."""
+    similarity_table = connection.ops.quote_name(CategorySimilarity._meta.db_table)
+    return f'''
+        walk(node, depth) AS (
+            SELECT CAST(%s AS BIGINT), 0
+            UNION
+            SELECT CAST({_OTHER_END.format(node='w.node')} AS BIGINT), w.depth + 1
+            FROM walk w
+            JOIN {similarity_table} s ON s.category_a_id = w.node OR s.category_b_id = w.node
+            WHERE w.depth < %s
+        )'''
+
+
+def _path_sql():
+    """
+    Walks from the end back to the start: at every step, any neighbor that
+    the walk reached one level earlier. A walk as long as the distance can
+    not revisit a node, so this always yields a shortest path.
+    """
+    similarity_table = connection.ops.quote_name(CategorySimilarity._meta.db_table)
+    neighbor = _OTHER_END.format(node='b.node')
+    return f'''
+        WITH RECURSIVE {_walk_cte()},
+        back(node, depth) AS (
+            SELECT CAST(%s AS BIGINT), MIN(depth) FROM walk WHERE node = %s HAVING MIN(depth) IS NOT NULL
+            UNION ALL
+            SELECT CAST((
+                SELECT {neighbor}
+                FROM {similarity_table} s
+                WHERE (s.category_a_id = b.node OR s.category_b_id = b.node)
+                AND {neighbor} IN (SELECT node FROM walk WHERE depth = b.depth - 1)
+                LIMIT 1
+            ) AS BIGINT), b.depth - 1
+            FROM back b
+            WHERE b.depth > 0
+        )
+        SELECT node FROM back ORDER BY depth'''
+
+
+def _neighborhood_sql():
+    """(node, distance) within the depth limit, nearest and lowest ids first."""
+    return f'''
+        WITH RECURSIVE {_walk_cte()}
+        SELECT node, MIN(depth) AS distance
+        FROM walk
+        GROUP BY node
+        HAVING MIN(depth) > 0
+        ORDER BY distance, node
+        LIMIT %s'''
+
+
+def _farthest_sql():
+    """(nodes reached, farthest node, its distance) within the depth limit."""
+    return f'''
+        WITH RECURSIVE {_walk_cte()},
+        distances(node, distance) AS (SELECT node, MIN(depth) FROM walk GROUP BY node)
+        SELECT (SELECT COUNT(*) FROM distances), node, distance
+        FROM distances
+        ORDER BY distance DESC, node
+        LIMIT 1'''
+
+
+class SQLGraphService:
+    """Same interface as CategoryGraphService, backed by recursive SQL queries."""
+
+    storage = 'sql'
+
+    def __init__(self):
+        # Bumped on every write notification, for callers that compare versions
+        self.version = 0
+        self.built_at = None
+        self._lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        """Nothing is cached: the database is always current."""
+        with self._lock:
+            self.version += 1
+            self.built_at = time.monotonic()
+
+    def _changed(self, *args):
+        with self._lock:
+            self.version += 1
+
+    # The signal handlers notify every engine; this one reads the tables directly
+    add_category = remove_category = _changed
+    add_similarity = remove_similarity = _changed
+    add_similarities = remove_similarities = _changed
+    # Bulk writes ask every engine to replay the change log
+    catch_up = _changed
+
+    def _island_of(self, *cat_ids):
+        """{id: island_id} for the given categories that exist."""
+        return dict(Category.objects.filter(id__in=cat_ids).values_list('id', 'island_id'))
+
+    def _island_size(self, label):
+        return Category.objects.filter(island_id=label).count()
+
+    def find_shortest_path(self, start_id, end_id, island_size=None):
+        """Finds the shortest sequence (rabbit hole) from start to end."""
+        if start_id == end_id:
+            return [start_id]
+
+        labels = self._island_of(start_id, end_id)
+        label = labels.get(start_id)
+        if label is None or label != labels.get(end_id):
+            return None # Missing, or on different islands
+
+        if island_size is None:
+            island_size = self._island_size(label)
+        depth_limit = min(INITIAL_DEPTH, island_size - 1)
+
+        with timed('graph_traversal'), connection.cursor() as cursor:
+            while True:
+                cursor.execute(_path_sql(), [start_id, depth_limit, end_id, end_id])
+                path = [row[0] for row in cursor.fetchall()]
+                if path:
+                    return path
+                if depth_limit >= island_size - 1:
+                    return None # Labels out of date
+                depth_limit = min(depth_limit * 2, island_size - 1)
+
+    def find_shortest_paths(self, pairs):
+        """
+        Shortest paths for many (start_id, end_id) pairs, as a list aligned
+        with pairs, None where there is no path. The island labels and sizes
+        of all ends are read with two queries, then one traversal runs per
+        connected pair.
+        """
+        pairs = [(int(start_id), int(end_id)) for start_id, end_id in pairs]
+        labels = self._island_of(*{cat_id for pair in pairs for cat_id in pair})
+        sizes = dict(
+            Category.objects.filter(island_id__in=set(labels.values()))
+            .island_sizes()
+        )
+
+        results = []
+        for start_id, end_id in pairs:
+            label = labels.get(start_id)
+            if start_id == end_id:
+                results.append([start_id])
+            elif label is None or label != labels.get(end_id):
+                results.append(None)
+            else:
+                results.append(self.find_shortest_path(start_id, end_id, island_size=sizes[label]))
+        return results
+
+    def _farthest(self, start_id, island_size):
+        """Returns (farthest category id, distance) from start_id within its island."""
+        depth_limit = min(INITIAL_DEPTH, island_size - 1)
+
+        with connection.cursor() as cursor:
+            while True:
+                cursor.execute(_farthest_sql(), [start_id, depth_limit])
+                reached, farthest, distance = cursor.fetchone()
+                # Every member reached: the deepest one is the farthest
+                if reached >= island_size or depth_limit >= island_size - 1:
+                    return farthest, distance
+                depth_limit = min(depth_limit * 2, island_size - 1)
+
+    def neighborhood(self, cat_id, k, limit=None):
+        """Categories within k similarity hops of cat_id, as ([[ids at 1 hop], ...], truncated)."""
+        if not Category.objects.filter(id=cat_id).exists():
+            return None, False
+        if k < 1:
+            return [], False
+
+        # One extra row tells whether the limit cut anything off
+        row_limit = 2 ** 62 if limit is None else limit + 1
+        with timed('graph_neighborhood'), connection.cursor() as cursor:
+            cursor.execute(_neighborhood_sql(), [cat_id, k, row_limit])
+            rows = cursor.fetchall()
+
+        truncated = limit is not None and len(rows) > limit
+        levels = []
+        for node, distance in rows[:limit]:
+            if len(levels) < distance:
+                levels.append([])
+            levels[-1].append(node)
+        return levels, truncated
+
+    def distance_bounds(self, id_a, id_b):
+        """
+        (lower, upper) bounds of the rabbit hole length between two
+        categories, or None if they are not connected. There are no
+        landmarks here: both bounds are the exact length.
+        """
+        path = self.find_shortest_path(id_a, id_b)
+        if path is None:
+            return None
+        return len(path) - 1, len(path) - 1
+
+    def same_island(self, id_a, id_b):
+        """Whether two categories are connected by any chain of similarities."""
+        labels = self._island_of(id_a, id_b)
+        label = labels.get(id_a)
+        return label is not None and label == labels.get(id_b)
+
+    def get_rabbit_islands(self):
+        """Finds all connected components (rabbit islands) as lists of category ids."""
+        rows = (
+            Category.objects.order_by('island_id', 'id')
+            .values_list('island_id', 'id')
+            .iterator(chunk_size=2000)
+        )
+        with timed('graph_islands'):
+            return [
+                [cat_id for _, cat_id in island_rows]
+                for _, island_rows in groupby(rows, key=itemgetter(0))
+            ]
+
+    def find_longest_rabbit_hole(self, exact=False):
+        """
+        Two-sweep approximation of the diameter of the largest island, as
+        with CategoryGraphService. With exact=True, every island that could
+        hold a longer path is loaded on its own and solved with iFUB.
+        """
+        if exact:
+            with timed('graph_diameter_exact'):
+                return self._find_exact_longest_rabbit_hole()
+
+        with timed('graph_diameter'):
+            largest = Category.objects.island_sizes().first()
+            if largest is None:
+                return []
+
+            label, size = largest
+            # A label is the id of one of the island's members
+            node_b, _ = self._farthest(label, size)
+            node_c, _ = self._farthest(node_b, size)
+            return self.find_shortest_path(node_b, node_c, island_size=size)
+
+    def _find_exact_longest_rabbit_hole(self):
+        best = []
+        workers = getattr(settings, 'CATEGORY_GRAPH_DIAMETER_WORKERS', None)
+
+        for label, size in Category.objects.island_sizes().iterator():
+            if size <= len(best):
+                break # Largest first: no remaining island can hold a longer path
+
+            graph = CSRGraph.from_edges(
+                Category.objects.filter(island_id=label).values_list('id', flat=True),
+                CategorySimilarity.objects.filter(category_a__island_id=label)
+                .values_list('category_a_id', 'category_b_id')
+                .iterator(),
+            )
+            with DiameterEngine(graph, workers=workers) as engine:
+                path = [graph.id_of(node) for node in engine.longest_path([list(graph.nodes())])]
+            if len(path) > len(best):
+                best = path
+
+        return best
+
+    def stats(self):
+        """Size of the graph in the database, for diagnostics."""
+        return {
+            'storage': self.storage,
+            'version': self.version,
+            'nodes': Category.objects.count(),
+            'edges': CategorySimilarity.objects.count(),
+            'memory_bytes': 0,
+            'landmarks': None,
+        }
@@ -0,0 +1,178 @@
+"""
+Deterministic synthetic category data, for benchmarks and large seeds.
+
+The same parameters and seed always produce the same tree and the same
+similarity graph. Categories get the ids first_id..first_id+num_categories-1
+(1..num_categories by default), parents before children, so the rows feed
+straight into Category.objects.bulk_import.
+Islands are contiguous id ranges: each is connected by a random spanning
+tree, then filled up with random edges to the requested average degree.
+No edge crosses two islands, so island labels are known without a
+union-find pass.
+
+Edges are generated in independent tasks of at most TASK_EDGES pairs, each
+with its own seed, so they stream in bounded memory and can be spread over
+a process pool without changing the result.
+"""
+import random
+from array import array
+from itertools import islice
+from multiprocessing import Pool
+
+from django.db import transaction
+
+from .graph_service import reset_graph_service
+from .models import Category, CategorySimilarity, GraphChange, GraphVersion
+
+# Pairs generated per task, in-process or by a pool worker
+TASK_EDGES = 50000
+
+
+def island_ranges(num_categories, num_islands, first_id=1):
+    """[(first id, last id + 1), ...] of every island, the last one taking the remainder."""
+    num_islands = max(1, min(num_islands, num_categories))
+    size = num_categories // num_islands
+    bounds = [first_id + index * size for index in range(num_islands)] + [first_id + num_categories]
+    return list(zip(bounds, bounds[1:]))
+
+
+def generate_tree(num_categories, num_roots, seed=0, depth_bias=1.0, max_depth=None, first_id=1):
+    """
+    Yields category row dicts, each parent before its children. Parents are
+    picked among the earlier categories: depth_bias 1 picks uniformly (trees
+    of logarithmic depth), higher values favour recent ones (deeper trees),
+    lower values early ones (flatter trees). max_depth caps the depth by
+    attaching to an ancestor instead.
+    """
+    rng = random.Random(seed)
+    num_roots = max(1, min(num_roots, num_categories))
+    exponent = 1 / depth_bias
+
+    # Indexed by position: category number 1..num_categories
+    parents = array('i', [0]) * (num_categories + 1)
+    depths = array('i', [0]) * (num_categories + 1)
+
+    for number in range(1, num_categories + 1):
+        cat_id = first_id - 1 + number
+        parent = None
+        if number > num_roots:
+            parent = min(number - 1, 1 + int(rng.random() ** exponent * (number - 1)))
+            if max_depth is not None:
+                while depths[parent] >= max_depth:
+                    parent = parents[parent]
+            parents[number] = parent
+            depths[number] = depths[parent] + 1
+
+        yield {
+            'id': cat_id,
+            'parent_id': None if parent is None else first_id - 1 + parent,
+            'name': f'Synthetic Category {cat_id}',
+            'description': f'Description for Synthetic Category {cat_id}',
+            'image': f'/image/path/to/category/{cat_id}.png',
+        }
+
+
+def similarity_tasks(num_categories, num_islands, average_degree, seed=0, first_id=1):
+    """
+    Splits the edge generation into (kind, first, end, start, count, seed)
+    tasks: 'tree' links members start..start+count-1 to an earlier member,
+    'random' adds count random edges within the island first..end-1.
+    """
+    tasks = []
+    for first, end in island_ranges(num_categories, num_islands, first_id):
+        size = end - first
+        if size < 2:
+            continue
+
+        for start in range(first + 1, end, TASK_EDGES):
+            tasks.append(('tree', first, end, start, min(TASK_EDGES, end - start)))
+
+        extra_edges = max(0, int(size * average_degree / 2) - (size - 1))
+        for done in range(0, extra_edges, TASK_EDGES):
+            tasks.append(('random', first, end, done, min(TASK_EDGES, extra_edges - done)))
+
+    return [task + (seed * 1000003 + index,) for index, task in enumerate(tasks)]
+
+
+def run_similarity_task(task):
+    """The (lower id, higher id) pairs of one task; may repeat an earlier pair."""
+    kind, first, end, start, count, task_seed = task
+    rng = random.Random(task_seed)
+
+    if kind == 'tree':
+        return [(rng.randrange(first, cat_id), cat_id) for cat_id in range(start, start + count)]
+
+    pairs = []
+    for _ in range(count):
+        id_a = rng.randrange(first, end)
+        id_b = rng.randrange(first, end - 1)
+        if id_b >= id_a:
+            id_b += 1 # Any member but id_a
+        pairs.append((id_a, id_b) if id_a < id_b else (id_b, id_a))
+    return pairs
+
+
+def generate_similarities(num_categories, num_islands, average_degree, seed=0, workers=1, first_id=1):
+    """
+    Yields lists of pairs, one per task. With workers > 1 the tasks run in
+    a process pool, a few at a time so memory stays bounded however fast
+    the caller consumes them.
+    """
+    tasks = similarity_tasks(num_categories, num_islands, average_degree, seed, first_id)
+
+    if workers <= 1:
+        for task in tasks:
+            yield run_similarity_task(task)
+        return
+
+    with Pool(workers) as pool:
+        window = workers * 2
+        for start in range(0, len(tasks), window):
+            yield from pool.map(run_similarity_task, tasks[start:start + window])
+
+
+def populate(num_categories, num_roots, num_islands, average_degree, seed=0, batch_size=1000,
+             workers=1, depth_bias=1.0, max_depth=None, first_id=1, log=None):
+    """
+    Loads a synthetic tree and similarity graph into a database without
+    categories from first_id on, with batched bulk inserts: the tree in one
+    transaction, then one transaction per generated task of edges.
+    Returns (categories created, similarities created).
+    """
+    categories = Category.objects.bulk_import(
+        generate_tree(num_categories, num_roots, seed, depth_bias=depth_bias, max_depth=max_depth, first_id=first_id),
+        batch_size=batch_size,
+    )
+    if log:
+        log(f'Created {categories} categories')
+
+    generated = 0
+    for pairs in generate_similarities(num_categories, num_islands, average_degree, seed, workers, first_id):
+        with transaction.atomic():
+            pairs = iter(pairs)
+            while True:
+                batch = set(islice(pairs, batch_size))
+                if not batch:
+                    break
+                CategorySimilarity.objects.bulk_create(
+                    [CategorySimilarity(category_a_id=id_a, category_b_id=id_b) for id_a, id_b in batch],
+                    batch_size=batch_size,
+                    ignore_conflicts=True,
+                )
+                generated += len(batch)
+        if log:
+            log(f'Inserted {generated} generated similarities')
+
+    with transaction.atomic():
+        # Each island is connected and labelled by its lowest id
+        for first, end in island_ranges(num_categories, num_islands, first_id):
+            Category.objects.filter(id__gte=first, id__lt=end).update(island_id=first)
+        Category.objects.refresh_similarity_degrees()
+        GraphVersion.bump(tree=True)
+
+        # bulk_create sends no signals, so the cached graph cannot be patched
+        GraphChange.log(GraphChange.RESET)
+        transaction.on_commit(reset_graph_service)
+
+    # Only the generated categories' similarities, not those of any categories before first_id
+    return categories, CategorySimilarity.objects.filter(category_a_id__gte=first_id).count()
@@ -1,3 +1,1405 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import diameter, graph_snapshot, similarity_io
+from .admin import EstimatedCountPaginator
+from .diameter import DiameterEngine
+from .graph_service import (
+    CategoryGraphService,
+    aget_graph_service,
+    get_graph_service,
+    reset_graph_service,
+    run_in_graph_executor,
+)
+from .models import Category, CategoryQuerySet, CategorySimilarity, GraphChange, prefetch_similar
+from .search import ensure_search_triggers, filter_by_name, search_categories
+from .similarity_io import mark_similar_many, merge_similarities, unmark_similar_many
+from .sql_graph import SQLGraphService
+from .tree_index import get_tree_index, reset_tree_index
 
 # Create your tests here.
+def create_category(name, parent=None):
+    return Category.objects.create(name=name, description=f'{name} description', image='', parent=parent)
+
+
+def create_graph(count, edges):
+    """Categories "0" to "count - 1" with similarities between the given indexes. Returns their ids."""
+    ids = [create_category(str(index)).id for index in range(count)]
+    mark_similar_many((ids[index_a], ids[index_b]) for index_a, index_b in edges)
+    return ids
+
+
+def island_partition(categories):
+    """The categories grouped by persisted island label, as a set of frozensets of names."""
+    by_label = {}
+    for category in Category.objects.filter(id__in=[category.id for category in categories]):
+        by_label.setdefault(category.island_id, set()).add(category.name)
+    return {frozenset(names) for names in by_label.values()}
+
+
+class GraphServiceTests(TestCase):
+    def setUp(self):
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        self.a = create_category('A')
+        self.b = create_category('B')
+        self.graph = get_graph_service(rebuild=True)
+
+    def test_saves_and_deletes_patch_the_graph(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            c = create_category('C')
+            self.a.mark_similar_to(self.b)
+            self.b.mark_similar_to(c)
+        self.assertEqual(self.graph.find_shortest_path(self.a.id, c.id), [self.a.id, self.b.id, c.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.b.unmark_similar_to(c)
+        self.assertIsNone(self.graph.find_shortest_path(self.a.id, c.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.b.delete()
+        self.assertIsNone(self.graph.find_shortest_path(self.a.id, self.b.id))
+        self.assertEqual(
+            sorted(sorted(island) for island in self.graph.get_rabbit_islands()),
+            [[self.a.id], [c.id]],
+        )
+
+    def test_rolled_back_writes_never_reach_the_graph(self):
+        # Callbacks dropped, as on a rollback
+        with self.captureOnCommitCallbacks(execute=False):
+            self.a.mark_similar_to(self.b)
+        self.assertIsNone(self.graph.find_shortest_path(self.a.id, self.b.id))
+
+    def test_the_service_is_shared_and_used_by_the_views(self):
+        self.assertIs(get_graph_service(), self.graph)
+
+        # Responses are cached per graph version, which restarts in every test
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a.mark_similar_to(self.b)
+        response = self.client.get(f'/categories/getRabbitHole/{self.a.id}/{self.b.id}/')
+        self.assertEqual(response.json()['path'], [{'id': self.a.id, 'name': 'A'}, {'id': self.b.id, 'name': 'B'}])
+        self.assertIs(get_graph_service(), self.graph)
+
+
+class GraphStorageTests(TestCase):
+    # 0 - 1 - 2 - 3 - 4, with 2 - 5 - 6 branching off, and 7 - 8 apart
+    EDGES = [(0, 1), (1, 2), (2, 3), (3, 4), (2, 5), (5, 6), (7, 8)]
+
+    def setUp(self):
+        self.ids = create_graph(9, self.EDGES)
+
+    def services(self):
+        return {
+            'dict': CategoryGraphService(storage='dict'),
+            'csr': CategoryGraphService(storage='csr'),
+            'sql': SQLGraphService(),
+        }
+
+    def assertIsPath(self, path):
+        pairs = {tuple(sorted((self.ids[a], self.ids[b]))) for a, b in self.EDGES}
+        for id_a, id_b in zip(path, path[1:]):
+            self.assertIn(tuple(sorted((id_a, id_b))), pairs)
+
+    def test_storages_give_the_same_paths(self):
+        ids = self.ids
+        for storage, service in self.services().items():
+            with self.subTest(storage=storage):
+                self.assertEqual(service.find_shortest_path(ids[0], ids[6]), [ids[0], ids[1], ids[2], ids[5], ids[6]])
+                self.assertEqual(service.find_shortest_path(ids[4], ids[4]), [ids[4]])
+                self.assertIsNone(service.find_shortest_path(ids[0], ids[8]))
+                self.assertEqual(
+                    sorted(sorted(island) for island in service.get_rabbit_islands()),
+                    [ids[:7], ids[7:]],
+                )
+
+    def test_storages_give_the_same_diameter(self):
+        for storage, service in self.services().items():
+            for exact in (False, True):
+                with self.subTest(storage=storage, exact=exact):
+                    path = service.find_longest_rabbit_hole(exact=exact)
+                    self.assertEqual(len(path), 5)
+                    self.assertIsPath(path)
+
+    def test_csr_is_rebuilt_after_writes(self):
+        ids = self.ids
+        service = CategoryGraphService(storage='csr')
+        version = service.version
+
+        # Notified of the write, it reloads from the database on next use
+        mark_similar_many([(ids[0], ids[4])])
+        service.add_similarity(ids[0], ids[4])
+        self.assertEqual(service.find_shortest_path(ids[0], ids[3]), [ids[0], ids[4], ids[3]])
+        self.assertGreater(service.version, version)
+
+        unmark_similar_many([(ids[2], ids[5])])
+        service.remove_similarity(ids[2], ids[5])
+        self.assertIsNone(service.find_shortest_path(ids[0], ids[6]))
+        self.assertEqual(service.stats()['edges'], len(self.EDGES))
+
+    def test_csr_is_smaller_than_dict(self):
+        dict_stats = CategoryGraphService(storage='dict').stats()
+        csr_stats = CategoryGraphService(storage='csr').stats()
+        self.assertEqual((csr_stats['nodes'], csr_stats['edges']), (dict_stats['nodes'], dict_stats['edges']))
+        self.assertLess(csr_stats['memory_bytes'], dict_stats['memory_bytes'])
+
+
+class ShortestPathTests(TestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        self.edges = {tuple(sorted(rng.sample(range(60), 2))) for _ in range(90)}
+        self.ids = create_graph(60, self.edges)
+        self.service = CategoryGraphService(storage='dict')
+
+    def distances_from(self, start_id):
+        """Plain one-sided BFS, for reference."""
+        distances = {start_id: 0}
+        frontier = [start_id]
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                for neighbor in self.service.graph.neighbors(node):
+                    if neighbor not in distances:
+                        distances[neighbor] = distances[node] + 1
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        return distances
+
+    def test_paths_are_shortest(self):
+        for start_id in self.ids[:10]:
+            distances = self.distances_from(start_id)
+            for end_id in self.ids:
+                path = self.service.find_shortest_path(start_id, end_id)
+                with self.subTest(start_id=start_id, end_id=end_id):
+                    if end_id not in distances:
+                        self.assertIsNone(path)
+                        continue
+                    self.assertEqual((path[0], path[-1], len(path) - 1), (start_id, end_id, distances[end_id]))
+                    for id_a, id_b in zip(path, path[1:]):
+                        self.assertIn(id_b, self.service.graph.neighbors(id_a))
+
+    def test_missing_categories_have_no_path(self):
+        self.assertIsNone(self.service.find_shortest_path(self.ids[0], max(self.ids) + 1))
+
+    def test_removals_keep_the_island_labels(self):
+        rng = random.Random(4)
+        self.service.get_rabbit_islands()
+
+        for step in range(40):
+            if step % 10 == 9:
+                self.service.remove_category(rng.choice(list(self.service.graph.nodes())))
+            else:
+                id_a = rng.choice(list(self.service.graph.nodes()))
+                neighbors = list(self.service.graph.neighbors(id_a))
+                if not neighbors:
+                    continue
+                self.service.remove_similarity(id_a, rng.choice(neighbors))
+
+            # Updated in place rather than dropped and recomputed
+            self.assertIsNotNone(self.service._components)
+            self.assertEqual(
+                sorted(sorted(island) for island in self.service.get_rabbit_islands()),
+                sorted(sorted(island) for island in self.service._islands(self.service.graph)),
+            )
+
+
+class IslandTests(TestCase):
+    def setUp(self):
+        self.a, self.b, self.c, self.d = (create_category(name) for name in 'ABCD')
+        self.categories = [self.a, self.b, self.c, self.d]
+
+    def test_new_categories_are_islands_of_their_own(self):
+        for category in self.categories:
+            category.refresh_from_db()
+            self.assertEqual(category.island_id, category.id)
+
+    def test_marking_merges_islands(self):
+        self.a.mark_similar_to(self.b)
+        self.c.mark_similar_to(self.d)
+        self.assertEqual(island_partition(self.categories), {frozenset('AB'), frozenset('CD')})
+
+        self.b.mark_similar_to(self.c)
+        self.assertEqual(island_partition(self.categories), {frozenset('ABCD')})
+        self.a.refresh_from_db()
+        self.d.refresh_from_db()
+        self.assertTrue(self.a.is_same_island(self.d))
+
+    def test_unmarking_splits_islands(self):
+        for cat_a, cat_b in ((self.a, self.b), (self.b, self.c), (self.c, self.d)):
+            cat_a.mark_similar_to(cat_b)
+
+        self.b.unmark_similar_to(self.c)
+        self.assertEqual(island_partition(self.categories), {frozenset('AB'), frozenset('CD')})
+
+        # A cycle keeps the island together
+        self.a.mark_similar_to(self.c)
+        self.b.mark_similar_to(self.c)
+        self.b.unmark_similar_to(self.c)
+        self.assertEqual(island_partition(self.categories), {frozenset('ABCD')})
+
+    def test_deleting_a_member_splits_its_island(self):
+        self.a.mark_similar_to(self.b)
+        self.b.mark_similar_to(self.c)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.b.delete()
+        self.assertEqual(island_partition(self.categories), {frozenset('A'), frozenset('C'), frozenset('D')})
+
+    def test_labels_are_member_ids(self):
+        self.a.mark_similar_to(self.b)
+        self.c.mark_similar_to(self.d)
+        self.b.mark_similar_to(self.c)
+        self.b.unmark_similar_to(self.c)
+        for category in Category.objects.all():
+            self.assertIn(category.island_id, Category.objects.filter(
+                island_id=category.island_id
+            ).values_list('id', flat=True))
+
+    def test_merging_reads_only_the_merged_labels(self):
+        """The cost of a merge does not grow with the size of the islands."""
+        def queries_to_merge(size):
+            ids = create_graph(size, [(0, index) for index in range(1, size)])
+            other = create_category(f'Other {size}')
+            with CaptureQueriesContext(connection) as queries:
+                Category.objects.get(id=ids[size // 2]).mark_similar_to(other)
+            other.refresh_from_db()
+            self.assertEqual(other.island_id, Category.objects.get(id=ids[0]).island_id)
+            return len(queries)
+
+        self.assertEqual(queries_to_merge(5), queries_to_merge(200))
+
+
+
+class DiameterTests(TestCase):
+    def setUp(self):
+        rng = random.Random(5)
+        # A long cycle with random chords, and a separate path
+        edges = {(index, index + 1) for index in range(39)} | {(0, 39)}
+        edges |= {tuple(sorted(rng.sample(range(40), 2))) for _ in range(6)}
+        edges |= {(index, index + 1) for index in range(40, 49)}
+        self.ids = create_graph(50, edges)
+        self.service = CategoryGraphService(storage='dict')
+
+    def brute_force_diameter(self):
+        graph = self.service.graph
+        return max(diameter.eccentricity(graph, node)[0] for node in graph.nodes())
+
+    def test_exact_diameter(self):
+        path = self.service.find_longest_rabbit_hole(exact=True)
+        self.assertEqual(len(path) - 1, self.brute_force_diameter())
+        self.assertEqual(len(self.service.find_shortest_path(path[0], path[-1])), len(path))
+
+    def test_exact_diameter_is_cached_per_version(self):
+        path = self.service.find_longest_rabbit_hole(exact=True)
+        with mock.patch.object(DiameterEngine, 'longest_path') as longest_path:
+            self.assertEqual(self.service.find_longest_rabbit_hole(exact=True), path)
+            longest_path.assert_not_called()
+
+    def test_exact_diameter_runs_outside_the_lock(self):
+        """Other threads can take the graph lock while the diameter is computed."""
+        longest_path = DiameterEngine.longest_path
+        acquired = []
+
+        def acquire_lock():
+            if self.service._lock.acquire(timeout=2):
+                self.service._lock.release()
+                acquired.append(True)
+
+        def longest_path_with_other_thread(engine, islands):
+            thread = threading.Thread(target=acquire_lock)
+            thread.start()
+            thread.join()
+            return longest_path(engine, islands)
+
+        with mock.patch.object(DiameterEngine, 'longest_path', longest_path_with_other_thread):
+            self.service.find_longest_rabbit_hole(exact=True)
+        self.assertEqual(acquired, [True])
+
+    def test_patches_during_the_computation_are_not_cached(self):
+        longest_path = DiameterEngine.longest_path
+
+        def longest_path_then_patch(engine, islands):
+            result = longest_path(engine, islands)
+            self.service.add_similarity(self.ids[0], self.ids[20])
+            return result
+
+        with mock.patch.object(DiameterEngine, 'longest_path', longest_path_then_patch):
+            self.service.find_longest_rabbit_hole(exact=True)
+        self.assertIsNone(self.service._exact_diameter)
+
+    def test_in_process_by_default(self):
+        self.assertEqual(DiameterEngine(self.service.graph).pool_size, 1)
+
+    def test_worker_processes_give_the_same_diameter(self):
+        graph = self.service.graph.snapshot()
+        islands = [list(island) for island in self.service._islands(graph)]
+        with mock.patch.object(diameter, 'PARALLEL_MIN_FRINGE', 1):
+            with DiameterEngine(graph, workers=2) as engine:
+                path = engine.longest_path(islands)
+                self.assertEqual(engine._executor._mp_context.get_start_method(), 'spawn')
+        self.assertEqual(len(path) - 1, self.brute_force_diameter())
+
+
+class SubtreeMoveTests(TestCase):
+    def setUp(self):
+        self.root = create_category('Root')
+        self.child = create_category('Child', parent=self.root)
+        self.grandchild = create_category('Grandchild', parent=self.child)
+        self.other_root = create_category('Other root')
+
+    def test_paths_and_depths(self):
+        self.assertEqual(self.grandchild.path, f'{self.root.id}/{self.child.id}/{self.grandchild.id}/')
+        self.assertEqual(self.grandchild.depth, 2)
+        self.assertEqual(
+            list(Category.objects.subtree(self.root.path).order_by('id')),
+            [self.root, self.child, self.grandchild],
+        )
+
+    def test_move_subtree(self):
+        self.child.parent = self.other_root
+        self.child.save()
+
+        self.grandchild.refresh_from_db()
+        self.assertEqual(self.grandchild.path, f'{self.other_root.id}/{self.child.id}/{self.grandchild.id}/')
+        self.assertEqual(self.grandchild.depth, 2)
+        self.assertEqual(list(Category.objects.subtree(self.root.path)), [self.root])
+
+        # And back up to the top level
+        self.child.parent = None
+        self.child.save()
+        self.grandchild.refresh_from_db()
+        self.assertEqual(self.grandchild.path, f'{self.child.id}/{self.grandchild.id}/')
+        self.assertEqual(self.grandchild.depth, 1)
+
+    def test_cycles_are_rejected(self):
+        for new_parent in (self.root, self.child, self.grandchild):
+            self.root.parent = new_parent
+            with self.assertRaises(ValueError):
+                self.root.save()
+
+        self.root.refresh_from_db()
+        self.grandchild.refresh_from_db()
+        self.assertIsNone(self.root.parent_id)
+        self.assertEqual(self.grandchild.path, f'{self.root.id}/{self.child.id}/{self.grandchild.id}/')
+
+    def test_deep_trees(self):
+        """Paths, and so the depth of the tree, are not bounded in length."""
+        parent = self.other_root
+        for depth in range(300):
+            parent = create_category(f'Level {depth}', parent=parent)
+        self.assertEqual(parent.depth, 300)
+
+        self.other_root.parent = self.grandchild
+        self.other_root.save()
+        parent.refresh_from_db()
+        self.assertEqual(parent.depth, 303)
+        self.assertTrue(parent.path.startswith(self.grandchild.path + f'{self.other_root.id}/'))
+        self.assertEqual(Category.objects.subtree(self.root.path).count(), 304)
+
+
+
+class TreeImportExportTests(TestCase):
+    ROWS = [
+        # Children before their parents, as an unsorted input may have them
+        {'id': 103, 'parent_id': 102, 'name': 'Grandchild', 'description': 'd', 'image': ''},
+        {'id': 102, 'parent_id': 101, 'name': 'Child', 'description': 'd', 'image': ''},
+        {'id': 104, 'parent_id': 101, 'name': 'Second child', 'description': 'd', 'image': ''},
+        {'id': 101, 'parent_id': None, 'name': 'Root', 'description': 'd', 'image': ''},
+    ]
+
+    def tree(self):
+        return list(Category.objects.order_by('id').values_list('id', 'parent_id', 'name', 'depth', 'path', 'island_id'))
+
+    def test_import(self):
+        self.assertEqual(Category.objects.bulk_import(self.ROWS, batch_size=2), 4)
+        self.assertEqual(self.tree(), [
+            (101, None, 'Root', 0, '101/', 101),
+            (102, 101, 'Child', 1, '101/102/', 102),
+            (103, 102, 'Grandchild', 2, '101/102/103/', 103),
+            (104, 101, 'Second child', 1, '101/104/', 104),
+        ])
+
+        # Under a parent imported earlier
+        Category.objects.bulk_import([{'id': 105, 'parent_id': 103, 'name': 'Leaf', 'description': 'd', 'image': ''}])
+        self.assertEqual(Category.objects.get(id=105).path, '101/102/103/105/')
+
+        # The sequence continues past the imported ids
+        self.assertGreater(create_category('New').id, 105)
+
+    def test_unknown_parents_are_rejected(self):
+        rows = self.ROWS + [{'id': 106, 'parent_id': 999, 'name': 'Orphan', 'description': 'd', 'image': ''}]
+        with self.assertRaises(ValueError):
+            Category.objects.bulk_import(rows)
+        self.assertFalse(Category.objects.exists())
+
+    def test_export_and_import_round_trip(self):
+        Category.objects.bulk_import(self.ROWS)
+        tree = self.tree()
+
+        for file_format in ('jsonl', 'csv'):
+            with self.subTest(file_format=file_format), tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, f'tree.{file_format}')
+                call_command('category_tree', mode='export', format=file_format, file=path, stderr=io.StringIO())
+                with open(path, encoding='utf-8') as export:
+                    names = [line for line in export if 'Root' in line or 'Grandchild' in line]
+                # Parents first
+                self.assertIn('Root', names[0])
+
+                Category.objects.all().delete()
+                call_command('category_tree', mode='import', format=file_format, file=path, stderr=io.StringIO())
+                self.assertEqual(self.tree(), tree)
+
+
+class RabbitIslandsViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Islands {0, 1, 2}, {3, 4} and {5}
+        self.ids = create_graph(6, [(0, 1), (1, 2), (3, 4)])
+
+    def get_json(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content))
+
+    def islands(self):
+        islands = {}
+        for cat_id, label in Category.objects.order_by('id').values_list('id', 'island_id'):
+            islands.setdefault(label, []).append(cat_id)
+        return islands
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        return len(queries)
+
+    def test_islands_page(self):
+        response = self.client.get('/categories/getRabbitIslands/')
+        self.assertContains(response, 'Total islands: 3')
+
+    def test_queries_do_not_grow_with_the_islands(self):
+        for url in ('/categories/getRabbitIslands/', '/categories/getRabbitIslandsJson/'):
+            with self.subTest(url=url):
+                before = self.count_queries(url)
+                create_graph(10, [(0, 1), (2, 3), (4, 5)])
+                self.assertEqual(self.count_queries(url), before)
+
+    def test_json_pages(self):
+        first = self.get_json('/categories/getRabbitIslandsJson/?limit=2')
+        second = self.get_json(f'/categories/getRabbitIslandsJson/?limit=2&after={first["next_after"]}')
+
+        islands = first['islands'] + second['islands']
+        self.assertIsNone(second['next_after'])
+        self.assertEqual(
+            {island['island_id']: [category['id'] for category in island['categories']] for island in islands},
+            self.islands(),
+        )
+        self.assertEqual(sorted(island['size'] for island in islands), [1, 2, 3])
+        self.assertEqual(islands[0]['categories'][0]['name'], Category.objects.get(id=islands[0]['categories'][0]['id']).name)
+
+
+class SimilarCategoriesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # 0 is similar to 1, 2 and 3; 4 has no similar categories
+        self.ids = create_graph(5, [(0, 1), (2, 0), (0, 3), (1, 2)])
+
+    def test_similar_is_a_queryset(self):
+        category = Category.objects.get(id=self.ids[0])
+        self.assertEqual(sorted(category.similar.values_list('id', flat=True)), self.ids[1:4])
+        self.assertEqual(category.similar.filter(id=self.ids[2]).count(), 1)
+        self.assertFalse(Category.objects.get(id=self.ids[4]).similar.exists())
+
+    @staticmethod
+    def similar_ids(categories):
+        return {category.id: [similar.id for similar in category.similar_categories] for category in categories}
+
+    def test_prefetched_similar_categories(self):
+        expected = self.similar_ids(Category.objects.all())
+        self.assertEqual(expected[self.ids[0]], self.ids[1:4])
+
+        with self.assertNumQueries(3):
+            self.assertEqual(self.similar_ids(Category.objects.with_similar()), expected)
+
+        categories = list(Category.objects.all())
+        with self.assertNumQueries(2):
+            prefetch_similar(categories)
+            self.assertEqual(self.similar_ids(categories), expected)
+
+    def test_similarity_degrees(self):
+        degrees = dict(Category.objects.values_list('id', 'similarity_degree'))
+        self.assertEqual([degrees[cat_id] for cat_id in self.ids], [3, 2, 2, 1, 0])
+
+        Category.objects.get(id=self.ids[0]).unmark_similar_to(Category.objects.get(id=self.ids[1]))
+        Category.objects.get(id=self.ids[4]).mark_similar_to(Category.objects.get(id=self.ids[3]))
+        degrees = dict(Category.objects.values_list('id', 'similarity_degree'))
+        self.assertEqual([degrees[cat_id] for cat_id in self.ids], [2, 1, 2, 2, 1])
+
+        Category.objects.update(similarity_degree=0)
+        Category.objects.refresh_similarity_degrees()
+        self.assertEqual(dict(Category.objects.values_list('id', 'similarity_degree')), degrees)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_pages_show_similar_categories_in_constant_queries(self):
+        for url in ('/categories/', f'/categories/{self.ids[0]}/'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                for cat_id in self.ids[1:4]:
+                    self.assertContains(response, f'href="/categories/{cat_id}/"')
+
+                before = self.count_queries(url)
+                create_graph(10, [(index, index + 1) for index in range(9)])
+                mark_similar_many((self.ids[0], cat_id) for cat_id in Category.objects.values_list('id', flat=True)[5:])
+                self.assertEqual(self.count_queries(url), before)
+
+    def test_missing_category(self):
+        self.assertEqual(self.client.get(f'/categories/{self.ids[-1] + 100}/').status_code, 404)
+
+
+class CategoryListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.root = create_category('Root')
+        self.children = [create_category(f'Child {index}', parent=self.root) for index in range(5)]
+
+    def test_keyset_pages(self):
+        ids = []
+        url = '/categories/?limit=2'
+        while url:
+            response = self.client.get(url)
+            page = response.context['categories']
+            self.assertLessEqual(len(page), 2)
+            ids += [category.id for category in page]
+            next_after = response.context['next_after']
+            url = f'/categories/?limit=2&after={next_after}' if next_after else None
+        self.assertEqual(ids, list(Category.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_child_counts(self):
+        response = self.client.get(f'/categoriesByParent/{self.root.id}/')
+        self.assertEqual([category.id for category in response.context['categories']], [child.id for child in self.children])
+
+        response = self.client.get('/categoriesByDepth/0/')
+        self.assertEqual([(category.id, category.child_count) for category in response.context['categories']], [(self.root.id, 5)])
+
+    def test_limits_are_clamped(self):
+        self.assertEqual(len(self.client.get('/categories/?limit=0').context['categories']), 1)
+        self.assertEqual(self.client.get('/categories/?limit=100000').context['limit'], 1000)
+
+    def test_malformed_integers_are_rejected(self):
+        category = create_category('A')
+        for url in (
+            '/categories/?after=x',
+            '/categories/?limit=abc',
+            '/categories/getRabbitIslandsJson/?limit=1.5',
+            f'/categories/getNeighborhood/{category.id}/?k=two',
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 400)
+
+        self.assertEqual(self.client.get(f'/categories/getNeighborhood/{category.id}/?k=99&limit=').status_code, 200)
+
+
+class GraphSnapshotTests(TestCase):
+    def setUp(self):
+        self.ids = create_graph(6, [(0, 1), (1, 2), (3, 4)])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'graph.snapshot')
+
+    def assertSameGraph(self, graph, expected):
+        self.assertEqual(list(graph.ids), list(expected.ids))
+        self.assertEqual(list(graph.indptr), list(expected.indptr))
+        self.assertEqual(list(graph.indices), list(expected.indices))
+
+    def test_round_trip(self):
+        _, version = graph_snapshot.build_snapshot(self.path)
+        graph, loaded_version = graph_snapshot.load_snapshot(self.path)
+
+        self.assertEqual(loaded_version, version)
+        self.assertSameGraph(graph, CategoryGraphService(storage='csr').graph)
+
+    def test_stale_and_broken_snapshots_are_rebuilt(self):
+        graph_snapshot.build_snapshot(self.path)
+        mark_similar_many([(self.ids[2], self.ids[3])])
+
+        graph = graph_snapshot.load_current_snapshot(self.path)
+        self.assertEqual(graph.edge_count(), 4)
+        self.assertEqual(graph_snapshot.read_header(self.path)[2], graph_snapshot.database_version())
+
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b'not a snapshot')
+        with self.assertRaises(graph_snapshot.SnapshotError):
+            graph_snapshot.load_snapshot(self.path)
+        self.assertEqual(graph_snapshot.load_current_snapshot(self.path).edge_count(), 4)
+
+    def test_mmap_storage(self):
+        with override_settings(CATEGORY_GRAPH_SNAPSHOT_PATH=self.path):
+            service = CategoryGraphService(storage='mmap')
+            self.assertEqual(service.find_shortest_path(self.ids[0], self.ids[2]), self.ids[:3])
+            self.assertIsNone(service.find_shortest_path(self.ids[0], self.ids[3]))
+
+            # Notified of a write, it maps a rebuilt snapshot on next use
+            mark_similar_many([(self.ids[2], self.ids[3])])
+            service.add_similarity(self.ids[2], self.ids[3])
+            self.assertEqual(service.find_shortest_path(self.ids[0], self.ids[4]), self.ids[:5])
+
+    def test_command(self):
+        stdout = io.StringIO()
+        call_command('build_graph_snapshot', path=self.path, stdout=stdout)
+        self.assertIn('6 categories, 3 similarities', stdout.getvalue())
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        self.ids = create_graph(5, [(0, 1), (1, 2), (3, 4)])
+        # Built here, as the executor threads can not see the test transaction
+        get_graph_service(rebuild=True)
+
+    def assertSameResponse(self, sync_url, async_url):
+        cache.clear()
+        sync_response = self.client.get(sync_url)
+        async_response = self.client.get(async_url)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(async_response.content, sync_response.content)
+
+    def test_async_views_match_the_sync_views(self):
+        start, end = self.ids[0], self.ids[2]
+        self.assertSameResponse(
+            f'/categories/getRabbitHole/{start}/{end}/',
+            f'/categories/async/getRabbitHole/{start}/{end}/',
+        )
+        self.assertSameResponse(
+            f'/categories/getRabbitHole/{start}/{self.ids[3]}/',
+            f'/categories/async/getRabbitHole/{start}/{self.ids[3]}/',
+        )
+        self.assertSameResponse('/categories/getRabbitIslands/', '/categories/async/getRabbitIslands/')
+        self.assertSameResponse('/categories/getLongestRabbitHole/', '/categories/async/getLongestRabbitHole/')
+
+    def test_executor_work_closes_stale_connections(self):
+        with mock.patch('categories.graph_service.close_old_connections') as close_old_connections:
+            self.assertEqual(async_to_sync(run_in_graph_executor)(sum, [1, 2]), 3)
+        self.assertEqual(close_old_connections.call_count, 2)
+
+    def test_concurrent_requests_share_one_build(self):
+        reset_graph_service()
+        started = threading.Event()
+
+        def slow_build():
+            started.wait(1)
+            return 'service'
+
+        async def requests():
+            pending = [asyncio.ensure_future(aget_graph_service()) for _ in range(5)]
+            await asyncio.sleep(0)
+            started.set()
+            return await asyncio.gather(*pending)
+
+        with mock.patch('categories.graph_service.get_graph_service', side_effect=slow_build) as build:
+            self.assertEqual(async_to_sync(requests)(), ['service'] * 5)
+        self.assertEqual(build.call_count, 1)
+
+
+class SimilarityBatchTests(TestCase):
+    def setUp(self):
+        self.a, self.b, self.c, self.d, self.e = (create_category(name) for name in 'ABCDE')
+        self.categories = [self.a, self.b, self.c, self.d, self.e]
+
+    def degrees(self):
+        return dict(Category.objects.values_list('name', 'similarity_degree'))
+
+    def test_mark_similar_many(self):
+        a, b, c, d, e = (category.id for category in self.categories)
+        created = mark_similar_many([(a, b), (c, b), (d, e), (b, a)])
+
+        self.assertEqual(created, 3)
+        self.assertEqual(CategorySimilarity.objects.count(), 3)
+        self.assertEqual(self.degrees(), {'A': 1, 'B': 2, 'C': 1, 'D': 1, 'E': 1})
+        self.assertEqual(island_partition(self.categories), {frozenset('ABC'), frozenset('DE')})
+
+        # Stored pairs are skipped, whatever their order
+        self.assertEqual(mark_similar_many([(b, a), (e, d)], chunk_size=1), 0)
+        self.assertEqual(self.degrees(), {'A': 1, 'B': 2, 'C': 1, 'D': 1, 'E': 1})
+
+    def test_mark_similar_many_in_chunks(self):
+        ids = [category.id for category in self.categories]
+        created = mark_similar_many(zip(ids, ids[1:]), chunk_size=2)
+
+        self.assertEqual(created, 4)
+        self.assertEqual(self.degrees(), {'A': 1, 'B': 2, 'C': 2, 'D': 2, 'E': 1})
+        self.assertEqual(island_partition(self.categories), {frozenset('ABCDE')})
+
+    def test_mark_similar_many_rejects_bad_pairs(self):
+        with self.assertRaises(ValueError):
+            mark_similar_many([(self.a.id, self.b.id), (self.c.id, self.c.id)])
+        with self.assertRaises(ValueError):
+            mark_similar_many([(self.a.id, self.b.id), (self.c.id, self.e.id + 1000)])
+
+        # Nothing written
+        self.assertFalse(CategorySimilarity.objects.exists())
+        self.assertEqual(set(self.degrees().values()), {0})
+
+    def test_endpoints_are_locked_before_the_lookup(self):
+        calls = []
+        lock, existing = CategoryQuerySet.lock, similarity_io._existing
+
+        def record_lock(queryset):
+            calls.append('lock')
+            return lock(queryset)
+
+        def record_lookup(pairs):
+            calls.append('lookup')
+            return existing(pairs)
+
+        with mock.patch.object(CategoryQuerySet, 'lock', autospec=True, side_effect=record_lock), \
+                mock.patch.object(similarity_io, '_existing', side_effect=record_lookup):
+            mark_similar_many([(self.a.id, self.b.id)])
+            unmark_similar_many([(self.a.id, self.b.id)])
+        self.assertEqual(calls, ['lock', 'lookup', 'lock', 'lookup'])
+
+    def test_unmark_similar_many(self):
+        a, b, c, d, e = (category.id for category in self.categories)
+        mark_similar_many([(a, b), (b, c), (c, d), (d, e)])
+
+        deleted = unmark_similar_many([(c, b), (d, e), (a, e)], chunk_size=2)
+
+        self.assertEqual(deleted, 2)
+        self.assertEqual(sorted(CategorySimilarity.objects.values_list('category_a_id', 'category_b_id')), [(a, b), (c, d)])
+        self.assertEqual(self.degrees(), {'A': 1, 'B': 1, 'C': 1, 'D': 1, 'E': 0})
+        self.assertEqual(island_partition(self.categories), {frozenset('AB'), frozenset('CD'), frozenset('E')})
+
+    def test_merge_similarities(self):
+        a, b, c, d, e = (category.id for category in self.categories)
+        mark_similar_many([(a, b), (a, c), (b, c), (d, e)])
+
+        created, deleted = merge_similarities([a, b], e)
+
+        self.assertEqual((created, deleted), (1, 3))
+        self.assertEqual(sorted(CategorySimilarity.objects.values_list('category_a_id', 'category_b_id')), [(c, e), (d, e)])
+        self.assertEqual(self.degrees(), {'A': 0, 'B': 0, 'C': 1, 'D': 1, 'E': 2})
+        self.assertEqual(island_partition(self.categories), {frozenset('A'), frozenset('B'), frozenset('CDE')})
+
+    def test_ingest_endpoint(self):
+        a, b, c = self.a.id, self.b.id, self.c.id
+        body = f'{{"category_a_id": {a}, "category_b_id": {b}}}\n{{"category_a_id": {c}, "category_b_id": {b}}}\n'
+        response = self.client.post('/categories/similarities/ingest/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.json(), {'action': 'mark', 'count': 2})
+
+        response = self.client.post(
+            '/categories/similarities/ingest/?action=unmark&format=csv',
+            f'category_a_id,category_b_id\n{b},{a}\n',
+            content_type='text/csv',
+        )
+        self.assertEqual(response.json(), {'action': 'unmark', 'count': 1})
+        self.assertEqual(island_partition(self.categories), {frozenset('A'), frozenset('BC'), frozenset('D'), frozenset('E')})
+
+        response = self.client.post('/categories/similarities/ingest/', f'{{"category_a_id": {a}}}\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+
+
+class SQLGraphTests(TestCase):
+    def setUp(self):
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        # A chain 0 - ... - 11, longer than the first depth limit, and 12 - 13 apart
+        self.ids = create_graph(14, [(index, index + 1) for index in range(11)] + [(12, 13)])
+
+    def test_paths_longer_than_the_first_depth_limit(self):
+        service = SQLGraphService()
+        self.assertEqual(service.find_shortest_path(self.ids[0], self.ids[11]), self.ids[:12])
+        self.assertEqual(service.find_shortest_path(self.ids[11], self.ids[9]), self.ids[9:12][::-1])
+        self.assertIsNone(service.find_shortest_path(self.ids[0], self.ids[12]))
+        self.assertIsNone(service.find_shortest_path(self.ids[0], self.ids[-1] + 1000))
+
+    def test_paths_need_no_python_graph(self):
+        # Reads the labels, the island size, then one traversal
+        service = SQLGraphService()
+        with self.assertNumQueries(3):
+            service.find_shortest_path(self.ids[0], self.ids[3])
+
+    def test_diameter(self):
+        service = SQLGraphService()
+        self.assertEqual(sorted(service.find_longest_rabbit_hole()), self.ids[:12])
+        self.assertEqual(len(service.find_longest_rabbit_hole(exact=True)), 12)
+
+    def test_write_notifications_bump_the_version(self):
+        service = SQLGraphService()
+        version = service.version
+        service.add_similarity(self.ids[11], self.ids[12])
+        self.assertGreater(service.version, version)
+
+    def test_engine_is_picked_by_storage_or_size(self):
+        self.assertIsInstance(get_graph_service(rebuild=True), CategoryGraphService)
+        with override_settings(CATEGORY_GRAPH_SQL_THRESHOLD=12):
+            self.assertIsInstance(get_graph_service(rebuild=True), SQLGraphService)
+        with override_settings(CATEGORY_GRAPH_STORAGE='sql'):
+            self.assertIsInstance(get_graph_service(rebuild=True), SQLGraphService)
+        self.assertIsInstance(get_graph_service(rebuild=True), CategoryGraphService)
+
+
+class SeedTests(TestCase):
+    def seed(self, **options):
+        stdout = io.StringIO()
+        call_command('seed', mode='refresh', nodes=40, roots=4, edges=60, islands=3, seed=7, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_refresh(self):
+        output = self.seed()
+
+        categories = list(Category.objects.order_by('id').values_list('name', flat=True))
+        self.assertEqual(len(categories), 46)
+        self.assertEqual(categories[:6], list('ABCDEF'))
+
+        # The five example similarities are not reported as generated ones
+        generated = CategorySimilarity.objects.count() - 5
+        self.assertIn(f'Actual unique similarities created: {generated} across 3 islands', output)
+        self.assertEqual(Category.objects.island_sizes().count(), 2 + 3)
+
+    def test_seed_is_deterministic(self):
+        def edges():
+            # Relative to the first id, which moves on with every refresh
+            first_id = Category.objects.order_by('id').values_list('id', flat=True).first()
+            return sorted(
+                (id_a - first_id, id_b - first_id)
+                for id_a, id_b in CategorySimilarity.objects.values_list('category_a_id', 'category_b_id')
+            )
+
+        self.seed()
+        first = edges()
+        self.seed()
+        self.assertEqual(edges(), first)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        self.ids = create_graph(4, [(0, 1), (1, 2)])
+
+    def test_server_timing_header(self):
+        response = self.client.get(f'/categories/getRabbitHole/{self.ids[0]}/{self.ids[2]}/')
+        timing = response['Server-Timing']
+        self.assertIn('graph_traversal;dur=', timing)
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('total;dur=', timing)
+
+    def test_metrics(self):
+        self.client.get(f'/categories/getRabbitHole/{self.ids[0]}/{self.ids[2]}/')
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_similar_many([(self.ids[2], self.ids[3])])
+
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('category_request_duration_seconds_count{view="categories.getRabbitHole"}', body)
+        self.assertIn('category_graph_nodes{storage="dict"} 4', body)
+        self.assertIn('category_graph_edges{storage="dict"} 3', body)
+
+    def test_sizes_are_kept_current_by_patches(self):
+        graph = get_graph_service().graph
+        graph.add_edge(self.ids[0], self.ids[3])
+        graph.remove_edge(self.ids[0], self.ids[1])
+        graph.remove_node(self.ids[2])
+        graph.add_node(self.ids[3] + 1)
+
+        # The same sizes as counted from scratch
+        sizes = graph.edge_count(), graph.memory_bytes()
+        graph._count()
+        self.assertEqual((graph.edge_count(), graph.memory_bytes()), sizes)
+        self.assertEqual(sizes[0], 1)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        self.ids = create_graph(3, [(0, 1)])
+        self.url = f'/categories/getRabbitHole/{self.ids[0]}/{self.ids[2]}/'
+
+    def test_repeated_request_is_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # One primary key lookup, no body
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_body_is_served_from_the_cache(self):
+        first = self.client.get(self.url)
+        with mock.patch('categories.views.get_graph_service') as graph_service:
+            second = self.client.get(self.url)
+        graph_service.assert_not_called()
+        self.assertEqual(second.content, first.content)
+
+    def test_writes_invalidate(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(response.json()['path'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_similar_many([(self.ids[1], self.ids[2])])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([step['id'] for step in response.json()['path']], self.ids)
+
+    def test_async_view_is_not_modified(self):
+        url = f'/categories/async/getRabbitHole/{self.ids[0]}/{self.ids[1]}/'
+        get_graph_service(rebuild=True)
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class NeighborhoodTests(TestCase):
+    # 0 - 1 - 3 - 4 and 0 - 2 - 3, with 5 apart
+    EDGES = [(0, 1), (0, 2), (1, 3), (2, 3), (3, 4)]
+
+    def setUp(self):
+        cache.clear()
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        self.ids = create_graph(6, self.EDGES)
+
+    def services(self):
+        return {
+            'dict': CategoryGraphService(storage='dict'),
+            'csr': CategoryGraphService(storage='csr'),
+            'sql': SQLGraphService(),
+        }
+
+    def test_levels_by_distance(self):
+        ids = self.ids
+        for storage, service in self.services().items():
+            with self.subTest(storage=storage):
+                self.assertEqual(service.neighborhood(ids[0], 1), ([[ids[1], ids[2]]], False))
+                self.assertEqual(service.neighborhood(ids[0], 6), ([[ids[1], ids[2]], [ids[3]], [ids[4]]], False))
+                self.assertEqual(service.neighborhood(ids[5], 2), ([], False))
+                self.assertEqual(service.neighborhood(ids[5] + 1000, 2), (None, False))
+
+    def test_limit_keeps_the_nearest_and_lowest_ids(self):
+        ids = self.ids
+        for storage, service in self.services().items():
+            with self.subTest(storage=storage):
+                self.assertEqual(service.neighborhood(ids[0], 3, limit=3), ([[ids[1], ids[2]], [ids[3]]], True))
+                self.assertEqual(service.neighborhood(ids[0], 3, limit=1), ([[ids[1]]], True))
+                self.assertEqual(service.neighborhood(ids[0], 3, limit=4)[1], False)
+
+    def test_endpoint(self):
+        ids = self.ids
+        response = self.client.get(f'/categories/getNeighborhood/{ids[4]}/?k=2&limit=10')
+        self.assertEqual(response.json(), {
+            'id': ids[4],
+            'k': 2,
+            'limit': 10,
+            'truncated': False,
+            'hops': [
+                {'distance': 1, 'categories': [{'id': ids[3], 'name': '3'}]},
+                {'distance': 2, 'categories': [{'id': ids[1], 'name': '1'}, {'id': ids[2], 'name': '2'}]},
+            ],
+        })
+        self.assertEqual(self.client.get(f'/categories/getNeighborhood/{ids[5] + 1000}/').status_code, 404)
+
+
+class LandmarkTests(TestCase):
+    def setUp(self):
+        rng = random.Random(5)
+        self.ids = create_graph(80, {tuple(sorted(rng.sample(range(80), 2))) for _ in range(120)})
+        self.exact = CategoryGraphService(storage='dict')
+
+    def landmark_service(self, storage):
+        service = CategoryGraphService(storage=storage, landmarks=3)
+        service.landmark_min_island = 2
+        service.build_landmarks()
+        return service
+
+    def pairs(self):
+        rng = random.Random(6)
+        return [tuple(rng.sample(self.ids, 2)) for _ in range(150)]
+
+    def test_bounds_contain_the_distance(self):
+        for storage in ('dict', 'csr'):
+            service = self.landmark_service(storage)
+            self.assertIsNotNone(service.landmark_stats())
+            for id_a, id_b in self.pairs():
+                path = self.exact.find_shortest_path(id_a, id_b)
+                with self.subTest(storage=storage, id_a=id_a, id_b=id_b):
+                    bounds = service.distance_bounds(id_a, id_b)
+                    if path is None:
+                        self.assertIsNone(bounds)
+                    else:
+                        self.assertLessEqual(bounds[0], len(path) - 1)
+                        self.assertGreaterEqual(bounds[1], len(path) - 1)
+
+    def test_landmark_search_finds_shortest_paths(self):
+        for storage in ('dict', 'csr'):
+            service = self.landmark_service(storage)
+            service.landmark_search = True
+            for id_a, id_b in self.pairs():
+                expected = self.exact.find_shortest_path(id_a, id_b)
+                path = service.find_shortest_path(id_a, id_b)
+                with self.subTest(storage=storage, id_a=id_a, id_b=id_b):
+                    if expected is None:
+                        self.assertIsNone(path)
+                        continue
+                    self.assertEqual((path[0], path[-1], len(path)), (id_a, id_b, len(expected)))
+                    for node_a, node_b in zip(path, path[1:]):
+                        self.assertIn(node_b, self.exact.graph.neighbors(node_a))
+
+    def test_patches_retire_the_index(self):
+        service = self.landmark_service('dict')
+        service.add_similarity(self.ids[0], self.ids[1])
+        service.remove_similarity(self.ids[0], self.ids[1])
+        self.assertIsNone(service.landmark_stats())
+
+        # Rebuilt for the new version on next use
+        service.distance_bounds(self.ids[0], self.ids[2])
+        self.assertIsNotNone(service.landmark_stats())
+
+
+class TreeIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # The tree version restarts in every test, so an index left behind could look current
+        reset_tree_index()
+        self.addCleanup(reset_tree_index)
+        self.root = create_category('Root')
+        self.child = create_category('Child', parent=self.root)
+        self.grandchild = create_category('Grandchild', parent=self.child)
+        self.sibling = create_category('Sibling', parent=self.root)
+        self.other_root = create_category('Other root')
+
+    def breadcrumb_names(self, category):
+        return [crumb.name for crumb in Category.objects.get(id=category.id).breadcrumbs()]
+
+    def test_hierarchy_queries(self):
+        tree = get_tree_index()
+        self.assertEqual(tree.ancestor_ids(self.grandchild.id), [self.root.id, self.child.id])
+        self.assertEqual(tree.descendant_ids(self.root.id), [self.child.id, self.grandchild.id, self.sibling.id])
+        self.assertEqual(tree.subtree_size(self.root.id), 3)
+        self.assertTrue(self.grandchild.is_descendant_of(self.root))
+        self.assertFalse(self.root.is_descendant_of(self.grandchild))
+        self.assertFalse(self.sibling.is_descendant_of(self.child))
+
+        # Current: one primary key lookup of the tree version
+        with self.assertNumQueries(1):
+            self.assertIs(get_tree_index(), tree)
+
+    def test_breadcrumbs_after_a_subtree_move(self):
+        self.assertEqual(self.breadcrumb_names(self.grandchild), ['Root', 'Child', 'Grandchild'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.child.parent = self.other_root
+            self.child.save()
+
+        self.assertEqual(self.breadcrumb_names(self.grandchild), ['Other root', 'Child', 'Grandchild'])
+        self.assertEqual(get_tree_index().subtree_size(self.root.id), 1)
+        self.assertTrue(self.grandchild.is_descendant_of(self.other_root))
+
+    def test_endpoint(self):
+        url = f'/categories/getBreadcrumbs/{self.grandchild.id}/'
+        self.assertEqual(
+            [(crumb['name'], crumb['depth'], crumb['descendants']) for crumb in self.client.get(url).json()['breadcrumbs']],
+            [('Root', 0, 3), ('Child', 1, 1), ('Grandchild', 2, 0)],
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.child.parent = self.sibling
+            self.child.save()
+        self.assertEqual(
+            [crumb['name'] for crumb in self.client.get(url).json()['breadcrumbs']],
+            ['Root', 'Sibling', 'Child', 'Grandchild'],
+        )
+        self.assertEqual(self.client.get(f'/categories/getBreadcrumbs/{self.other_root.id + 1000}/').status_code, 404)
+
+
+class CatchUpTests(TestCase):
+    def setUp(self):
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        self.a = create_category('A')
+        self.b = create_category('B')
+        self.graph = get_graph_service(rebuild=True)
+
+    def write_elsewhere(self, write):
+        """Runs write without the callbacks that patch this graph, as another process would."""
+        with self.captureOnCommitCallbacks(execute=False):
+            return write()
+
+    def test_catch_up_replays_changes_logged_elsewhere(self):
+        c = self.write_elsewhere(lambda: create_category('C'))
+        self.write_elsewhere(lambda: mark_similar_many([(self.a.id, self.b.id), (self.b.id, c.id)]))
+        self.assertIsNone(self.graph.find_shortest_path(self.a.id, c.id))
+
+        self.assertEqual(self.graph.catch_up(), 3)
+        self.assertEqual(self.graph.find_shortest_path(self.a.id, c.id), [self.a.id, self.b.id, c.id])
+        self.assertEqual(self.graph.catch_up(), 0)
+
+        self.write_elsewhere(lambda: unmark_similar_many([(self.a.id, self.b.id)]))
+        self.graph.catch_up()
+        self.assertIsNone(self.graph.find_shortest_path(self.a.id, c.id))
+
+    def test_rebuilds_when_the_log_can_not_be_replayed(self):
+        cases = {
+            'reset': lambda: GraphChange.log(GraphChange.RESET),
+            'compacted': lambda: GraphChange.compact(timezone.now() + datetime.timedelta(days=1)),
+        }
+        for case, write in cases.items():
+            with self.subTest(case=case):
+                self.write_elsewhere(lambda: mark_similar_many([(self.a.id, self.b.id)]))
+                self.write_elsewhere(lambda: create_category('C'))
+                write()
+                self.assertIsNone(self.graph.catch_up())
+                self.assertEqual(self.graph.find_shortest_path(self.a.id, self.b.id), [self.a.id, self.b.id])
+                self.write_elsewhere(lambda: unmark_similar_many([(self.a.id, self.b.id)]))
+                self.graph.catch_up()
+
+        # More entries pending than allowed, the overlap left out
+        with override_settings(CATEGORY_GRAPH_CATCH_UP_MAX=1), mock.patch('categories.graph_service.CHANGE_LOG_OVERLAP', 0):
+            self.write_elsewhere(lambda: mark_similar_many([(self.a.id, self.b.id)]))
+            self.write_elsewhere(lambda: create_category('D'))
+            self.assertIsNone(self.graph.catch_up())
+
+    def test_shared_service_catches_up_on_interval(self):
+        self.write_elsewhere(lambda: mark_similar_many([(self.a.id, self.b.id)]))
+        self.assertIsNone(get_graph_service().find_shortest_path(self.a.id, self.b.id))
+
+        with override_settings(CATEGORY_GRAPH_CATCH_UP_INTERVAL=0):
+            self.assertIs(get_graph_service(), self.graph)
+        self.assertEqual(self.graph.find_shortest_path(self.a.id, self.b.id), [self.a.id, self.b.id])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        for name in ('Cat food recipes', 'Cats', 'Dog food', 'Scattered cats'):
+            create_category(name)
+
+    def names(self, query, limit=10):
+        return [name for _, name in search_categories(query, limit)]
+
+    def test_ranked_prefix_matches(self):
+        self.assertEqual(self.names('cat'), ['Cats', 'Scattered cats', 'Cat food recipes'])
+        self.assertEqual(self.names('fo'), ['Dog food', 'Cat food recipes'])
+        self.assertEqual(self.names('cat foo'), ['Cat food recipes'])
+        self.assertEqual(self.names('cat', limit=1), ['Cats'])
+        # Query syntax is treated as words
+        self.assertEqual(self.names('"cat" AND NEAR('), [])
+        self.assertEqual(self.names('  '), [])
+
+    def test_index_follows_renames_and_deletes(self):
+        category = Category.objects.get(name='Dog food')
+        category.name = 'Parrot seeds'
+        category.save()
+        self.assertEqual(self.names('dog'), [])
+        self.assertEqual(self.names('parr'), ['Parrot seeds'])
+
+        category.delete()
+        self.assertEqual(self.names('parr'), [])
+
+    def test_missing_triggers_are_recreated(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER categories_category_fts_update')
+        Category.objects.filter(name='Cats').update(name='Kittens')
+
+        self.assertEqual(ensure_search_triggers(), ['categories_category_fts_update'])
+        self.assertEqual(self.names('kit'), ['Kittens'])
+        self.assertEqual(ensure_search_triggers(), [])
+
+    def test_filter_by_name(self):
+        queryset = filter_by_name(Category.objects.order_by('name'), 'food')
+        self.assertEqual([category.name for category in queryset], ['Cat food recipes', 'Dog food'])
+
+    def test_endpoint(self):
+        response = self.client.get('/categories/search/?q=dog&limit=5')
+        self.assertEqual(response.json(), {
+            'query': 'dog',
+            'results': [{'id': Category.objects.get(name='Dog food').id, 'name': 'Dog food'}],
+        })
+
+
+class ShortestPathsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_graph_service()
+        self.addCleanup(reset_graph_service)
+        rng = random.Random(8)
+        self.ids = create_graph(60, {tuple(sorted(rng.sample(range(60), 2))) for _ in range(80)})
+        self.exact = CategoryGraphService(storage='dict')
+
+        # Many pairs from one start, many to one end, and a few odd ones
+        rng = random.Random(9)
+        self.pairs = (
+            [(self.ids[0], end_id) for end_id in self.ids]
+            + [(start_id, self.ids[1]) for start_id in rng.sample(self.ids, 20)]
+            + [(self.ids[2], self.ids[2]), (self.ids[3], max(self.ids) + 1)]
+        )
+
+    def assertSamePaths(self, paths, pairs):
+        self.assertEqual(len(paths), len(pairs))
+        for (start_id, end_id), path in zip(pairs, paths):
+            expected = self.exact.find_shortest_path(start_id, end_id)
+            with self.subTest(start_id=start_id, end_id=end_id):
+                if expected is None:
+                    self.assertIsNone(path)
+                    continue
+                self.assertEqual((path[0], path[-1], len(path)), (start_id, end_id, len(expected)))
+                for id_a, id_b in zip(path, path[1:]):
+                    self.assertIn(id_b, self.exact.graph.neighbors(id_a))
+
+    def test_same_paths_as_one_by_one(self):
+        services = {
+            'dict': CategoryGraphService(storage='dict'),
+            'csr': CategoryGraphService(storage='csr'),
+            'sql': SQLGraphService(),
+        }
+        for storage, service in services.items():
+            with self.subTest(storage=storage):
+                self.assertSamePaths(service.find_shortest_paths(self.pairs), self.pairs)
+                self.assertEqual(service.find_shortest_paths([]), [])
+
+    def post(self, pairs):
+        return self.client.post('/categories/getRabbitHoles/', json.dumps({'pairs': pairs}), content_type='application/json')
+
+    def test_endpoint(self):
+        pairs = self.pairs[:5] + self.pairs[-2:]
+        results = self.post(pairs).json()['results']
+        self.assertSamePaths([[step['id'] for step in result['path']] or None for result in results], pairs)
+        self.assertEqual([(result['start_id'], result['end_id']) for result in results], pairs)
+
+        # The names of every path are loaded with one query
+        with CaptureQueriesContext(connection) as few_pairs:
+            self.post(pairs)
+        with CaptureQueriesContext(connection) as many_pairs:
+            self.post(self.pairs)
+        self.assertEqual(len(many_pairs), len(few_pairs))
+
+    def test_bad_requests(self):
+        for body in ('not json', '{}', '{"pairs": [[1]]}', '{"pairs": [["a", 2]]}'):
+            with self.subTest(body=body):
+                response = self.client.post('/categories/getRabbitHoles/', body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+
+        with mock.patch('categories.views.RABBIT_HOLES_MAX_PAIRS', 2):
+            self.assertEqual(self.post(self.pairs[:3]).status_code, 400)
+        self.assertEqual(self.client.get('/categories/getRabbitHoles/').status_code, 405)
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        for index in range(12):
+            create_category(f'Category {index}', parent=None)
+
+    def test_small_tables_are_counted(self):
+        paginator = EstimatedCountPaginator(Category.objects.order_by('id'), 5)
+        self.assertEqual(paginator.count, 12)
+        self.assertTrue(paginator.exact)
+        self.assertEqual(len(paginator.page(3)), 2)
+
+    def test_large_tables_are_estimated(self):
+        # The estimate on SQLite is the highest id
+        top_id = Category.objects.order_by('-id').values_list('id', flat=True)[0]
+        with mock.patch('categories.admin.ESTIMATE_THRESHOLD', 5):
+            paginator = EstimatedCountPaginator(Category.objects.order_by('id'), 5)
+            self.assertEqual(paginator.count, top_id)
+        self.assertFalse(paginator.exact)
+
+    def test_filtered_counts_are_capped(self):
+        queryset = Category.objects.filter(depth=0).order_by('id')
+        with mock.patch('categories.admin.COUNT_LIMIT', 7):
+            paginator = EstimatedCountPaginator(queryset, 5)
+            self.assertEqual(paginator.count, 7)
+        self.assertFalse(paginator.exact)
+
+        # Pages past the capped count are still served, by slicing
+        self.assertEqual(list(paginator.page(3)), list(queryset[10:15]))
+        self.assertEqual(list(paginator.page(4)), [])
+
+
+class AdminActionTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.root = create_category('Root')
+        self.child = create_category('Child', parent=self.root)
+        self.target = create_category('Target')
+
+    def run_action(self, model_name, action, ids, **data):
+        return self.client.post(
+            reverse(f'admin:categories_{model_name}_changelist'),
+            {'action': action, '_selected_action': ids, **data},
+            follow=True,
+        )
+
+    def test_changelist(self):
+        response = self.client.get(reverse('admin:categories_category_changelist'))
+        self.assertContains(response, 'Target')
+
+    def test_changelist_search(self):
+        response = self.client.get(reverse('admin:categories_category_changelist'), {'q': 'targ'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.target])
+
+    def test_move_subtree(self):
+        self.run_action('category', 'move_subtree', [self.root.id], target_id=self.target.id)
+
+        self.child.refresh_from_db()
+        self.assertEqual(self.child.path, f'{self.target.id}/{self.root.id}/{self.child.id}/')
+        self.assertEqual(self.child.depth, 2)
+
+    def test_move_subtree_under_itself(self):
+        response = self.run_action('category', 'move_subtree', [self.root.id], target_id=self.child.id)
+
+        self.assertContains(response, 'Cannot move a category under itself')
+        self.root.refresh_from_db()
+        self.assertIsNone(self.root.parent_id)
+
+    def test_move_subtree_without_target(self):
+        response = self.run_action('category', 'move_subtree', [self.root.id])
+
+        self.assertContains(response, 'Enter a target category id.')
+        self.root.refresh_from_db()
+        self.assertIsNone(self.root.parent_id)
+
+    def test_merge_similarities(self):
+        self.root.mark_similar_to(self.child)
+        self.run_action('category', 'merge_similarities', [self.root.id], target_id=self.target.id)
+
+        self.assertEqual(
+            list(CategorySimilarity.objects.values_list('category_a_id', 'category_b_id')),
+            [(self.child.id, self.target.id)],
+        )
+
+    def test_unmark_selected(self):
+        self.root.mark_similar_to(self.child)
+        self.child.mark_similar_to(self.target)
+        similarity = CategorySimilarity.objects.get(category_a=self.root)
+
+        response = self.run_action('categorysimilarity', 'unmark_selected', [similarity.id])
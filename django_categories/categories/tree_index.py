@@ -0,0 +1,183 @@
+"""
+In-memory index of the category tree for hierarchy questions.
+
+Built from a single values_list('id', 'parent_id') pass. Categories are
+numbered 0..n-1 in id order; parents and children (CSR offsets into one
+array) are kept as arrays of those numbers. A depth-first walk assigns
+every category its Euler-tour entry number, its position in the preorder
+listing; since a subtree is visited in one go, the category's descendants
+are exactly the next subtree_size - 1 entries. So:
+
+    B is under A            entry[A] < entry[B] < exit[A]        O(1)
+    descendants of A        preorder[entry[A] + 1:exit[A]]       one slice
+    subtree size of A       exit[A] - entry[A]                   O(1)
+
+with exit[A] = entry[A] + subtree size. Ancestors are a walk up the parent
+array, without a query per level.
+
+Every new, deleted or moved category renumbers part of the tour, so such
+writes bump GraphVersion.tree_version (see signals.py and Category.save) and
+the index is rebuilt on next use. The index is kept per process, and each
+get_tree_index() call compares it with the persisted tree_version (a
+primary key lookup), so the writes of other processes are seen at once:
+responses cached under a GraphVersion are never built from an older tree.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+
+from .metrics import timed
+from .models import Category, GraphVersion
+
+NO_PARENT = -1
+
+
+class CategoryTreeIndex:
+    def __init__(self, rows, tree_version=0):
+        """
+        rows: (id, parent_id) of every category, in id order; tree_version
+        the GraphVersion.tree_version they reflect at least.
+        """
+        self.tree_version = tree_version
+        self.ids = array('q')
+        parent_ids = array('q')
+        for cat_id, parent_id in rows:
+            self.ids.append(cat_id)
+            parent_ids.append(NO_PARENT if parent_id is None else parent_id)
+
+        size = len(self.ids)
+
+        # Temporary id -> node map, dropped once the parents are numbered
+        node_of = {cat_id: node for node, cat_id in enumerate(self.ids)}.get
+        self.parent = array('i', (node_of(parent_id, NO_PARENT) for parent_id in parent_ids))
+        del node_of, parent_ids
+
+        # Children of node are child_indices[child_indptr[node]:child_indptr[node + 1]], in id order
+        counts = array('i', [0]) * (size + 1)
+        for parent in self.parent:
+            if parent != NO_PARENT:
+                counts[parent + 1] += 1
+        for node in range(size):
+            counts[node + 1] += counts[node]
+        self.child_indptr = counts
+        self.child_indices = array('i', [0]) * counts[size]
+        filled = array('i', counts[:size])
+        for node, parent in enumerate(self.parent):
+            if parent != NO_PARENT:
+                self.child_indices[filled[parent]] = node
+                filled[parent] += 1
+
+        # Preorder walk from every root, in id order
+        self.preorder = array('i')
+        self.entry = array('i', [NO_PARENT]) * size
+        self.depth = array('i', [0]) * size
+        for root in range(size):
+            if self.parent[root] != NO_PARENT:
+                continue
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                self.entry[node] = len(self.preorder)
+                self.preorder.append(node)
+                children = self.child_indices[self.child_indptr[node]:self.child_indptr[node + 1]]
+                for child in reversed(children):
+                    self.depth[child] = self.depth[node] + 1
+                    stack.append(child)
+
+        # Subtree sizes, children before parents, then exit = entry + size
+        subtree_sizes = array('i', [1]) * size
+        for node in reversed(self.preorder):
+            parent = self.parent[node]
+            if parent != NO_PARENT:
+                subtree_sizes[parent] += subtree_sizes[node]
+        self.exit = array('i', (entry + subtree_size for entry, subtree_size in zip(self.entry, subtree_sizes)))
+
+    @classmethod
+    def build(cls, queryset=None):
+        queryset = Category.objects.all() if queryset is None else queryset
+        with timed('tree_build'):
+            # Read before the rows: a write committed meanwhile only makes the
+            # index look older than it is
+            tree_version = GraphVersion.current_tree()
+            return cls(queryset.order_by('id').values_list('id', 'parent_id').iterator(chunk_size=10000), tree_version)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, cat_id):
+        return self._node_of(cat_id) is not None
+
+    def _node_of(self, cat_id):
+        node = bisect_left(self.ids, cat_id)
+        if node < len(self.ids) and self.ids[node] == cat_id:
+            return node
+        return None
+
+    def _existing_node(self, cat_id):
+        node = self._node_of(cat_id)
+        if node is None:
+            raise KeyError(cat_id)
+        return node
+
+    def parent_id(self, cat_id):
+        parent = self.parent[self._existing_node(cat_id)]
+        return None if parent == NO_PARENT else self.ids[parent]
+
+    def child_ids(self, cat_id):
+        node = self._existing_node(cat_id)
+        return [self.ids[child] for child in self.child_indices[self.child_indptr[node]:self.child_indptr[node + 1]]]
+
+    def ancestor_ids(self, cat_id):
+        """Ids from the root down to the parent."""
+        ancestors = []
+        node = self.parent[self._existing_node(cat_id)]
+        while node != NO_PARENT:
+            ancestors.append(self.ids[node])
+            node = self.parent[node]
+        return ancestors[::-1]
+
+    def depth_of(self, cat_id):
+        return self.depth[self._existing_node(cat_id)]
+
+    def is_ancestor(self, ancestor_id, cat_id):
+        """Whether cat_id is somewhere below ancestor_id (not the category itself)."""
+        ancestor, node = self._node_of(ancestor_id), self._node_of(cat_id)
+        if ancestor is None or node is None:
+            return False
+        return self.entry[ancestor] < self.entry[node] < self.exit[ancestor]
+
+    def descendant_ids(self, cat_id):
+        """Every category below cat_id, in preorder."""
+        node = self._existing_node(cat_id)
+        return [self.ids[descendant] for descendant in self.preorder[self.entry[node] + 1:self.exit[node]]]
+
+    def subtree_size(self, cat_id):
+        """Number of descendants, excluding the category itself."""
+        node = self._existing_node(cat_id)
+        return self.exit[node] - self.entry[node] - 1
+
+    def memory_bytes(self):
+        arrays = (self.ids, self.parent, self.child_indptr, self.child_indices, self.preorder, self.entry, self.exit, self.depth)
+        return sum(values.itemsize * len(values) for values in arrays)
+
+
+# Process-wide index, built on first use and dropped by writes to the tree
+_tree_index = None
+_tree_index_lock = threading.Lock()
+
+
+def get_tree_index():
+    global _tree_index
+
+    with _tree_index_lock:
+        if _tree_index is None or _tree_index.tree_version < GraphVersion.current_tree():
+            _tree_index = CategoryTreeIndex.build()
+        return _tree_index
+
+
+def reset_tree_index():
+    """Drops the shared index; the next get_tree_index() call rebuilds it."""
+    global _tree_index
+
+    with _tree_index_lock:
+        _tree_index = None
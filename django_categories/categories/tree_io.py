@@ -0,0 +1,166 @@
+"""
+Streaming import and export of Category hierarchies.
+
+Rows are plain dicts with id, parent_id, name, description and image. Input
+does not need to be sorted: a row whose parent has not been seen yet waits
+until the parent arrives, so memory only grows with the number of rows that
+arrive before their parent. Depth and path are computed in memory and rows
+are written with batched bulk_create, bypassing Category.save.
+Exports are ordered by path, which puts every parent before its children,
+so an export can be imported back as-is.
+"""
+import csv
+import json
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from .graph_service import reset_graph_service
+from .models import Category, GraphChange, GraphVersion
+from .tree_index import reset_tree_index
+
+FIELDS = ('id', 'parent_id', 'name', 'description', 'image')
+
+# Paths of written categories kept in memory for their children; beyond this
+# they are looked up again from the database
+PATH_CACHE_SIZE = 100000
+
+
+class CategoryTreeImporter:
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.imported = 0
+
+        self._paths = {}    # id -> path, for recently resolved categories
+        self._buffer = []   # resolved Category objects not written yet
+        self._waiting = {}  # parent_id -> [rows waiting for that parent]
+        self._unchecked = set()  # waiting parent ids not yet looked up in the database
+
+    def add(self, row):
+        parent_id = row.get('parent_id')
+        if parent_id is None:
+            self._resolve(row, '')
+        elif parent_id in self._paths:
+            self._resolve(row, self._paths[parent_id])
+        else:
+            self._waiting.setdefault(parent_id, []).append(row)
+            self._unchecked.add(parent_id)
+
+        if len(self._buffer) >= self.batch_size:
+            self._flush()
+
+    def finish(self):
+        self._flush()
+        self._release_from_database()
+        self._flush()
+
+        if self._waiting:
+            missing = sorted(self._waiting)[:10]
+            raise ValueError(f"Categories reference unknown parents: {missing}")
+
+        # Explicit ids leave sequences (e.g. on PostgreSQL) behind
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Category]):
+                cursor.execute(sql)
+
+        return self.imported
+
+    def _resolve(self, row, parent_path):
+        """Queues a row whose parent path is known, then releases its waiting children."""
+        pending = [(row, parent_path)]
+        while pending:
+            row, parent_path = pending.pop()
+            cat_id = row['id']
+            path = f'{parent_path}{cat_id}/'
+
+            self._buffer.append(Category(
+                id=cat_id,
+                parent_id=row.get('parent_id'),
+                name=row['name'],
+                description=row['description'],
+                image=row['image'],
+                depth=path.count('/') - 1,
+                path=path,
+                island_id=cat_id,
+            ))
+            self._paths[cat_id] = path
+
+            for child in self._waiting.pop(cat_id, ()):
+                pending.append((child, path))
+
+    def _release_from_database(self):
+        """Resolves waiting rows whose parent already exists in the database."""
+        parent_ids = [parent_id for parent_id in self._unchecked if parent_id in self._waiting]
+        self._unchecked = set()
+        for start in range(0, len(parent_ids), 500):
+            existing = Category.objects.filter(id__in=parent_ids[start:start + 500]).values_list('id', 'path')
+            for parent_id, path in existing:
+                for row in self._waiting.pop(parent_id, ()):
+                    self._resolve(row, path)
+
+    def _flush(self):
+        if not self._buffer:
+            return
+
+        Category.objects.bulk_create(self._buffer, batch_size=self.batch_size)
+        self.imported += len(self._buffer)
+        self._buffer = []
+
+        # Everything cached has been written, so it is safe to forget
+        if len(self._paths) > PATH_CACHE_SIZE:
+            self._paths = {}
+
+        # Parents that were not part of this input are looked up once
+        self._release_from_database()
+
+
+def import_tree(rows, batch_size=1000):
+    importer = CategoryTreeImporter(batch_size=batch_size)
+    with transaction.atomic():
+        for row in rows:
+            importer.add(row)
+        imported = importer.finish()
+        GraphVersion.bump(tree=True)
+
+        # bulk_create sends no signals, so the cached graph cannot be patched
+        GraphChange.log(GraphChange.RESET)
+        transaction.on_commit(reset_graph_service)
+        transaction.on_commit(reset_tree_index)
+
+    return imported
+
+
+def export_tree(queryset, chunk_size=2000):
+    """Yields category rows, parents first, without loading the table."""
+    return queryset.order_by('path').values(*FIELDS).iterator(chunk_size=chunk_size)
+
+
+def read_rows(stream, file_format):
+    if file_format == 'csv':
+        for row in csv.DictReader(stream):
+            yield {
+                'id': int(row['id']),
+                'parent_id': int(row['parent_id']) if row.get('parent_id') else None,
+                'name': row['name'],
+                'description': row['description'],
+                'image': row['image'],
+            }
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_rows(rows, stream, file_format):
+    count = 0
+    if file_format == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(row) + '\n')
+            count += 1
+    return count
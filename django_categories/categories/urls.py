@@ -6,8 +6,18 @@ urlpatterns = [
     path('categoriesByDepth/<int:depth>/', views.indexByDepth, name='categories.indexByDepth'),
     path('categoriesByParent/<int:parent_id>/', views.indexByParent, name='categories.indexByParent'),
     path('categories/getRabbitIslands/', views.getRabbitIslands, name='categories.getRabbitIslands'),
+    path('categories/getRabbitIslandsJson/', views.getRabbitIslandsJson, name='categories.getRabbitIslandsJson'),
     path('categories/getRabbitHole/<int:start>/<int:end>/', views.getRabbitHole, name='categories.getRabbitHole'),
+    path('categories/getRabbitHoles/', views.getRabbitHoles, name='categories.getRabbitHoles'),
+    path('categories/getNeighborhood/<int:category_id>/', views.getNeighborhood, name='categories.getNeighborhood'),
+    path('categories/getBreadcrumbs/<int:category_id>/', views.getBreadcrumbs, name='categories.getBreadcrumbs'),
+    path('categories/search/', views.searchCategories, name='categories.search'),
     path('categories/getLongestRabbitHole/', views.getLongestRabbitHole, name='categories.getLongestRabbitHole'),
+    path('categories/async/getRabbitIslands/', views.agetRabbitIslands, name='categories.agetRabbitIslands'),
+    path('categories/async/getRabbitHole/<int:start>/<int:end>/', views.agetRabbitHole, name='categories.agetRabbitHole'),
+    path('categories/async/getLongestRabbitHole/', views.agetLongestRabbitHole, name='categories.agetLongestRabbitHole'),
+    path('categories/similarities/ingest/', views.ingestSimilarities, name='categories.ingestSimilarities'),
+    path('metrics', views.metrics, name='categories.metrics'),
     path('categories/create/', views.create, name='categories.create'),
     path('categories/store/', views.store, name='categories.store'),
     path('categories/<int:category_id>/', views.show, name='categories.show'),
@@ -1,142 +1,431 @@
 import json
-from django.shortcuts import render
-from django.http import HttpResponse
+from django.core.exceptions import BadRequest
+from django.shortcuts import get_object_or_404, render
+from django.http import HttpResponse, StreamingHttpResponse
 from django.template import loader
 from django.urls import reverse
 from django.views.decorators.http import require_GET, require_POST
-from django.views.decorators.csrf import requires_csrf_token, csrf_protect
+from django.views.decorators.csrf import requires_csrf_token, csrf_exempt, csrf_protect
 from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
 
-from .graph_service import CategoryGraphService
+from .caching import graph_version_cached
+from .graph_service import aget_graph_service, get_graph_service, run_in_graph_executor
+from .metrics import render_metrics, timed
 from .models import Category, CategorySimilarity
+from .search import search_categories
+from .similarity_io import read_pairs
+from .tree_index import get_tree_index
 from .forms import CategoryForm
 
-# graph_service = CategoryGraphService()
+CATEGORIES_PAGE_SIZE = 100
+CATEGORIES_MAX_PAGE_SIZE = 1000
+ISLANDS_PAGE_SIZE = 100
+ISLANDS_MAX_PAGE_SIZE = 1000
+NEIGHBORHOOD_MAX_HOPS = 6
+NEIGHBORHOOD_LIMIT = 500
+NEIGHBORHOOD_MAX_LIMIT = 5000
+RABBIT_HOLES_MAX_PAIRS = 1000
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
 
 # Create your views here.
+def render_template(template, context):
+    with timed('render'):
+        return template.render(context)
+
+def int_param(request, name, default, minimum=None, maximum=None):
+    """
+    The integer query parameter name (default when absent or empty), clamped
+    to [minimum, maximum]. Raises BadRequest, which Django answers with an
+    HttpResponseBadRequest, if it is not an integer.
+    """
+    value = request.GET.get(name, '')
+    if value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadRequest(f'{name} must be an integer, got {value!r}')
+    if minimum is not None:
+        value = max(minimum, value)
+    if maximum is not None:
+        value = min(maximum, value)
+    return value
+
+def paginate_categories(request, categories):
+    """
+    Keyset pagination on id: ?after=<last id seen>&limit=<n>. Unlike OFFSET,
+    every page is an index range scan, however deep into the table it is.
+    Child counts are correlated subqueries, evaluated only for the page rows,
+    and similar categories are prefetched for the whole page at once.
+    """
+    after = int_param(request, 'after', 0)
+    limit = int_param(request, 'limit', CATEGORIES_PAGE_SIZE, 1, CATEGORIES_MAX_PAGE_SIZE)
+
+    page = list(
+        categories.filter(id__gt=after)
+        .with_child_count()
+        .with_similar()
+        .order_by('id')[:limit + 1]
+    )
+    next_after = page[limit - 1].id if len(page) > limit else None
+
+    return {'categories': page[:limit], 'after': after, 'limit': limit, 'next_after': next_after}
+
 def index(request):
     template = loader.get_template('categories.html')
-    categories = Category.objects.all().prefetch_related('children')
-    return HttpResponse(template.render({'categories': categories}))
+    context = paginate_categories(request, Category.objects.all())
+    return HttpResponse(render_template(template, context))
 
 def indexByDepth(request, depth=0):
     template = loader.get_template('categories.html')
-    categories = Category.objects.filter(depth=depth).prefetch_related('children')
-    return HttpResponse(template.render({'categories': categories, 'depth': depth}))
+    context = paginate_categories(request, Category.objects.filter(depth=depth))
+    return HttpResponse(render_template(template, {**context, 'depth': depth}))
 
 def indexByParent(request, parent_id=0):
     template = loader.get_template('categories.html')
-    categories = Category.objects.filter(parent_id=parent_id).prefetch_related('children')
-    return HttpResponse(template.render({'categories': categories, 'parent_id': parent_id}))
-
-def getRabbitHole(request, start, end):
-    graph_service = CategoryGraphService()
-    path_ids = graph_service.find_shortest_path(start, end)
+    context = paginate_categories(request, Category.objects.filter(parent_id=parent_id))
+    return HttpResponse(render_template(template, {**context, 'parent_id': parent_id}))
 
+def rabbit_hole_payload(start, end, path_ids, path_details):
     if path_ids is None:
-        return HttpResponse(json.dumps({
+        return {
             "start_id": start,
             "end_id": end,
             "length": 0,
             "path": [],
-        }), content_type="application/json")
+        }
 
-    path_details = Category.objects.filter(id__in=path_ids).in_bulk(path_ids)
     path_sequence = [{"id": pid, "name": path_details[pid].name} for pid in path_ids]
 
-    return HttpResponse(json.dumps({
+    return {
         "start_id": start,
         "end_id": end,
         "length": len(path_ids) - 1,
         "path": path_sequence,
+    }
+
+@graph_version_cached
+def getRabbitHole(request, start, end):
+    graph_service = get_graph_service()
+    path_ids = graph_service.find_shortest_path(start, end)
+
+    with timed('hydrate'):
+        path_details = Category.objects.in_bulk(path_ids) if path_ids else {}
+
+    return HttpResponse(
+        json.dumps(rabbit_hole_payload(start, end, path_ids, path_details)),
+        content_type="application/json",
+    )
+
+@csrf_exempt
+@require_POST
+def getRabbitHoles(request):
+    """
+    POST /categories/getRabbitHoles/ with {"pairs": [[start, end], ...]}
+    Rabbit holes for up to RABBIT_HOLES_MAX_PAIRS pairs in one request, in
+    the order of the pairs. Pairs sharing an end share one BFS, and all
+    names are loaded with a single query. Read-only, so no CSRF token is
+    needed.
+    """
+    try:
+        pairs = [(int(start), int(end)) for start, end in json.loads(request.body)['pairs']]
+    except (ValueError, KeyError, TypeError) as error:
+        return HttpResponse(
+            json.dumps({"error": f"Expected {{\"pairs\": [[start, end], ...]}}: {error}"}),
+            status=400,
+            content_type="application/json",
+        )
+    if len(pairs) > RABBIT_HOLES_MAX_PAIRS:
+        return HttpResponse(
+            json.dumps({"error": f"At most {RABBIT_HOLES_MAX_PAIRS} pairs per request"}),
+            status=400,
+            content_type="application/json",
+        )
+
+    paths = get_graph_service().find_shortest_paths(pairs)
+
+    with timed('hydrate'):
+        path_details = Category.objects.in_bulk({cat_id for path in paths if path for cat_id in path})
+
+    return HttpResponse(json.dumps({
+        "results": [
+            rabbit_hole_payload(start, end, path_ids, path_details)
+            for (start, end), path_ids in zip(pairs, paths)
+        ],
     }), content_type="application/json")
 
-def getRabbitIslands(request):
-    graph_service = CategoryGraphService()
-    islands = graph_service.get_rabbit_islands()
+@graph_version_cached
+async def agetRabbitHole(request, start, end):
+    """Async getRabbitHole: the BFS runs in the graph executor, off the event loop."""
+    graph_service = await aget_graph_service()
+    path_ids = await run_in_graph_executor(graph_service.find_shortest_path, start, end)
+
+    with timed('hydrate'):
+        path_details = await Category.objects.ain_bulk(path_ids) if path_ids else {}
+
+    return HttpResponse(
+        json.dumps(rabbit_hole_payload(start, end, path_ids, path_details)),
+        content_type="application/json",
+    )
+
+def islands_context(islands, member_rows):
+    # All names in one query, grouped by island in memory
+    members = defaultdict(list)
+    for island_id, category_id, name in member_rows:
+        members[island_id].append({"id": category_id, "name": name})
 
     island_data = []
-    for island in islands:
-        category_details = Category.objects.filter(id__in=island).values('id', 'name')
+    for island_id, size in islands:
         island_data.append({
-            "size": len(island),
-            "categories": list(category_details)
+            "size": size,
+            "categories": members[island_id]
         })
 
-    template = loader.get_template('islands.html')
-    return HttpResponse(template.render({
+    return {
         "total_islands": len(islands),
         "islands": island_data
-    }))
-
-    # adjacency_list = defaultdict(list)
-    # all_category_ids = set(Category.objects.values_list('id', flat=True))
-    # similarities = CategorySimilarity.objects.all().values_list(
-    #     'category_a_id', 'category_b_id'
-    # )
-    #
-    # for id_a, id_b in similarities:
-    #     adjacency_list[id_a].append(id_b)
-    #     adjacency_list[id_b].append(id_a)
-    #
-    # for cat_id in all_category_ids:
-    #     if cat_id not in adjacency_list:
-    #         adjacency_list[cat_id] = []
-    #
-    # visited = set()
-    # islands = []
-    #
-    # for start_node in all_category_ids:
-    #     if start_node not in visited:
-    #         island = []
-    #         stack = [start_node]
-    #
-    #         while stack:
-    #             current_node = stack.pop()
-    #             if current_node not in visited:
-    #                 visited.add(current_node)
-    #                 island.append(current_node)
-    #
-    #                 for neighbor in adjacency_list.get(current_node, []):
-    #                     stack.append(neighbor)
-    #         if island:
-    #             islands.append(island)
-    #
-    # template = loader.get_template('islands.html')
-    # island_data = [];
-    # for island in islands:
-    #     category_details = Category.objects.filter(pk__in=island).values('id', 'name')
-    #
-    #     island_data.append({
-    #         'size': len(island),
-    #         'categories': list(category_details)
-    #     })
-    # # categories = Category.objects.filter(pk__in=islands).prefetch_related('children')
-    # return HttpResponse(template.render({
-    #     'total_islands': len(islands),
-    #     'islands': island_data,
-    # }))
+    }
+
+def island_member_rows():
+    return Category.objects.order_by('island_id', 'id').values_list('island_id', 'id', 'name')
+
+@graph_version_cached
+def getRabbitIslands(request):
+    # Island membership is persisted on Category.island_id
+    islands = list(Category.objects.island_sizes())
+
+    template = loader.get_template('islands.html')
+    return HttpResponse(render_template(template, islands_context(islands, island_member_rows())))
+
+@graph_version_cached
+async def agetRabbitIslands(request):
+    """Async getRabbitIslands, reading both queries through the async ORM."""
+    islands = [island async for island in Category.objects.island_sizes()]
+    member_rows = [row async for row in island_member_rows()]
+
+    template = loader.get_template('islands.html')
+    return HttpResponse(render_template(template, islands_context(islands, member_rows)))
+
+@graph_version_cached
+def getRabbitIslandsJson(request):
+    """
+    GET /categories/getRabbitIslandsJson/?after=<island_id>&limit=<n>
+    Streams one page of islands, ordered by island id, as they are read.
+    Pass the returned "next_after" as "after" to fetch the next page.
+    """
+    after = int_param(request, 'after', 0)
+    limit = int_param(request, 'limit', ISLANDS_PAGE_SIZE, 1, ISLANDS_MAX_PAGE_SIZE)
+
+    sizes = dict(
+        Category.objects.filter(island_id__gt=after)
+        .island_sizes()
+        .order_by('island_id')[:limit]
+    )
+    last_island_id = max(sizes, default=None)
+
+    def stream():
+        yield '{"islands": ['
+        if last_island_id is not None:
+            rows = (
+                Category.objects.filter(island_id__gt=after, island_id__lte=last_island_id)
+                .order_by('island_id', 'id')
+                .values_list('island_id', 'id', 'name')
+                .iterator(chunk_size=2000)
+            )
+            for index, (island_id, island_rows) in enumerate(groupby(rows, key=itemgetter(0))):
+                yield (',' if index else '') + json.dumps({
+                    "island_id": island_id,
+                    "size": sizes[island_id],
+                    "categories": [{"id": category_id, "name": name} for _, category_id, name in island_rows],
+                })
+        next_after = last_island_id if len(sizes) == limit else None
+        yield '], "next_after": %s}' % json.dumps(next_after)
+
+    return StreamingHttpResponse(stream(), content_type="application/json")
 
+@graph_version_cached
+def getNeighborhood(request, category_id):
+    """
+    GET /categories/getNeighborhood/<id>/?k=<hops>&limit=<n>
+    Categories within k similarity hops of a category (the "rabbit hole
+    radius"), grouped by distance, at most limit of them.
+    """
+    k = int_param(request, 'k', 1, 1, NEIGHBORHOOD_MAX_HOPS)
+    limit = int_param(request, 'limit', NEIGHBORHOOD_LIMIT, 1, NEIGHBORHOOD_MAX_LIMIT)
+
+    levels, truncated = get_graph_service().neighborhood(category_id, k, limit)
+    if levels is None:
+        return HttpResponse(
+            json.dumps({"error": f"Category {category_id} does not exist"}),
+            status=404,
+            content_type="application/json",
+        )
+
+    with timed('hydrate'):
+        names = dict(
+            Category.objects.filter(id__in=[cat_id for level in levels for cat_id in level])
+            .values_list('id', 'name')
+        )
+
+    return HttpResponse(json.dumps({
+        "id": category_id,
+        "k": k,
+        "limit": limit,
+        "truncated": truncated,
+        "hops": [
+            {
+                "distance": distance,
+                "categories": [{"id": cat_id, "name": names.get(cat_id)} for cat_id in level],
+            }
+            for distance, level in enumerate(levels, start=1)
+        ],
+    }), content_type="application/json")
+
+@graph_version_cached
+def getBreadcrumbs(request, category_id):
+    """
+    GET /categories/getBreadcrumbs/<id>/
+    The path from the root down to a category, each step with its number of
+    descendants, from the cached tree index plus one query for the names.
+    """
+    tree = get_tree_index()
+    if category_id not in tree:
+        return HttpResponse(
+            json.dumps({"error": f"Category {category_id} does not exist"}),
+            status=404,
+            content_type="application/json",
+        )
+
+    crumb_ids = tree.ancestor_ids(category_id) + [category_id]
+    with timed('hydrate'):
+        names = dict(Category.objects.filter(id__in=crumb_ids).values_list('id', 'name'))
+
+    return HttpResponse(json.dumps({
+        "id": category_id,
+        "breadcrumbs": [
+            {
+                "id": cat_id,
+                "name": names.get(cat_id),
+                "depth": depth,
+                "descendants": tree.subtree_size(cat_id),
+            }
+            for depth, cat_id in enumerate(crumb_ids)
+        ],
+    }), content_type="application/json")
+
+@graph_version_cached
+def searchCategories(request):
+    """
+    GET /categories/search/?q=<text>&limit=<n>
+    Categories whose names match q, best first, for autocompleting the
+    ends of a rabbit hole. Words of q match as prefixes.
+    """
+    query = request.GET.get('q', '')
+    limit = int_param(request, 'limit', SEARCH_LIMIT, 1, SEARCH_MAX_LIMIT)
+
+    return HttpResponse(json.dumps({
+        "query": query,
+        "results": [{"id": cat_id, "name": name} for cat_id, name in search_categories(query, limit)],
+    }), content_type="application/json")
+
+def longest_rabbit_hole_payload(path_ids, path_details, exact):
+    path_sequence = [{"id": pid, "name": path_details[pid].name} for pid in path_ids]
+
+    return {
+        "length": len(path_ids) - 1,
+        "path": path_sequence,
+        "message": (
+            "Calculated exactly across all connected components."
+            if exact else
+            "Calculated via two-BFS approximation on the largest connected component."
+        )
+    }
+
+@graph_version_cached
 def getLongestRabbitHole(request):
     """
     GET /categories/getLongestRabbitHole/
     Returns the longest shortest path (graph diameter approximation).
+    GET /categories/getLongestRabbitHole/?exact=1
+    Returns the exact graph diameter across all islands.
     """
-    graph_service = CategoryGraphService()
-    path_ids = graph_service.find_longest_rabbit_hole()
+    exact = request.GET.get('exact') == '1'
+    graph_service = get_graph_service()
+    path_ids = graph_service.find_longest_rabbit_hole(exact=exact)
 
     # Fetch category names/details for a friendly response
-    path_details = Category.objects.filter(id__in=path_ids).in_bulk(path_ids)
-    path_sequence = [{"id": pid, "name": path_details[pid].name} for pid in path_ids]
+    with timed('hydrate'):
+        path_details = Category.objects.in_bulk(path_ids)
 
-    return HttpResponse(json.dumps({
-        "length": len(path_ids) - 1,
-        "path": path_sequence,
-        "message": "Calculated via two-BFS approximation on the largest connected component."
-    }))
+    return HttpResponse(json.dumps(longest_rabbit_hole_payload(path_ids, path_details, exact)))
+
+@graph_version_cached
+async def agetLongestRabbitHole(request):
+    """Async getLongestRabbitHole; the diameter computation runs in the graph executor."""
+    exact = request.GET.get('exact') == '1'
+    graph_service = await aget_graph_service()
+    path_ids = await run_in_graph_executor(graph_service.find_longest_rabbit_hole, exact=exact)
+
+    with timed('hydrate'):
+        path_details = await Category.objects.ain_bulk(path_ids)
+
+    return HttpResponse(json.dumps(longest_rabbit_hole_payload(path_ids, path_details, exact)))
+
+@csrf_protect
+@require_POST
+def ingestSimilarities(request):
+    """
+    POST /categories/similarities/ingest/?action=mark|unmark&format=jsonl|csv
+    Streams an edge list from the request body into mark_similar_many /
+    unmark_similar_many, chunk by chunk, without buffering the whole body.
+    JSONL lines are {"category_a_id": 1, "category_b_id": 2}; CSV needs a
+    category_a_id,category_b_id header. Send the CSRF token in the
+    X-CSRFToken header.
+    """
+    action = request.GET.get('action', 'mark')
+    file_format = request.GET.get('format', 'jsonl')
+    if action not in ('mark', 'unmark') or file_format not in ('jsonl', 'csv'):
+        return HttpResponse(
+            json.dumps({"error": "action must be mark or unmark, format jsonl or csv"}),
+            status=400,
+            content_type="application/json",
+        )
+
+    lines = (line.decode('utf-8') for line in request)
+    pairs = read_pairs(lines, file_format)
+    try:
+        if action == 'mark':
+            count = CategorySimilarity.objects.mark_similar_many(pairs)
+        else:
+            count = CategorySimilarity.objects.unmark_similar_many(pairs)
+    except (ValueError, KeyError, TypeError) as error:
+        return HttpResponse(
+            json.dumps({"error": f"Invalid edge list: {error}"}),
+            status=400,
+            content_type="application/json",
+        )
+
+    return HttpResponse(
+        json.dumps({"action": action, "count": count}),
+        content_type="application/json",
+    )
+
+@require_GET
+def metrics(request):
+    """
+    GET /metrics
+    Request, phase and graph metrics of this process in the Prometheus text
+    format, see metrics.py.
+    """
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 def show(request, category_id):
-    return HttpResponse(f'Here I imagine this category id {category_id}')
+    category = get_object_or_404(Category.objects.select_related('parent').with_similar(), id=category_id)
+    template = loader.get_template('category.html')
+    return HttpResponse(render_template(template, {'category': category}))
 
 @csrf_protect
 @require_GET
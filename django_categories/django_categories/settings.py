@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so the Server-Timing total covers the whole middleware stack
+    'categories.metrics.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,6 +91,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Rendered graph responses are cached here, see categories/caching.py. The
+# local memory cache is per process; use Redis or Memcached to share it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -129,3 +143,66 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Category similarity graph
+
+# The graph is cached per process and patched from model signals. Writes made
+# by other processes are replayed from the GraphChange log, read at most
+# every CATEGORY_GRAPH_CATCH_UP_INTERVAL seconds (None disables it), and the
+# graph is rebuilt once older than this many seconds (None disables the
+# periodic rebuild).
+CATEGORY_GRAPH_MAX_AGE = 300
+CATEGORY_GRAPH_CATCH_UP_INTERVAL = 1
+
+# With more GraphChange entries pending than this, a catch-up rebuilds the
+# graph instead of replaying them one by one.
+CATEGORY_GRAPH_CATCH_UP_MAX = 10000
+
+# Age in seconds of the GraphChange entries removed by
+# `manage.py compact_graph_changes`; keep it well above the longest time a
+# worker may go without reading the log, or that worker has to rebuild.
+CATEGORY_GRAPH_CHANGE_RETENTION = 86400
+
+# Graph representation: 'dict' (dict of lists, patched in place on
+# every write), 'csr' (compact typed arrays, several times smaller, rebuilt
+# lazily on the first query after a write) or 'mmap' (CSR arrays mapped from
+# the snapshot file below, shared by every worker through the page cache)
+# or 'sql' (no graph in memory: recursive SQL queries, see sql_graph.py).
+CATEGORY_GRAPH_STORAGE = 'dict'
+
+# Graphs with at least this many similarities are always queried with the
+# 'sql' engine, keeping worker memory bounded. None disables the switch.
+CATEGORY_GRAPH_SQL_THRESHOLD = 5_000_000
+
+# Snapshot written by `manage.py build_graph_snapshot` and by 'mmap' workers
+# that find it missing or out of date.
+CATEGORY_GRAPH_SNAPSHOT_PATH = BASE_DIR / 'graph.snapshot'
+
+# Lifetime of rendered graph responses in the cache, keyed on GraphVersion.
+# The graph is caught up to that version before a response is rendered, so
+# entries never go stale; the timeout only bounds the memory they take.
+CATEGORY_GRAPH_CACHE_TIMEOUT = 300
+
+# Threads running graph builds and traversals for the async views.
+CATEGORY_GRAPH_EXECUTOR_WORKERS = 4
+
+# Landmarks per island for the distance oracle (see landmarks.py): bounds
+# on the rabbit hole length in O(#landmarks) and landmark-guided shortest
+# path search. Costs one BFS per landmark whenever the graph changed, and
+# one distance per landmark and category. 0 disables the index.
+CATEGORY_GRAPH_LANDMARKS = 0
+
+# Islands smaller than this get no landmarks, a plain BFS is cheap enough.
+CATEGORY_GRAPH_LANDMARK_MIN_ISLAND = 1000
+
+# Whether shortest paths use the landmark-guided (ALT) search instead of the
+# bidirectional BFS. It only pays off on graphs with long paths: on small-world
+# islands the landmark bounds are loose, A* expands most of the island and is
+# 20-100x slower than meeting in the middle.
+CATEGORY_GRAPH_LANDMARK_SEARCH = False
+
+# Worker processes for the exact diameter computation (?exact=1 on
+# getLongestRabbitHole), spawned per computation. None or 1 keeps it
+# in-process.
+CATEGORY_GRAPH_DIAMETER_WORKERS = None